@@ -0,0 +1,137 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+
+from aiogram import types
+from aiogram.dispatcher.handler import CancelHandler, current_handler
+from aiogram.dispatcher.middlewares import BaseMiddleware
+
+import metrics
+from config import ADMISSION_MAX_INFLIGHT, ADMISSION_QUEUE_BUDGET, ADMISSION_MAX_QUEUE
+
+
+# Configure logger
+logger = logging.getLogger(__name__)
+
+# Priority classes, lower runs first
+HIGH = 0  # Callback answers and inline queries
+NORMAL = 1  # Messages, the rating flow
+LOW = 2  # Heavy flows: who rated me, search, broadcasts, admin tools
+PRIORITY_NAMES = {HIGH: "high", NORMAL: "normal", LOW: "low"}
+
+SHED_TEXT = "Бот сейчас перегружен, попробуйте позже"
+
+
+def priority(value):
+    """Decorator that sets a handler's priority class, or a function of the event returning one"""
+    def decorator(func):
+        func.admission_priority = value
+        return func
+    return decorator
+
+
+class AdmissionController:
+    """Caps concurrent handlers and hands free slots to the highest priority waiter"""
+
+    def __init__(self, limit=ADMISSION_MAX_INFLIGHT, budget=ADMISSION_QUEUE_BUDGET, max_queue=ADMISSION_MAX_QUEUE):
+        self.limit = limit
+        self.budget = budget
+        self.max_queue = max_queue
+        self.in_flight = 0
+        self.queued = 0
+        self._waiters = []
+        self._seq = itertools.count()
+
+    async def acquire(self, level):
+        """Wait for a slot, returns False when the update has to be shed"""
+        if self.in_flight < self.limit and not self.queued:
+            self.in_flight += 1
+            metrics.ADMISSION_QUEUE_WAIT.observe(0, priority=PRIORITY_NAMES[level])
+            return True
+        if self.queued >= self.max_queue:
+            metrics.ADMISSION_SHED.inc(priority=PRIORITY_NAMES[level])
+            return False
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (level, next(self._seq), future))
+        self.queued += 1
+        start = time.perf_counter()
+        try:
+            await asyncio.wait({future}, timeout=self.budget)
+        except asyncio.CancelledError:
+            # Don't leak a slot that was handed over while the task was being cancelled
+            if future.done():
+                self.release()
+            future.cancel()
+            raise
+        finally:
+            self.queued -= 1
+        metrics.ADMISSION_QUEUE_WAIT.observe(time.perf_counter() - start, priority=PRIORITY_NAMES[level])
+        if future.done():
+            # release() handed over its slot
+            return True
+        # Left in the heap, release() skips cancelled waiters
+        future.cancel()
+        metrics.ADMISSION_SHED.inc(priority=PRIORITY_NAMES[level])
+        return False
+
+    def release(self):
+        """Give the slot to the next waiter or free it"""
+        while self._waiters:
+            _, _, future = heapq.heappop(self._waiters)
+            if not future.done():
+                future.set_result(True)
+                return
+        self.in_flight -= 1
+
+
+class AdmissionMiddleware(BaseMiddleware):
+    """Admission control for messages, callback queries and inline queries"""
+
+    def __init__(self, controller=None):
+        self.controller = controller or AdmissionController()
+        metrics.register_collector(self._collect)
+        super(AdmissionMiddleware, self).__init__()
+
+    def _collect(self):
+        metrics.ADMISSION_IN_FLIGHT.set(self.controller.in_flight)
+        metrics.ADMISSION_QUEUED.set(self.controller.queued)
+
+    async def _admit(self, event, data, default):
+        handler = current_handler.get()
+        level = getattr(handler, 'admission_priority', default)
+        if callable(level):
+            level = level(event)
+        if not await self.controller.acquire(level):
+            return False
+        data['_admission'] = True
+        return True
+
+    def _release(self, data):
+        if data.pop('_admission', False):
+            self.controller.release()
+
+    async def on_process_message(self, message: types.Message, data: dict):
+        if not await self._admit(message, data, NORMAL):
+            await message.answer(SHED_TEXT)
+            raise CancelHandler()
+
+    async def on_process_callback_query(self, call: types.CallbackQuery, data: dict):
+        if not await self._admit(call, data, HIGH):
+            await call.answer(SHED_TEXT)
+            raise CancelHandler()
+
+    async def on_process_inline_query(self, inline_query: types.InlineQuery, data: dict):
+        if not await self._admit(inline_query, data, HIGH):
+            # Telegram shows nothing for an unanswered query, the user simply retypes
+            raise CancelHandler()
+
+    async def on_post_process_message(self, message: types.Message, results, data: dict):
+        self._release(data)
+
+    async def on_post_process_callback_query(self, call: types.CallbackQuery, results, data: dict):
+        self._release(data)
+
+    async def on_post_process_inline_query(self, inline_query: types.InlineQuery, results, data: dict):
+        self._release(data)
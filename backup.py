@@ -0,0 +1,261 @@
+#!/usr/bin/env python3
+"""
+Streaming export and parallel import of the posts collection.
+
+Export walks the collection in _id order through a projected cursor and
+writes gzip-compressed chunks of BSON (mongorestore compatible once
+gunzipped) or canonical extended JSON lines. A manifest is rewritten after
+every chunk, so an interrupted export resumes after the last finished one.
+On a replica set running MongoDB 5.0 or later each run reads one snapshot
+and the manifest records its cluster time; the export is point-in-time when
+a single run wrote it. Otherwise documents changed while the export runs
+are written in their latest state and the manifest says it is not.
+
+Import loads chunks with parallel unordered insert_many batches into an
+index-free collection and builds the indexes afterwards. Finished chunks
+are remembered next to the manifest, and a re-imported partial chunk only
+yields duplicate key errors, which are ignored.
+
+    python backup.py export backups/posts
+    MONGODB_DATABASE=kaoka_dev python backup.py import backups/posts --drop
+"""
+import argparse
+import asyncio
+import gzip
+import json
+import logging
+import os
+import sys
+import time
+from itertools import islice
+
+import bson
+from bson import json_util
+from pymongo.errors import BulkWriteError, ConfigurationError, OperationFailure
+
+import database as db
+
+
+# Configure logger
+logger = logging.getLogger(__name__)
+
+MANIFEST = 'manifest.json'
+DUPLICATE_KEY = 11000
+
+
+def _write_json(path, data):
+    """Replace a JSON file atomically"""
+    tmp = f"{path}.tmp"
+    with open(tmp, 'w') as f:
+        json.dump(data, f, indent=2, default=str)
+    os.replace(tmp, path)
+
+
+def _read_json(path, default):
+    if not os.path.exists(path):
+        return default
+    with open(path) as f:
+        return json.load(f)
+
+
+def _encode(doc, fmt):
+    if fmt == 'bson':
+        return bson.encode(doc)
+    return (json_util.dumps(doc, json_options=json_util.CANONICAL_JSON_OPTIONS) + '\n').encode()
+
+
+def _decode(f, fmt):
+    if fmt == 'bson':
+        return bson.decode_file_iter(f)
+    return (json_util.loads(line) for line in f if line.strip())
+
+
+class Progress:
+    """Docs and MB per second on one log line"""
+
+    def __init__(self, label):
+        self.label = label
+        self.start = time.perf_counter()
+        self.docs = 0
+        self.bytes = 0
+
+    def add(self, docs, size):
+        self.docs += docs
+        self.bytes += size
+
+    def report(self, suffix=""):
+        elapsed = max(time.perf_counter() - self.start, 1e-9)
+        logger.info(
+            f"{self.label}: {self.docs} docs, {self.bytes / 2**20:.1f} MB, "
+            f"{self.docs / elapsed:.0f} docs/s, {self.bytes / 2**20 / elapsed:.1f} MB/s{suffix}"
+        )
+
+
+async def _snapshot_session():
+    """Session reading the collection as of one cluster time, None when the deployment has no snapshot reads"""
+    session = await db.client.start_session(snapshot=True)
+    try:
+        # The first read fixes the snapshot
+        await db.posts.find_one({}, {'_id': 1}, session=session)
+    except (ConfigurationError, OperationFailure) as e:
+        await session.end_session()
+        logger.warning(f"Snapshot reads are unavailable, the export is not point-in-time: {str(e)}")
+        return None
+    return session
+
+
+async def export(directory, fmt='bson', chunk_docs=100000, batch_size=5000, level=6, fields=None):
+    """Write the posts collection to compressed chunks, resuming an unfinished export"""
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, MANIFEST)
+    manifest = _read_json(path, None)
+    if manifest is None:
+        manifest = {'collection': 'posts', 'format': fmt, 'fields': fields, 'chunks': [], 'snapshots': [],
+                    'complete': False, 'started': time.time()}
+    elif manifest['complete']:
+        logger.info(f"Export in {directory} is already complete")
+        return manifest
+    else:
+        fmt, fields = manifest['format'], manifest['fields']
+        logger.info(f"Resuming export after {len(manifest['chunks'])} chunks")
+
+    query = {}
+    if manifest['chunks']:
+        query['_id'] = {'$gt': json_util.loads(manifest['chunks'][-1]['last_id'])}
+    projection = dict.fromkeys(fields, 1) if fields else None
+    progress = Progress("Export")
+    session = await _snapshot_session()
+    # Every run reads its own snapshot, chunks from the first one on are as of its cluster time
+    snapshot = {'first_chunk': len(manifest['chunks']) + 1, 'cluster_time': None}
+    if session is not None and session.operation_time is not None:
+        snapshot['cluster_time'] = json_util.dumps(session.operation_time)
+        logger.info(f"Exporting the snapshot at {session.operation_time.as_datetime()}")
+    # Manifests of older exports have no snapshots
+    manifest.setdefault('snapshots', [{'first_chunk': 1, 'cluster_time': None}] if manifest['chunks'] else [])
+    manifest['snapshots'].append(snapshot)
+    cursor = db.posts.find(query, projection, session=session).sort('_id', 1).batch_size(batch_size)
+
+    chunk = None
+
+    def finish_chunk():
+        chunk['file'].close()
+        manifest['chunks'].append({key: chunk[key] for key in ('name', 'docs', 'bytes', 'first_id', 'last_id')})
+        _write_json(path, manifest)
+        progress.report(f", chunk {chunk['name']}")
+
+    try:
+        async for doc in cursor:
+            if chunk is None:
+                name = f"posts-{len(manifest['chunks']) + 1:06d}.{fmt}.gz"
+                chunk = {'name': name, 'docs': 0, 'bytes': 0, 'first_id': json_util.dumps(doc['_id']),
+                         'file': gzip.open(os.path.join(directory, name), 'wb', compresslevel=level)}
+            data = _encode(doc, fmt)
+            chunk['file'].write(data)
+            chunk['docs'] += 1
+            chunk['bytes'] += len(data)
+            chunk['last_id'] = json_util.dumps(doc['_id'])
+            progress.add(1, len(data))
+            if chunk['docs'] >= chunk_docs:
+                finish_chunk()
+                chunk = None
+    finally:
+        if session is not None:
+            await session.end_session()
+    if chunk is not None:
+        finish_chunk()
+
+    # Runs that wrote chunks, resumed exports mix the snapshots of their runs
+    runs = [run for run in manifest['snapshots'] if run['first_chunk'] <= len(manifest['chunks'])]
+    manifest['point_in_time'] = len(runs) <= 1 and all(run['cluster_time'] for run in runs)
+    manifest['complete'] = True
+    manifest['finished'] = time.time()
+    _write_json(path, manifest)
+    progress.report(", done")
+    return manifest
+
+
+async def _import_chunk(directory, chunk, fmt, batch_size, progress):
+    """Insert one chunk, decoding batches in a thread while the previous one is written"""
+    loop = asyncio.get_running_loop()
+    with gzip.open(os.path.join(directory, chunk['name']), 'rb' if fmt == 'bson' else 'rt') as f:
+        docs = _decode(f, fmt)
+        while True:
+            batch = await loop.run_in_executor(None, lambda: list(islice(docs, batch_size)))
+            if not batch:
+                break
+            async with db.db_operation("import_batch", background=True):
+                try:
+                    await db.posts.insert_many(batch, ordered=False)
+                except BulkWriteError as e:
+                    # Already imported by an interrupted run
+                    if any(error['code'] != DUPLICATE_KEY for error in e.details['writeErrors']):
+                        raise
+            progress.add(len(batch), 0)
+    progress.add(0, chunk['bytes'])
+
+
+async def restore(directory, workers=4, batch_size=1000, drop=False):
+    """Load an export into the posts collection and build the indexes afterwards"""
+    manifest = _read_json(os.path.join(directory, MANIFEST), None)
+    if manifest is None:
+        sys.exit(f"No {MANIFEST} in {directory}")
+    if not manifest['complete']:
+        logger.warning("Export is incomplete, importing the finished chunks")
+    state_path = os.path.join(directory, f"import-{db.db.name}.json")
+    if drop:
+        await db.posts.drop()
+        state = {'done': []}
+    else:
+        state = _read_json(state_path, {'done': []})
+    done = set(state['done'])
+    queue = asyncio.Queue()
+    for chunk in manifest['chunks']:
+        if chunk['name'] not in done:
+            queue.put_nowait(chunk)
+    logger.info(f"Importing {queue.qsize()} of {len(manifest['chunks'])} chunks with {workers} workers")
+    progress = Progress("Import")
+
+    async def worker():
+        while not queue.empty():
+            chunk = queue.get_nowait()
+            await _import_chunk(directory, chunk, manifest['format'], batch_size, progress)
+            state['done'].append(chunk['name'])
+            _write_json(state_path, state)
+            progress.report(f", chunk {chunk['name']}")
+
+    await asyncio.gather(*(worker() for _ in range(workers)))
+    start = time.perf_counter()
+    await db.ensure_indexes()
+    logger.info(f"Indexes built in {time.perf_counter() - start:.1f}s")
+    progress.report(", done")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Export or import the posts collection")
+    commands = parser.add_subparsers(dest='command', required=True)
+    exporter = commands.add_parser('export', help="write compressed chunks")
+    exporter.add_argument('directory')
+    exporter.add_argument('--format', choices=['bson', 'ndjson'], default='bson')
+    exporter.add_argument('--chunk-docs', type=int, default=100000, help="documents per chunk file")
+    exporter.add_argument('--batch-size', type=int, default=5000, help="cursor batch size")
+    exporter.add_argument('--level', type=int, default=6, help="gzip compression level")
+    exporter.add_argument('--fields', help="comma separated projection, default all fields")
+    importer = commands.add_parser('import', help="load an export")
+    importer.add_argument('directory')
+    importer.add_argument('--workers', type=int, default=4, help="chunks loaded in parallel")
+    importer.add_argument('--batch-size', type=int, default=1000, help="documents per insert_many")
+    importer.add_argument('--drop', action='store_true', help="drop the collection first")
+    importer.add_argument('--force', action='store_true', help="allow importing into the production database")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    args = parse_args()
+    if args.command == 'export':
+        fields = args.fields.split(',') if args.fields else None
+        asyncio.run(export(args.directory, args.format, args.chunk_docs, args.batch_size, args.level, fields))
+    else:
+        if db.db.name == 'baraboba' and not args.force:
+            sys.exit("Refusing to import into the production database, set MONGODB_DATABASE or pass --force")
+        asyncio.run(restore(args.directory, args.workers, args.batch_size, args.drop))
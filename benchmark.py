@@ -0,0 +1,410 @@
+#!/usr/bin/env python3
+"""
+Microbenchmarks for database.py against a local MongoDB
+Seeds a dedicated database with a reproducible dataset of each requested size,
+then calls every benchmarked function on its own and reports ops/s, latency
+percentiles, BSON bytes on the wire and cache hit rates. Results are written
+as JSON so runs can be compared.
+
+Example:
+    python benchmark.py --sizes 10000,100000,1000000
+    python benchmark.py --sizes 100000 --only get_document,update_mark --compare bench-results/before.json
+"""
+import argparse
+import asyncio
+import json
+import logging
+import math
+import os
+import platform
+import random
+import subprocess
+import sys
+import time
+from datetime import datetime
+
+import bson
+from pymongo import monitoring
+
+from loadtest import SEED_OFFSET, CITIES, percentile
+
+
+class WireCounter(monitoring.CommandListener):
+    """BSON bytes of commands and replies, only counted while enabled"""
+
+    def __init__(self):
+        self.enabled = False
+        self.commands = 0
+        self.sent = 0
+        self.received = 0
+
+    def started(self, event):
+        if self.enabled:
+            self.commands += 1
+            self.sent += len(bson.encode(event.command))
+
+    def succeeded(self, event):
+        if self.enabled:
+            self.received += len(bson.encode(event.reply))
+
+    def failed(self, event):
+        pass
+
+    def reset(self):
+        self.commands = self.sent = self.received = 0
+
+
+# Must be registered before database.py creates the client
+wire = WireCounter()
+monitoring.register(wire)
+
+
+class Benchmark:
+    """A database.py call with the cache state it is measured in"""
+
+    def __init__(self, name, func, cold=False, iterations=None):
+        self.name = name
+        self.func = func
+        self.cold = cold
+        self.iterations = iterations
+
+
+BENCHMARKS = []
+
+
+def benchmark(name, cold=False, iterations=None):
+    """Register a benchmark, cold ones clear the caches before every call"""
+    def decorator(func):
+        BENCHMARKS.append(Benchmark(name, func, cold, iterations))
+        return func
+    return decorator
+
+
+class Context:
+    """Repeatable random arguments for the benchmarked calls"""
+
+    def __init__(self, profiles, seed):
+        self.profiles = profiles
+        self.rng = random.Random(seed)
+
+    def chat_id(self):
+        return SEED_OFFSET + self.rng.randrange(self.profiles)
+
+    def hot_chat_id(self):
+        """80% of the calls go to 1% of the profiles, like the active audience"""
+        if self.rng.random() < 0.8:
+            return SEED_OFFSET + self.rng.randrange(max(self.profiles // 100, 1))
+        return self.chat_id()
+
+    def city(self):
+        return self.rng.choice(CITIES)
+
+
+@benchmark('check')
+async def bench_check(db, ctx):
+    await db.check(ctx.hot_chat_id())
+
+
+@benchmark('get_document')
+async def bench_get_document(db, ctx):
+    await db.get_document(ctx.hot_chat_id())
+
+
+@benchmark('get_document_cold', cold=True)
+async def bench_get_document_cold(db, ctx):
+    await db.get_document(ctx.chat_id())
+
+
+@benchmark('find_answer')
+async def bench_find_answer(db, ctx):
+    await db.find_answer(ctx.chat_id())
+
+
+@benchmark('get_likers')
+async def bench_get_likers(db, ctx):
+    await db.get_likers(ctx.chat_id())
+
+
+@benchmark('get_users_by_name', cold=True, iterations=50)
+async def bench_get_users_by_name(db, ctx):
+    await db.get_users_by_name(f"user{ctx.rng.randrange(ctx.profiles)}")
+
+
+@benchmark('get_random_form', iterations=100)
+async def bench_get_random_form(db, ctx):
+    await db.get_random_form(ctx.chat_id(), ctx.city())
+
+
+@benchmark('get_default_form', iterations=100)
+async def bench_get_default_form(db, ctx):
+    await db.get_default_form(ctx.chat_id())
+
+
+@benchmark('sort_collection_by_mark', cold=True, iterations=50)
+async def bench_sort_by_mark(db, ctx):
+    await db.sort_collection_by_mark()
+
+
+@benchmark('sort_collection_by_mark_cached')
+async def bench_sort_by_mark_cached(db, ctx):
+    await db.sort_collection_by_mark()
+
+
+@benchmark('sort_collection_by_count', cold=True, iterations=50)
+async def bench_sort_by_count(db, ctx):
+    await db.sort_collection_by_count()
+
+
+@benchmark('check_counts', cold=True, iterations=10)
+async def bench_check_counts(db, ctx):
+    await db.check_counts()
+
+
+@benchmark('sender', cold=True, iterations=5)
+async def bench_sender(db, ctx):
+    await db.sender()
+
+
+@benchmark('get_stats', iterations=100)
+async def bench_get_stats(db, ctx):
+    await db.get_stats()
+
+
+@benchmark('change_field')
+async def bench_change_field(db, ctx):
+    await db.change_field(ctx.chat_id(), 'active', ctx.rng.randint(0, 20))
+
+
+@benchmark('update_by')
+async def bench_update_by(db, ctx):
+    await db.update_by(ctx.chat_id(), ctx.chat_id(), ctx.rng.randint(1, 10), None)
+
+
+@benchmark('update_mark')
+async def bench_update_mark(db, ctx):
+    await db.update_mark(ctx.chat_id())
+
+
+def generate_profile(rng, i, profiles, mean_by, max_by):
+    """One profile with a log-normal number of ratings: most have a few, some have thousands"""
+    length = min(max_by, int(rng.lognormvariate(math.log(mean_by + 1) - 0.5, 1.0)))
+    by = [
+        {'id': SEED_OFFSET + rng.randrange(profiles), 'mark': rng.randint(1, 10),
+         'comment': 'ok' if rng.random() < 0.1 else None}
+        for _ in range(length)
+    ]
+    histogram = [0] * 10
+    for item in by:
+        histogram[item['mark'] - 1] += 1
+    return {
+        'chat_id': SEED_OFFSET + i,
+        'name': f'user{i}',
+        'photo': f'photo_{i}',
+        'count': len(by),
+        'by': by,
+        'histogram': histogram,
+        'mark': round(sum(item['mark'] for item in by) / len(by), 2) if by else 0.0,
+        'block': 1 if rng.random() < 0.01 else 0,
+        'active': rng.randint(0, 20),
+        'answer': [],
+        'vip': 1 if rng.random() < 0.05 else 0,
+        'city': rng.choice(CITIES),
+        'updated': datetime.utcnow(),
+    }
+
+
+async def seed(db, profiles, mean_by, max_by, seed_value, reseed=False, batch_size=1000):
+    """Replace the collection with a generated dataset, skipped when it is already seeded"""
+    spec = {'profiles': profiles, 'mean_by': mean_by, 'max_by': max_by, 'seed': seed_value}
+    current = await db.meta.find_one({'_id': 'benchmark_seed'})
+    if current and current.get('spec') == spec and not reseed:
+        print(f"Reusing {profiles} seeded profiles")
+        return
+    print(f"Seeding {profiles} profiles into {db.db.name}.posts...")
+    start = time.perf_counter()
+    # An interrupted seed must not be reused
+    await db.meta.delete_one({'_id': 'benchmark_seed'})
+    await db.posts.drop()
+    await db.stats.drop()
+    rng = random.Random(seed_value)
+    batch = []
+    for i in range(profiles):
+        batch.append(generate_profile(rng, i, profiles, mean_by, max_by))
+        if len(batch) >= batch_size:
+            await db.posts.insert_many(batch, ordered=False)
+            batch = []
+    if batch:
+        await db.posts.insert_many(batch, ordered=False)
+    await db.ensure_indexes()
+    await db.reconcile_stats()
+    await db.meta.update_one({'_id': 'benchmark_seed'}, {'$set': {'spec': spec}}, upsert=True)
+    print(f"Seeded in {time.perf_counter() - start:.1f}s")
+
+
+def cache_counts(metrics):
+    """(hits, misses) over all caches so far"""
+    hits = misses = 0
+    for (cache, result), value in metrics.CACHE_REQUESTS._values.items():
+        if result == 'hit':
+            hits += value
+        else:
+            misses += value
+    return hits, misses
+
+
+def clear_caches(db):
+    db._document_cache.clear()
+    db._bulk_cache.clear()
+
+
+async def run_benchmark(db, metrics, item, ctx, args):
+    """Time sequential calls, then repeat a few with wire accounting on"""
+    iterations = min(args.iterations, item.iterations or args.iterations)
+    clear_caches(db)
+    for _ in range(min(args.warmup, iterations)):
+        if item.cold:
+            clear_caches(db)
+        await item.func(db, ctx)
+
+    latencies = []
+    hits_before, misses_before = cache_counts(metrics)
+    started = time.perf_counter()
+    for _ in range(iterations):
+        if item.cold:
+            clear_caches(db)
+        start = time.perf_counter()
+        await item.func(db, ctx)
+        latencies.append(time.perf_counter() - start)
+        if time.perf_counter() - started > args.max_seconds:
+            break
+    elapsed = time.perf_counter() - started
+    hits, misses = cache_counts(metrics)
+    hits, misses = hits - hits_before, misses - misses_before
+
+    # Encoding every command costs time, so bytes are measured outside the timed loop
+    samples = min(args.wire_samples, len(latencies))
+    wire.reset()
+    wire.enabled = True
+    try:
+        for _ in range(samples):
+            if item.cold:
+                clear_caches(db)
+            await item.func(db, ctx)
+    finally:
+        wire.enabled = False
+
+    calls = len(latencies)
+    return {
+        'calls': calls,
+        'ops_per_second': round(calls / elapsed, 1) if elapsed else 0,
+        'mean_ms': round(sum(latencies) / calls * 1000, 3),
+        'p50_ms': round(percentile(latencies, 50) * 1000, 3),
+        'p90_ms': round(percentile(latencies, 90) * 1000, 3),
+        'p99_ms': round(percentile(latencies, 99) * 1000, 3),
+        'max_ms': round(max(latencies) * 1000, 3),
+        'commands_per_op': round(wire.commands / samples, 2) if samples else None,
+        'bytes_sent_per_op': round(wire.sent / samples) if samples else None,
+        'bytes_received_per_op': round(wire.received / samples) if samples else None,
+        'cache_hit_rate': round(hits / (hits + misses), 3) if hits + misses else None,
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_results(size, results, baseline):
+    print(f"\n{size} profiles")
+    print(f"{'benchmark':<32}{'ops/s':>10}{'p50 ms':>10}{'p99 ms':>10}{'KiB in':>9}{'hit rate':>10}")
+    for name, row in results.items():
+        line = (
+            f"{name:<32}{row['ops_per_second']:>10}{row['p50_ms']:>10}{row['p99_ms']:>10}"
+            f"{(row['bytes_received_per_op'] or 0) / 1024:>9.1f}{row['cache_hit_rate'] if row['cache_hit_rate'] is not None else '-':>10}"
+        )
+        previous = baseline.get(name) if baseline else None
+        if previous and previous.get('ops_per_second'):
+            change = (row['ops_per_second'] - previous['ops_per_second']) / previous['ops_per_second'] * 100
+            line += f"  ({change:+.1f}% ops/s vs baseline)"
+        print(line)
+
+
+async def main(args):
+    import database as db
+    import metrics
+    logging.getLogger().setLevel(logging.WARNING)
+    # Scans of a million profiles are slow by design, they must not open the circuit
+    db.circuit.slow_call = float('inf')
+
+    selected = BENCHMARKS
+    if args.only:
+        names = set(args.only.split(','))
+        unknown = names - {item.name for item in BENCHMARKS}
+        if unknown:
+            sys.exit(f"Unknown benchmarks: {', '.join(sorted(unknown))}")
+        selected = [item for item in BENCHMARKS if item.name in names]
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)['sizes']
+
+    server = await db.db.command('buildInfo')
+    report = {
+        'started': datetime.utcnow().isoformat(),
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'mongodb': server.get('version'),
+        'database': db.db.name,
+        'settings': {key: value for key, value in vars(args).items() if key not in ('json', 'compare', 'list')},
+        'sizes': {},
+    }
+    for size in [int(value) for value in args.sizes.split(',')]:
+        await seed(db, size, args.mean_by, args.max_by, args.seed, args.reseed)
+        results = {}
+        for item in selected:
+            ctx = Context(size, f"{args.seed}:{item.name}")
+            results[item.name] = await run_benchmark(db, metrics, item, ctx, args)
+        report['sizes'][str(size)] = results
+        print_results(size, results, baseline.get(str(size)) if baseline else None)
+
+    path = args.json or os.path.join('bench-results', f"{datetime.utcnow():%Y%m%d-%H%M%S}.json")
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    with open(path, 'w') as f:
+        json.dump(report, f, indent=2, ensure_ascii=False)
+    print(f"\nResults written to {path}")
+    return report
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Microbenchmarks for database.py")
+    parser.add_argument('--sizes', default='10000,100000', help="comma separated numbers of seeded profiles")
+    parser.add_argument('--mean-by', type=int, default=30, help="mean ratings per profile, log-normal")
+    parser.add_argument('--max-by', type=int, default=5000, help="cap of ratings per profile")
+    parser.add_argument('--seed', type=int, default=1, help="random seed of the dataset and the call arguments")
+    parser.add_argument('--reseed', action='store_true', help="seed again even if the dataset matches, "
+                        "write benchmarks slowly change it")
+    parser.add_argument('--iterations', type=int, default=500, help="timed calls per benchmark")
+    parser.add_argument('--warmup', type=int, default=20, help="untimed calls before timing")
+    parser.add_argument('--max-seconds', type=float, default=20, help="stop a benchmark after this long")
+    parser.add_argument('--wire-samples', type=int, default=20, help="calls repeated to measure BSON bytes")
+    parser.add_argument('--only', help="comma separated benchmark names")
+    parser.add_argument('--list', action='store_true', help="list the benchmarks and exit")
+    parser.add_argument('--json', help="result file, default bench-results/<timestamp>.json")
+    parser.add_argument('--compare', help="previous result file to compare against")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    if args.list:
+        for item in BENCHMARKS:
+            print(f"{item.name}{' (cold caches)' if item.cold else ''}")
+        sys.exit()
+    # Seeding drops the collection, never point it at the production database
+    os.environ.setdefault('MONGODB_DATABASE', 'kaoka_bench')
+    if os.environ['MONGODB_DATABASE'] == 'baraboba':
+        sys.exit("Refusing to seed the production database, set MONGODB_DATABASE")
+    asyncio.run(main(args))
@@ -2,14 +2,14 @@
 
 
 import logging
-from aiogram import Bot, Dispatcher, executor, types, md
+from aiogram import Dispatcher, executor, types, md
 from aiogram.contrib.fsm_storage.memory import MemoryStorage
 from aiogram.dispatcher import FSMContext
 from aiogram.dispatcher.filters.state import State, StatesGroup
-import time
 import os
+import io
+import time
 from config import (
-    API_TOKEN,
     admin,
     username,
     unban,
@@ -17,11 +17,34 @@ from config import (
     vipsum,
     number,
     QIWI_SEC_TOKEN,
+    METRICS_HOST,
+    METRICS_PORT,
+    TELEGRAM_API_SERVER,
+    RECORD_UPDATES,
+    MODERATION_INTERVAL,
+    STATS_RECONCILE_INTERVAL,
+    SAMPLER_REBUILD_INTERVAL,
+    RANKING_REBUILD_INTERVAL,
 )
 import database as db
+import hosting
 import keyboard
 import functions
-from qiwipyapi import Wallet
+import metrics
+import tracing
+from throttling import ThrottlingMiddleware, rate_limit
+from admission import AdmissionMiddleware, priority, HIGH, LOW
+from breaker import CLOSED
+from replay import UpdateRecorder
+import events
+from sampler import sampler
+from seen import recently_seen
+from outbox import rating_outbox
+from ranking import ranking
+from scheduler import Scheduler, Interval
+from moderation import ModerationScanner, format_summary
+from collage import top_collage
+from payments import PaymentClient, PaymentReconciler, PAID_STATUSES, PENDING_STATUSES
 from aiogram.utils.deep_linking import get_start_link
 from aiogram.utils import markdown
 import hashlib
@@ -29,8 +52,8 @@ from aiogram.types import InlineQuery
 import random
 import string
 import asyncio
-from functools import lru_cache
 from aiogram.utils.exceptions import MessageNotModified, ChatNotFound, BotBlocked, TelegramAPIError
+from aiogram.bot.api import TelegramAPIServer, TELEGRAM_PRODUCTION
 
 
 # Setup logging with a more specific format
@@ -41,17 +64,27 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 # Initialize bot and dispatcher
+API_SERVER = TelegramAPIServer.from_base(TELEGRAM_API_SERVER) if TELEGRAM_API_SERVER else TELEGRAM_PRODUCTION
 storage = MemoryStorage()
-bot = Bot(token=API_TOKEN)
-dp = Dispatcher(bot, storage=storage)
-
-# Initialize QIWI wallet for payments
-wallet_p2p = Wallet(number, p2p_sec_key=QIWI_SEC_TOKEN)
-
-# Performance optimization: Use a cache dictionary with TTL for liketime and timeout
-# to avoid many small database queries
-liketime = {}
-timeout = {}
+main_bot = hosting.HostedBot(hosting.MAIN, server=API_SERVER)
+# Handlers answer through the bot that received the update, see hosting.py
+bot = hosting.CurrentBot(main_bot)
+dp = hosting.register(Dispatcher(main_bot, storage=storage))
+if RECORD_UPDATES:
+    dp.middleware.setup(UpdateRecorder(RECORD_UPDATES))
+dp.middleware.setup(tracing.TracingMiddleware())
+dp.middleware.setup(ThrottlingMiddleware())
+dp.middleware.setup(AdmissionMiddleware())
+dp.middleware.setup(metrics.MetricsMiddleware())
+
+def create_wallet():
+    """Create the QIWI wallet on the first payment, qiwipyapi is slow to import"""
+    from qiwipyapi import Wallet
+    return Wallet(number, p2p_sec_key=QIWI_SEC_TOKEN)
+
+
+# Initialize QIWI payment client, wallet calls run in a thread pool
+payment_client = PaymentClient(create_wallet)
 
 # Global caches to avoid repeated file gets and message sends
 FILE_CACHE = {}  # Store file paths to avoid repeated getFile requests
@@ -60,6 +93,49 @@ EMOJI_CACHE = {}  # Cache emoji results
 # File cache TTL in seconds (1 hour)
 FILE_CACHE_TTL = 3600
 
+# Rating keyboard answers
+MARKS = [str(mark) for mark in range(1, 11)]
+
+# On-demand stack sampler for /profile
+profiler = tracing.StackSampler()
+
+# Ratings, skips, complaints and answers for analytics, written in batches per hosted bot namespace
+event_log = hosting.BotLocal(lambda config: events.EventLog())
+
+# Profile name and comment checks, runs incrementally in the background and on /scan
+scanner = ModerationScanner()
+
+
+async def notify_admins(text):
+    """Send a moderation summary or a status change to the admin chat"""
+    try:
+        await main_bot.send_message(admchat, text)
+    except TelegramAPIError as e:
+        logger.warning(f"Failed to notify admins: {str(e)}")
+
+
+DEGRADED_TEXT = "База данных временно недоступна, попробуйте позже"
+
+
+@db.circuit.on_change
+def notify_degraded(old, new):
+    """Tell the admins when the bot enters and leaves degraded mode"""
+    if old == CLOSED:
+        text = "⚠️ MongoDB недоступна, бот работает в режиме деградации: чтение из кэша, оценки копятся в очереди"
+    elif new == CLOSED:
+        text = f"✅ MongoDB снова доступна, оценок в очереди: {sum(outbox.pending for outbox in rating_outbox.instances())}"
+    else:
+        # Failed probes while still down
+        return
+    asyncio.create_task(notify_admins(text))
+
+
+async def moderation_job():
+    """Scan profiles changed since the last run and report findings"""
+    summary = await scanner.scan(incremental=True)
+    if summary['flagged']:
+        await notify_admins(format_summary(summary))
+
 # Define FSM states
 class reg(StatesGroup):
     name = State()
@@ -83,6 +159,20 @@ class reg(StatesGroup):
     wait = State()
     city = State()
 
+@metrics.register_collector
+def collect_fsm_states():
+    """Count users per FSM state in the memory storages of all hosted bots"""
+    populations = {}
+    for dispatcher in hosting.dispatchers:
+        for chat in dispatcher.storage.data.values():
+            for user in chat.values():
+                state = user.get("state")
+                if state:
+                    populations[state] = populations.get(state, 0) + 1
+    metrics.FSM_STATES.clear()
+    for state, count in populations.items():
+        metrics.FSM_STATES.set(count, state=state)
+
 # Helper functions to reduce code duplication and increase performance
 async def send_menu_message(chat_id, text):
     """Send a message with the menu keyboard"""
@@ -103,7 +193,9 @@ async def get_file_path(photo):
     if photo in FILE_CACHE:
         path, timestamp = FILE_CACHE[photo]
         if time.time() - timestamp < FILE_CACHE_TTL:
+            metrics.cache_lookup("file", True)
             return path
+    metrics.cache_lookup("file", False)
     
     try:
         file = await bot.get_file(photo)
@@ -113,7 +205,6 @@ async def get_file_path(photo):
         logger.error(f"Error getting file path: {str(e)}")
         return None
 
-@lru_cache(maxsize=20)  # Cache emoji results
 async def get_emoji(num):
     """Cached version of emojies function to avoid repeated calculations"""
     if num in EMOJI_CACHE:
@@ -176,6 +267,14 @@ async def errors_handler(update, exception):
         # User blocked the bot
         logger.warning(f"Bot blocked by user: {update}")
         return True
+
+    if isinstance(exception, db.UNAVAILABLE):
+        # Degraded mode and nothing cached to answer from
+        if update.message:
+            await update.message.answer(DEGRADED_TEXT)
+        elif update.callback_query:
+            await update.callback_query.answer(DEGRADED_TEXT)
+        return True
         
     logger.error(f"Update: {update}\nError: {exception}")
     return True
@@ -332,7 +431,10 @@ async def profile(message: types.Message):
         # Update mark in a non-blocking way
         likes = await db.update_mark(user_id)
         
-        caption = f"📛Имя: {name}\n💯Вас оценили на: {likes}/10\n📊Вас оценили {count} человек(а)\n🔝Вас могут оценить {active} раз(а)\n🌆Город: {city}"
+        caption = f"📛Имя: {name}\n💯Вас оценили на: {likes}/10\n📊Вас оценили {count} человек(а)\n🔝Вас могут оценить {active} раз(а)\n🌆Город: {city}\n{ranking.describe(user_id)}"
+        histogram = functions.format_histogram(block.get("histogram"))
+        if histogram:
+            caption += f"\n\n{histogram}"
         
         # Send media with caption
         custom_keyboard = await keyboard.change(user_id)
@@ -590,11 +692,40 @@ async def vip(message: types.Message):
         await reg.buy.set()
 
 
+async def grant_vip(chat_id, bot_name=None):
+    """Activate VIP after a confirmed payment and notify the user and admins through the bot
+    the bill was made in, the current one by default"""
+    # The reconciler may check the bill from another bot of the namespace
+    await hosting.run_as(bot_name, _grant_vip, chat_id)
+
+
+async def _grant_vip(chat_id):
+    await db.change_field(chat_id, "vip", 1)
+    # The user may still be waiting on the "Я оплатил" keyboard
+    await Dispatcher.get_current().current_state(chat=chat_id, user=chat_id).finish()
+    await send_menu_message(
+        chat_id,
+        "🔥 Поздравляю! Вы приобрели VIP на месяц\n\n⭐️ Теперь вам доступна функция ответа на комментарии!",
+    )
+    # Log successful payment
+    logger.info(f"User {chat_id} successfully purchased VIP")
+    # Notify admins
+    for adm in admin:
+        try:
+            await bot.send_message(adm, f"Пользователь {chat_id} купил вип!")
+        except TelegramAPIError as e:
+            logger.warning(f"Failed to notify admin {adm}: {str(e)}")
+
+
+payment_reconciler = PaymentReconciler(payment_client, grant_vip)
+
+
 @dp.message_handler(state=reg.buy, chat_type=["private"])
 async def buy_vip(message: types.Message, state: FSMContext):
     if message.text == "Приобрести":
-        link, bid = await functions.pay(wallet_p2p)
+        link, bid = await payment_client.create_bill(message.chat.id)
         if link and bid:
+            await payment_reconciler.track(message.chat.id, link, bid)
             await state.update_data({"bid": bid})
             await message.answer(
                 "Для покупки VIP на 1 месяц - {} руб. После успешной оплаты жми 'Я оплатил'".format(vipsum),
@@ -621,25 +752,20 @@ async def wait_success(message: types.Message, state: FSMContext):
                 await state.finish()
                 return
                 
-            # Use the optimized payment status checking function
-            status = await functions.check_payment(wallet_p2p, bid)
+            # Same path as the background reconciler, VIP is granted exactly once
+            bill = await db.get_bill(bid)
+            if bill:
+                status = await payment_reconciler.check(bill)
+            else:
+                status = await payment_client.get_status(bid)
+                if status in PAID_STATUSES:
+                    payment_client.forget(message.chat.id)
+                    await grant_vip(message.chat.id)
                 
-            if status == "PAID" or status == "COMPLETED":
-                # Payment successful
-                await db.change_field(message.chat.id, "vip", 1)
-                await message.answer(
-                    "🔥 Поздравляю! Вы приобрели VIP на месяц\n\n⭐️ Теперь вам доступна функция ответа на комментарии!",
-                    reply_markup=keyboard.menu,
-                )
-                # Log successful payment
-                logger.info(f"User {message.chat.id} successfully purchased VIP")
-                # Notify admins
-                for adm in admin:
-                    await bot.send_message(
-                        adm, f"Пользователь {message.chat.id} купил вип!"
-                    )
+            if status in PAID_STATUSES:
+                # grant_vip has already congratulated the user
                 await state.finish()
-            elif status == "WAITING" or status == "PENDING":
+            elif status in PENDING_STATUSES:
                 # Payment still pending
                 await message.answer(
                     "⏳ Платеж в обработке. Пожалуйста, подождите или попробуйте еще раз через минуту.",
@@ -672,7 +798,8 @@ async def mark(message: types.Message, state: FSMContext):
     if block["block"] == 0:
         try:
             city = block["city"]
-            form = await db.get_random_form(message.chat.id, city)
+            seen = await recently_seen.get(state)
+            form = await sampler.get_form(message.chat.id, city, seen)
             if form == False:
                 linkencoded = await get_start_link(message.chat.id, encode=True)
                 await message.answer(
@@ -684,6 +811,7 @@ async def mark(message: types.Message, state: FSMContext):
             else:
                 chat_id = form[0]["chat_id"]
                 print("{} оценивает {}".format(message.chat.id, chat_id))
+                await recently_seen.add(state, chat_id)
                 photo = form[0]["photo"]
                 name = form[0]["name"]
                 city = form[0]["city"]
@@ -718,6 +846,9 @@ async def mark(message: types.Message, state: FSMContext):
                         parse_mode="Markdown",
                     )
                 await reg.mark.set()
+        except db.UNAVAILABLE:
+            # Retrying would only spin until MongoDB is back
+            raise
         except Exception as error:
             print(error)
             await mark(message, state)
@@ -730,6 +861,8 @@ async def mark(message: types.Message, state: FSMContext):
 
 
 @dp.message_handler(state=reg.mark, chat_type=["private"])
+# Only a rating is debounced, skipping and reporting are never dropped
+@rate_limit(1, per=1, when=lambda message: message.text in MARKS)
 async def mark_photo(message: types.Message, state: FSMContext):
     block = await db.get_document(message.chat.id)
     if block["block"] == 0:
@@ -742,42 +875,28 @@ async def mark_photo(message: types.Message, state: FSMContext):
             )
             await reg.msg.set()
         elif message.text == "Пропустить":
+            data = await state.get_data()
+            event_log.log(events.SKIP, message.chat.id, data.get("chat_id"))
             await mark(message, state)
         else:
-            marks = ["1", "2", "3", "4", "5", "6", "7", "8", "9", "10"]
-            if message.text in marks:
+            if message.text in MARKS:
                 try:
-                    if (
-                        message.chat.id not in liketime
-                        or time.time() >= liketime[message.chat.id]
-                    ):
-                        liketime[message.chat.id] = time.time() + 1
-                        data = await state.get_data()
-                        chat_id = data.get("chat_id")
-                        comment = data.get("comment")
-                        await state.finish()
-                        fullbase = await db.get_document(chat_id)
-                        count = fullbase["count"]
-                        active = fullbase["active"]
-                        liker = block["active"]
-                        await db.change_field(message.chat.id, "active", liker + 1)
-                        if active != 0:
-                            await db.change_field(chat_id, "active", active - 1)
-                        await db.change_field(chat_id, "count", count + 1)
-                        await db.update_by(
-                            chat_id, message.chat.id, int(message.text), comment
-                        )
-                        await db.update_mark(chat_id)
-                        await mark(message, state)
-                    elif (
-                        message.chat.id in liketime
-                        and time.time() <= liketime[message.chat.id]
-                    ):
-                        pass
+                    data = await state.get_data()
+                    chat_id = data.get("chat_id")
+                    comment = data.get("comment")
+                    await state.finish()
+                    # Applied in the background, the next profile is sent right away
+                    await rating_outbox.submit(message.chat.id, chat_id, int(message.text), comment)
+                    event_log.log(
+                        events.RATING, message.chat.id, chat_id, mark=int(message.text), comment=bool(comment)
+                    )
+                    await mark(message, state)
+                except db.UNAVAILABLE:
+                    raise
                 except Exception as error:
                     print(
-                        "Юзер {} получил ошибку {} при оценивании {}\nДокумент: {}".format(
-                            message.chat.id, error, chat_id, fullbase
+                        "Юзер {} получил ошибку {} при оценивании {}".format(
+                            message.chat.id, error, chat_id
                         )
                     )
                     await mark(message, state)
@@ -805,6 +924,7 @@ async def report_state(message: types.Message, state: FSMContext):
         if message.text in ["🔞Материал для взрослых", "💰Реклама", "👾Другое"]:
             data = await state.get_data()
             chat_id = data.get("chat_id")
+            event_log.log(events.COMPLAINT, message.chat.id, chat_id, reason=message.text)
             fullbase = await db.get_document(chat_id)
             photo = fullbase["photo"]
             name = fullbase["name"]
@@ -877,6 +997,8 @@ async def comment_state(message: types.Message, state: FSMContext):
 
 
 @dp.message_handler(text="💕Кто меня оценил?", chat_type=["private"])
+@rate_limit(1, per=5)
+@priority(LOW)
 async def who_liked(message: types.Message, state: FSMContext):
     user_id = message.chat.id
     
@@ -889,13 +1011,6 @@ async def who_liked(message: types.Message, state: FSMContext):
             )
             return
             
-        # Check rate limiting
-        if user_id in timeout and time.time() <= timeout[user_id]:
-            return  # Silent return on rate limit
-            
-        # Set rate limit
-        timeout[user_id] = time.time() + 5
-        
         # Update ratings
         await db.update_mark(user_id)
         
@@ -925,7 +1040,8 @@ async def who_liked(message: types.Message, state: FSMContext):
             
             # Small delay between batches to avoid rate limits
             if i + BATCH_SIZE < len(sender):
-                await asyncio.sleep(1)
+                with tracing.span("sleep.batch_delay"):
+                    await asyncio.sleep(1)
             
     except Exception as e:
         logger.error(f"Error in who_liked handler for user {user_id}: {str(e)}")
@@ -988,6 +1104,7 @@ async def top(message: types.Message):
 
 
 @dp.callback_query_handler(text="marks")
+@rate_limit(1, per=2, key="top")
 async def tophandler(call):
     try:
         dbcount = await db.sort_collection_by_mark()
@@ -1008,10 +1125,16 @@ async def tophandler(call):
                 f"{i+1}) {user.get('name', '')} - {user.get('mark', 0)}/10 ({user.get('count', 0)} оценок)"
             )
         
-        # Send messages in a batch to reduce number of API calls
+        # One collage of the ten profiles, or the list alone without Pillow
         if messages:
             text = "\n".join(messages)
-            await bot.send_message(call.message.chat.id, text)
+            try:
+                sent = await top_collage.send(call.message.chat.id, dbcount[:10], text)
+            except Exception as e:
+                logger.error(f"Top collage failed: {str(e)}")
+                sent = False
+            if not sent:
+                await bot.send_message(call.message.chat.id, text)
             
     except MessageNotModified:
         # Ignore this common error
@@ -1025,6 +1148,7 @@ async def tophandler(call):
 
 
 @dp.callback_query_handler(lambda call: call.data.startswith("marksbutton"))
+@rate_limit(2, per=1, key="topbutton")
 async def marksbuttons(call):
     try:
         data = call.data.split("_")[1]
@@ -1075,6 +1199,7 @@ async def marksbuttons(call):
 
 
 @dp.callback_query_handler(text="counts")
+@rate_limit(1, per=2, key="top")
 async def topcount(call):
     try:
         dbcount = await db.sort_collection_by_count()
@@ -1147,6 +1272,7 @@ async def answer_state(message: types.Message, state: FSMContext):
                     parse_mode="HTML",
                 )
                 await db.update_answer(int(chat_id), message.chat.id)
+                event_log.log(events.ANSWER, message.chat.id, int(chat_id))
                 await state.finish()
             elif message.text is not None:
                 if len(message.text) <= 300:
@@ -1182,6 +1308,7 @@ async def answer_state(message: types.Message, state: FSMContext):
                             parse_mode="HTML",
                         )
                     await db.update_answer(int(chat_id), message.chat.id)
+                    event_log.log(events.ANSWER, message.chat.id, int(chat_id))
                     await message.answer(
                         "Ваш ответ успешно отправлен пользователю.",
                         reply_markup=keyboard.menu,
@@ -1216,6 +1343,8 @@ async def information(message: types.Message):
 
 
 @dp.inline_handler()
+@rate_limit(1, per=1, burst=3)
+@priority(lambda inline_query: LOW if inline_query.query else HIGH)
 async def inline_echo(inline_query: InlineQuery):
     if inline_query.query == "":
         chat_id = inline_query.from_user.id
@@ -1229,9 +1358,12 @@ async def inline_echo(inline_query: InlineQuery):
                 likes = await db.update_mark(chat_id)
                 active = fullbase["active"]
                 city = fullbase["city"]
-                caption = "📛Имя: {}\n💯Вас оценили на: {}/10\n📊Вас оценили {} человек(а)\n🔝Вас могут оценить {} раз(а)\n🌆Город: {}".format(
-                    name, likes, count, active, city
+                caption = "📛Имя: {}\n💯Вас оценили на: {}/10\n📊Вас оценили {} человек(а)\n🔝Вас могут оценить {} раз(а)\n🌆Город: {}\n{}".format(
+                    name, likes, count, active, city, ranking.describe(chat_id)
                 )
+                histogram = functions.format_histogram(fullbase.get("histogram"))
+                if histogram:
+                    caption += "\n\n{}".format(histogram)
                 file = await bot.get_file(photo)
                 randomSource = string.ascii_letters + string.digits
                 password = ""
@@ -1361,19 +1493,129 @@ async def inline_echo(inline_query: InlineQuery):
 @dp.message_handler(commands="admin", chat_type=["private"])
 async def admin_panel(message: types.Message):
     if int(message.chat.id) in admin:
-        await message.answer("Админ-панель\n/giveactive id value - выдать актив", reply_markup=keyboard.apanel)
+        await message.answer(
+            "Админ-панель\n/giveactive id [id ...] value - выдать актив\n/profile секунды - профилирование\n/scan [full] - проверка анкет"
+            "\n\nЗадачи:\n{}".format(await scheduler.status()),
+            reply_markup=keyboard.apanel,
+        )
 
 
-@dp.message_handler(commands='giveactive', chat_type=['private'])
-async def giveactive(message: types.Message):
-    args = message.get_args().split(" ")
-    id, value = args[0], args[1]
-    await db.change_field(int(id), "active", int(value))
-    await message.answer(
-        "Пользователю {} успешно установлено {} актива".format(id, value)
+@dp.message_handler(commands="profile", chat_type=["private"])
+@priority(LOW)
+async def profile_command(message: types.Message):
+    if int(message.chat.id) not in admin:
+        return
+    if profiler.running:
+        await message.answer("Профилирование уже запущено")
+        return
+    args = message.get_args()
+    seconds = min(int(args), 300) if args.isdigit() else 30
+    await message.answer(f"Профилирую {seconds} сек...")
+    folded = await profiler.profile(seconds)
+    await bot.send_document(
+        message.chat.id,
+        types.InputFile(io.BytesIO(folded.encode()), filename=f"profile_{int(time.time())}.folded"),
+        caption="Формат folded stacks: flamegraph.pl или speedscope",
     )
 
 
+@dp.message_handler(commands="scan", chat_type=["private"])
+@priority(LOW)
+async def scan_command(message: types.Message):
+    if int(message.chat.id) not in admin:
+        return
+    if scanner.running:
+        await message.answer("Проверка уже запущена")
+        return
+    full = message.get_args().strip() == "full"
+    await message.answer("Проверяю анкеты...")
+    summary = await scanner.scan(incremental=not full)
+    await message.answer(format_summary(summary))
+
+
+# Uploaded id lists are refused above this size, ten megabytes hold about a million ids
+MAX_ID_FILE = 10 * 1024 * 1024
+# Missing ids listed in a bulk action report
+REPORT_MISSING = 20
+BULK_HINT = "Можно прислать несколько id через пробел, запятую или с новой строки, либо .txt файл со списком"
+
+
+async def read_ids(message: types.Message, text=None):
+    """Ids from an uploaded text file or from text (the message text by default) and the tokens
+    that are not ids, None when the file is too large"""
+    if message.document:
+        if (message.document.file_size or 0) > MAX_ID_FILE:
+            return None
+        file = await bot.download_file_by_id(message.document.file_id)
+        text = file.getvalue().decode("utf-8", "ignore")
+    elif text is None:
+        text = message.text or ""
+    return functions.parse_ids(text)
+
+
+async def apply_bulk(message: types.Message, ids, invalid, field, value, action):
+    """Set a field on the listed users with one bulk write and report the counts"""
+    matched, modified, missing = await db.bulk_change_field(ids, field, value)
+    lines = [
+        f"{action}",
+        f"Всего id: {len(ids)}",
+        f"Найдено: {matched}",
+        f"Изменено: {modified}",
+        f"Нет в базе: {len(missing)}",
+    ]
+    if missing:
+        more = "…" if len(missing) > REPORT_MISSING else ""
+        lines.append(", ".join(str(chat_id) for chat_id in missing[:REPORT_MISSING]) + more)
+    if invalid:
+        lines.append(f"Пропущено не-id: {len(invalid)}")
+    await message.answer("\n".join(lines), reply_markup=keyboard.menu)
+
+
+async def bulk_state_action(message: types.Message, state: FSMContext, field, value, action):
+    """Shared flow of the ban, unban and VIP states: cancel, or apply to the listed ids"""
+    if message.text == "Отмена":
+        await message.answer(
+            "Отмена! Возвращаю в главное меню.", reply_markup=keyboard.menu
+        )
+        await state.finish()
+        return
+    parsed = await read_ids(message)
+    if parsed is None:
+        await message.answer("Файл слишком большой")
+        return
+    ids, invalid = parsed
+    if not ids:
+        await message.answer("Не нашел ни одного id. " + BULK_HINT)
+        return
+    await state.finish()
+    await apply_bulk(message, ids, invalid, field, value, action)
+
+
+@dp.message_handler(
+    commands='giveactive', commands_ignore_caption=False,
+    chat_type=['private'], content_types=['text', 'document'],
+)
+@priority(LOW)
+async def giveactive(message: types.Message):
+    if int(message.chat.id) not in admin:
+        return
+    # /giveactive id [id ...] value, or /giveactive value as the caption of a .txt file with ids
+    args = message.get_args().split()
+    if not args or not args[-1].lstrip("-").isdecimal():
+        await message.answer("Формат: /giveactive id [id ...] значение\nИли .txt файл с id и подписью /giveactive значение")
+        return
+    value = int(args[-1])
+    parsed = await read_ids(message, " ".join(args[:-1]))
+    if parsed is None:
+        await message.answer("Файл слишком большой")
+        return
+    ids, invalid = parsed
+    if not ids:
+        await message.answer("Не нашел ни одного id. " + BULK_HINT)
+        return
+    await apply_bulk(message, ids, invalid, "active", value, f"Установлено {value} актива")
+
+
 @dp.callback_query_handler(lambda call: call.data.startswith("admin"))
 async def adminpanel(call, state: FSMContext):
     if "rass" in call.data:
@@ -1385,11 +1627,20 @@ async def adminpanel(call, state: FSMContext):
             await reg.send_text.set()
     elif "stats" in call.data:
         if int(call.message.chat.id) in admin:
-            count = await db.sender()
-            sum = await db.check_counts()
-            await call.answer(
-                "Всего юзеров: {}\nВсего оценок: {}".format(len(count), sum),
-                show_alert=True,
+            stats = await db.get_stats()
+            total = stats.get("total", {})
+            cities = sorted(stats.get("cities", {}).items(), key=lambda item: item[1].get("users", 0), reverse=True)
+            # Alerts are limited to 200 characters, the city breakdown goes in a message
+            await call.answer()
+            await call.message.answer(
+                "Всего юзеров: {}\nВсего оценок: {}\nЗабанено: {}\nVIP: {}\nОтключено: {}\n\n{}".format(
+                    total.get("users", 0),
+                    total.get("ratings", 0),
+                    total.get("banned", 0),
+                    total.get("vip", 0),
+                    total.get("inactive", 0),
+                    "\n".join(f"{city}: {item.get('users', 0)}" for city, item in cities[:10]),
+                )
             )
     elif "skip" in call.data:
         await call.answer("Пропущено")
@@ -1406,14 +1657,14 @@ async def adminpanel(call, state: FSMContext):
     elif "un" in call.data:
         if int(call.message.chat.id) in admin:
             await call.message.answer(
-                "Введите id пользователя для разбана\n\nДля отмены нажмите кнопку ниже 👇",
+                f"Введите id пользователя для разбана\n{BULK_HINT}\n\nДля отмены нажмите кнопку ниже 👇",
                 reply_markup=keyboard.cancel,
             )
             await reg.text.set()
     elif "id" in call.data:
         if int(call.message.chat.id) in admin:
             await call.message.answer(
-                "Введите id пользователя для бана\n\nДля отмены нажмите кнопку ниже 👇",
+                f"Введите id пользователя для бана\n{BULK_HINT}\n\nДля отмены нажмите кнопку ниже 👇",
                 reply_markup=keyboard.cancel,
             )
             await reg.btext.set()
@@ -1441,61 +1692,29 @@ async def adminpanel(call, state: FSMContext):
     elif call.data == "admin_add_vip":
         if int(call.message.chat.id) in admin:
             await call.message.answer(
-                "Введите telegram id пользователя (циферки) для выдачи VIP доступа",
+                f"Введите telegram id пользователя (циферки) для выдачи VIP доступа\n{BULK_HINT}",
                 reply_markup=keyboard.cancel,
             )
             await reg.vipid.set()
     elif call.data == "admin_rem_vip":
         if int(call.message.chat.id) in admin:
             await call.message.answer(
-                "Введите telegram id пользователя (циферки) у которого нужно забрать VIP доступ",
+                f"Введите telegram id пользователя (циферки) у которого нужно забрать VIP доступ\n{BULK_HINT}",
                 reply_markup=keyboard.cancel,
             )
             await reg.remvip.set()
 
 
-@dp.message_handler(state=reg.vipid, chat_type=["private"])
+@dp.message_handler(state=reg.vipid, chat_type=["private"], content_types=["text", "document"])
+@priority(LOW)
 async def addvip(message: types.Message, state: FSMContext):
-    if message.text == "Отмена":
-        await message.answer(
-            "Отмена! Возвращаю в главное меню.", reply_markup=keyboard.menu
-        )
-        await state.finish()
-    else:
-        if message.text.isdigit():
-            chat = int(message.text)
-            check = await db.check(chat)
-            if check is None:
-                await message.answer("Такого юзера нет")
-            else:
-                await db.change_field(chat, "vip", 1)
-                await message.answer(
-                    "Пользователю {} выдан VIP-доступ".format(message.text),
-                    reply_markup=keyboard.menu,
-                )
-                await state.finish()
+    await bulk_state_action(message, state, "vip", 1, "Выдан VIP-доступ")
 
 
-@dp.message_handler(state=reg.remvip, chat_type=["private"])
+@dp.message_handler(state=reg.remvip, chat_type=["private"], content_types=["text", "document"])
+@priority(LOW)
 async def delvip(message: types.Message, state: FSMContext):
-    if message.text == "Отмена":
-        await message.answer(
-            "Отмена! Возвращаю в главное меню.", reply_markup=keyboard.menu
-        )
-        await state.finish()
-    else:
-        if message.text.isdigit():
-            chat = int(message.text)
-            check = await db.check(chat)
-            if check is None:
-                await message.answer("Такого юзера нет")
-            else:
-                await db.change_field(chat, "vip", 0)
-                await message.answer(
-                    "У пользователю {} отобран VIP-доступ".format(message.text),
-                    reply_markup=keyboard.menu,
-                )
-                await state.finish()
+    await bulk_state_action(message, state, "vip", 0, "Отобран VIP-доступ")
 
 
 @dp.message_handler(state=reg.checkuser, chat_type=["private"])
@@ -1557,6 +1776,7 @@ async def report_state_inline(message: types.Message, state: FSMContext):
             chat_id = data.get("reportid")
             comment = data.get("comment")
             reporter = data.get("reporter")
+            event_log.log(events.COMPLAINT, reporter, chat_id, reason=message.text)
             fullbase = await db.get_document(chat_id)
             photo = fullbase["photo"]
             name = fullbase["name"]
@@ -1609,6 +1829,7 @@ async def report_state_inline(message: types.Message, state: FSMContext):
 
 
 @dp.message_handler(state=reg.send_text, chat_type=["private"])
+@priority(LOW)
 async def process_name(message: types.Message, state: FSMContext):
     if message.text == "Отмена":
         await message.answer(
@@ -1636,38 +1857,16 @@ async def process_name(message: types.Message, state: FSMContext):
         await message.answer("Рассылка завершена.\nДоставлено сообщений: {}".format(x))
 
 
-@dp.message_handler(state=reg.text, chat_type=["private"])
+@dp.message_handler(state=reg.text, chat_type=["private"], content_types=["text", "document"])
+@priority(LOW)
 async def process_unban(message: types.Message, state: FSMContext):
-    if message.text == "Отмена":
-        await message.answer(
-            "Отмена! Возвращаю в главное меню.", reply_markup=keyboard.menu
-        )
-        await state.finish()
-    else:
-        chat = int(message.text)
-        await state.finish()
-        await db.change_field(chat, "block", 0)
-        await message.answer(
-            "Пользователь {} успешно разбанен".format(message.text),
-            reply_markup=keyboard.menu,
-        )
+    await bulk_state_action(message, state, "block", 0, "Разбанены")
 
 
-@dp.message_handler(state=reg.btext, chat_type=["private"])
-async def process_unban(message: types.Message, state: FSMContext):
-    if message.text == "Отмена":
-        await message.answer(
-            "Отмена! Возвращаю в главное меню.", reply_markup=keyboard.menu
-        )
-        await state.finish()
-    else:
-        chat = int(message.text)
-        await state.finish()
-        await db.change_field(chat, "block", 1)
-        await message.answer(
-            "Пользователь {} успешно забанен".format(message.text),
-            reply_markup=keyboard.menu,
-        )
+@dp.message_handler(state=reg.btext, chat_type=["private"], content_types=["text", "document"])
+@priority(LOW)
+async def process_ban(message: types.Message, state: FSMContext):
+    await bulk_state_action(message, state, "block", 1, "Забанены")
 
 
 @dp.message_handler(chat_type=["private"])
@@ -1693,6 +1892,7 @@ async def all_messages(message: types.Message):
 
 
 @dp.callback_query_handler(lambda call: call.data.startswith("countbutton"))
+@rate_limit(2, per=1, key="topbutton")
 async def countbuttons(call):
     try:
         data = call.data.split("_")[1]
@@ -1742,10 +1942,90 @@ async def countbuttons(call):
         await call.answer("Произошла ошибка при загрузке анкеты")
 
 
+async def warm_up():
+    """Fill caches while the bot already accepts updates"""
+    start = time.perf_counter()
+    steps = {
+        "init_db": db.init_db(),
+        "db.warm_up": db.warm_up(),
+        "events.ensure_collection": events.ensure_collection(),
+    }
+    results = await asyncio.gather(*steps.values(), return_exceptions=True)
+    for step, result in zip(steps, results):
+        if isinstance(result, Exception):
+            logger.error(f"Warm-up step {step} failed for bot {hosting.current().name}: {str(result)}")
+    logger.info(f"Warm-up finished in {time.perf_counter() - start:.2f}s")
+
+
+# The other tokens get copies of the handlers above with FSM storages of their own
+for config in hosting.CONFIGS[1:]:
+    hosting.clone_dispatcher(dp, hosting.HostedBot(config, server=API_SERVER))
+
+
+async def rebuild_sampler():
+    await sampler.rebuild()
+
+
+async def rebuild_ranking():
+    await ranking.rebuild()
+
+
+# Periodic jobs, exclusive ones run on a single instance through Mongo leases,
+# jobs touching profiles run once per hosted bot namespace
+scheduler = Scheduler()
+scheduler.add("payments", hosting.per_namespace(payment_reconciler.drain), Interval(payment_reconciler.interval), timeout=120)
+# Reconciled on start too, counters drift while no instance runs
+scheduler.add(
+    "stats", hosting.per_namespace(db.reconcile_stats), Interval(STATS_RECONCILE_INTERVAL),
+    timeout=600, jitter=60, initial_delay=0,
+)
+if MODERATION_INTERVAL:
+    scheduler.add("moderation", hosting.per_namespace(moderation_job), Interval(MODERATION_INTERVAL), timeout=1800, jitter=60)
+# In-memory structures are kept by every instance and built right after start
+scheduler.add(
+    "sampler", hosting.per_namespace(rebuild_sampler), Interval(SAMPLER_REBUILD_INTERVAL),
+    jitter=30, exclusive=False, initial_delay=0,
+)
+scheduler.add(
+    "ranking", hosting.per_namespace(rebuild_ranking), Interval(RANKING_REBUILD_INTERVAL),
+    jitter=30, exclusive=False, initial_delay=0,
+)
+scheduler.add("caches", db.prune_caches, Interval(60), exclusive=False)
+
+
+async def on_startup(dispatcher):
+    """Start background jobs once the event loop is running"""
+    # Index creation and cache warm-up must not delay polling
+    hosting.spawn_each(warm_up)
+    hosting.spawn_each(lambda: event_log.run())
+    hosting.spawn_each(lambda: rating_outbox.run())
+    scheduler.start()
+    await hosting.start_polling(timeout=60, relax=0.1, fast=True)
+    if METRICS_PORT:
+        await metrics.start_server(METRICS_HOST, METRICS_PORT)
+
+
+async def on_shutdown(dispatcher):
+    """Remember the hot profiles so the next start can preload them"""
+    await hosting.stop_polling()
+    await scheduler.stop()
+    await hosting.each_namespace(save_state)
+    scanner.close()
+    top_collage.close()
+    payment_client.close()
+
+
+async def save_state():
+    """Flush the outbox and the event log and save hot profile ids of one namespace"""
+    try:
+        await db.save_hot_ids()
+    except db.UNAVAILABLE:
+        logger.warning("MongoDB is unavailable, hot profile ids not saved")
+    await rating_outbox.close()
+    await event_log.close()
+
+
 if __name__ == "__main__":
-    # Initialize database before starting the bot
-    db.setup_db()
-    
     # Start the bot with skip_updates=True to avoid answering old messages on restart
     # Also set a reasonable value for updates worker count and pool size
     executor.start_polling(
@@ -1754,4 +2034,6 @@ if __name__ == "__main__":
         timeout=60,  # Higher timeout for long operations
         relax=0.1,   # Relax period between updates polling
         fast=True,   # Process updates in parallel
+        on_startup=on_startup,
+        on_shutdown=on_shutdown,
     )
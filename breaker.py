@@ -0,0 +1,90 @@
+import logging
+import time
+from collections import deque
+
+from pymongo.errors import ConnectionFailure
+
+import metrics
+from config import BREAKER_WINDOW, BREAKER_FAILURE_RATE, BREAKER_SLOW_CALL, BREAKER_RESET_TIMEOUT
+
+
+# Configure logger
+logger = logging.getLogger(__name__)
+
+CLOSED = "closed"
+HALF_OPEN = "half_open"
+OPEN = "open"
+STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+
+class DatabaseUnavailable(Exception):
+    """Raised instead of calling MongoDB while the circuit is open"""
+
+
+# Errors that mean MongoDB can't be reached, as opposed to a rejected operation
+UNAVAILABLE = (DatabaseUnavailable, ConnectionFailure)
+
+
+class CircuitBreaker:
+    """Opens when too many of the recent operations failed or were slow, then lets one
+    probe through every reset_timeout seconds and closes once a probe succeeds"""
+
+    def __init__(self, window=BREAKER_WINDOW, failure_rate=BREAKER_FAILURE_RATE,
+                 slow_call=BREAKER_SLOW_CALL, reset_timeout=BREAKER_RESET_TIMEOUT):
+        self.failure_rate = failure_rate
+        self.slow_call = slow_call
+        self.reset_timeout = reset_timeout
+        self.state = CLOSED
+        self.opened_at = None
+        self._outcomes = deque(maxlen=window)  # True for a failed or slow operation
+        self._probe_started = None
+        self._listeners = []
+
+    def on_change(self, func):
+        """Register func(old, new), called on every state transition"""
+        self._listeners.append(func)
+        return func
+
+    def _transition(self, state):
+        old, self.state = self.state, state
+        metrics.DB_BREAKER_STATE.set(STATE_VALUES[state])
+        if state == OPEN:
+            self.opened_at = time.monotonic()
+        if state == CLOSED:
+            self._outcomes.clear()
+        logger.warning(f"MongoDB circuit {old} -> {state}")
+        for func in self._listeners:
+            try:
+                func(old, state)
+            except Exception as e:
+                logger.error(f"Circuit listener failed: {str(e)}")
+
+    def check(self, name):
+        """Raise DatabaseUnavailable unless the operation may go to MongoDB"""
+        if self.state == CLOSED:
+            return
+        now = time.monotonic()
+        if self.state == OPEN and now - self.opened_at >= self.reset_timeout:
+            self._transition(HALF_OPEN)
+            self._probe_started = None
+        if self.state == HALF_OPEN and (self._probe_started is None
+                                        or now - self._probe_started >= self.reset_timeout):
+            # A lost probe (e.g. a cancelled task) is replaced after reset_timeout
+            self._probe_started = now
+            return
+        metrics.DB_BREAKER_REJECTED.inc(operation=name)
+        raise DatabaseUnavailable(f"MongoDB circuit is {self.state}")
+
+    def record(self, failed, elapsed, budget=True):
+        """Count an operation's outcome, slow ones count as failed unless budget is False"""
+        failed = failed or (budget and elapsed > self.slow_call)
+        if self.state == HALF_OPEN:
+            self._probe_started = None
+            self._transition(OPEN if failed else CLOSED)
+            return
+        if self.state == OPEN:
+            return
+        self._outcomes.append(failed)
+        if len(self._outcomes) * 2 >= self._outcomes.maxlen \
+                and sum(self._outcomes) >= self.failure_rate * len(self._outcomes):
+            self._transition(OPEN)
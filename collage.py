@@ -0,0 +1,181 @@
+import asyncio
+import hashlib
+import io
+import logging
+from concurrent.futures import ProcessPoolExecutor
+
+from aiogram import Bot, types
+from aiogram.utils.exceptions import BadRequest
+
+import database as db
+import hosting
+from config import COLLAGE_TILE, COLLAGE_FONT
+
+try:
+    from PIL import Image, ImageDraw, ImageFont, ImageOps
+except ImportError:
+    # Optional, the top is sent as a text list without it
+    Image = None
+
+
+# Configure logger
+logger = logging.getLogger(__name__)
+
+COLUMNS = 5
+BACKGROUND = (24, 24, 27)
+PLACEHOLDER = (52, 52, 58)
+TEXT = (240, 240, 240)
+ACCENT = (255, 196, 0)
+# Tiles of profiles without a photo
+LABELS = {'video': "видео", 'voice': "голос"}
+
+
+def _font(path, size):
+    try:
+        return ImageFont.truetype(path, size)
+    except OSError:
+        return ImageFont.load_default()
+
+
+def _fit(draw, text, font, width):
+    """Cut text with an ellipsis to fit width"""
+    if draw.textlength(text, font=font) <= width:
+        return text
+    while text and draw.textlength(text + "…", font=font) > width:
+        text = text[:-1]
+    return text + "…"
+
+
+def render(tiles, tile=COLLAGE_TILE, font_path=COLLAGE_FONT):
+    """JPEG of (title, score, image bytes or None, label) tiles in rows of COLUMNS, runs in a worker process"""
+    band = tile // 4
+    pad = tile // 16
+    rows = (len(tiles) + COLUMNS - 1) // COLUMNS
+    canvas = Image.new("RGB", (COLUMNS * tile, rows * (tile + band)), BACKGROUND)
+    draw = ImageDraw.Draw(canvas)
+    font = _font(font_path, band // 3)
+    for index, (title, score, data, label) in enumerate(tiles):
+        x, y = index % COLUMNS * tile, index // COLUMNS * (tile + band)
+        thumbnail = None
+        if data:
+            try:
+                thumbnail = ImageOps.fit(Image.open(io.BytesIO(data)).convert("RGB"), (tile, tile), Image.LANCZOS)
+            except OSError:
+                pass
+        if thumbnail is not None:
+            canvas.paste(thumbnail, (x, y))
+        else:
+            draw.rectangle((x + 1, y + 1, x + tile - 2, y + tile - 2), fill=PLACEHOLDER)
+            draw.text((x + tile // 2, y + tile // 2), label, font=font, fill=TEXT, anchor="mm")
+        draw.text((x + pad, y + tile + pad // 2), _fit(draw, title, font, tile - 2 * pad), font=font, fill=TEXT)
+        draw.text((x + pad, y + tile + band // 2), score, font=font, fill=ACCENT)
+    output = io.BytesIO()
+    canvas.save(output, "JPEG", quality=85, optimize=True)
+    return output.getvalue()
+
+
+def signature(top):
+    """Changes only when what the collage shows changes"""
+    shown = "|".join(f"{doc['chat_id']}:{doc.get('photo')}:{doc.get('name')}:{doc.get('mark')}" for doc in top)
+    return hashlib.sha1(shown.encode()).hexdigest()
+
+
+class TopCollage:
+    """Top 10 by mark as one image rendered in a worker process, later views send the
+    Telegram file_id until the top changes"""
+
+    def __init__(self):
+        self._processes = None
+        self._file_ids = {}  # meta key -> (signature, file_id)
+        self._locks = {}
+
+    @property
+    def available(self):
+        return Image is not None
+
+    def _executor(self):
+        if self._processes is None:
+            self._processes = ProcessPoolExecutor(max_workers=1)
+        return self._processes
+
+    async def _cached(self, key):
+        if key not in self._file_ids:
+            # file_ids outlive restarts and are shared with the other instances
+            try:
+                async with db.db_operation("collage_cached"):
+                    doc = await db.meta.find_one({'_id': key})
+            except db.UNAVAILABLE:
+                return None, None
+            self._file_ids[key] = (doc['signature'], doc['file_id']) if doc else (None, None)
+        return self._file_ids[key]
+
+    async def _store(self, key, sig, file_id):
+        self._file_ids[key] = (sig, file_id)
+        try:
+            async with db.db_operation("collage_store"):
+                await db.meta.update_one({'_id': key}, {'$set': {'signature': sig, 'file_id': file_id}}, upsert=True)
+        except db.UNAVAILABLE:
+            logger.warning("MongoDB is unavailable, the collage file_id is kept in memory only")
+
+    async def _send_cached(self, bot, chat_id, key, sig, caption):
+        """Send the stored file_id if it shows this top, False when it doesn't"""
+        cached_sig, file_id = await self._cached(key)
+        if cached_sig != sig:
+            return False
+        try:
+            await bot.send_photo(chat_id, file_id, caption=caption)
+            return True
+        except BadRequest as e:
+            logger.warning(f"Cached collage rejected, rendering again: {str(e)}")
+            self._file_ids[key] = (None, None)
+            return False
+
+    async def _thumbnail(self, bot, file_id):
+        """Image bytes of a profile photo, or None and a label for videos and voice messages"""
+        try:
+            file = await bot.get_file(file_id)
+            for kind, label in LABELS.items():
+                if kind in file.file_path:
+                    return None, label
+            return (await bot.download_file(file.file_path)).getvalue(), ""
+        except Exception as e:
+            logger.warning(f"Collage thumbnail {file_id} unavailable: {str(e)}")
+            return None, "нет фото"
+
+    async def _render(self, bot, top):
+        thumbnails = await asyncio.gather(*(self._thumbnail(bot, doc.get('photo')) for doc in top))
+        tiles = [
+            (f"{place}. {doc.get('name', '')}", f"{doc.get('mark', 0)}/10", data, label)
+            for place, (doc, (data, label)) in enumerate(zip(top, thumbnails), 1)
+        ]
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor(), render, tiles)
+
+    async def send(self, chat_id, top, caption):
+        """Send the collage of top with caption, False when Pillow is not installed"""
+        if not self.available:
+            return False
+        bot = Bot.get_current()
+        # A file_id only works for the bot that uploaded it
+        key = f"top_collage:{hosting.current().name}"
+        sig = signature(top)
+        caption = caption[:1024]
+        if await self._send_cached(bot, chat_id, key, sig, caption):
+            return True
+        async with self._locks.setdefault(key, asyncio.Lock()):
+            # A changed top is rendered once however many users ask for it meanwhile
+            if await self._send_cached(bot, chat_id, key, sig, caption):
+                return True
+            data = await self._render(bot, top)
+            message = await bot.send_photo(
+                chat_id, types.InputFile(io.BytesIO(data), filename="top.jpg"), caption=caption
+            )
+            await self._store(key, sig, message.photo[-1].file_id)
+        return True
+
+    def close(self):
+        if self._processes is not None:
+            self._processes.shutdown(wait=False)
+
+
+top_collage = TopCollage()
@@ -3,10 +3,96 @@ from typing import List
 
 # Load environment variables with fallbacks
 API_TOKEN = os.environ.get('TELEGRAM_API_TOKEN', 'YOUR_TELEGRAM_BOT_TOKEN')
+# Alternative Bot API server, e.g. a local server or loadtest.py's fake API
+TELEGRAM_API_SERVER = os.environ.get('TELEGRAM_API_SERVER', '')
 admin: List[int] = [int(x) for x in os.environ.get('ADMIN_IDS', '123456789').split(',')]
 username = os.environ.get('ADMIN_USERNAME', '@your_username')
 unban = os.environ.get('UNBAN_COST', '200')
 vipsum = os.environ.get('VIP_COST', '99')
 admchat = int(os.environ.get('ADMIN_CHAT_ID', '-1001000000000'))
 number = os.environ.get('QIWI_NUMBER', '70000000000')
-QIWI_SEC_TOKEN = os.environ.get('QIWI_SEC_TOKEN', 'YOUR_QIWI_SECRET_TOKEN') 
\ No newline at end of file
+QIWI_SEC_TOKEN = os.environ.get('QIWI_SEC_TOKEN', 'YOUR_QIWI_SECRET_TOKEN')
+PAYMENT_WORKERS = int(os.environ.get('PAYMENT_WORKERS', '4'))  # threads for blocking QIWI calls
+PAYMENT_TIMEOUT = float(os.environ.get('PAYMENT_TIMEOUT', '10'))  # seconds per QIWI call
+PAYMENT_RECONCILE_INTERVAL = int(os.environ.get('PAYMENT_RECONCILE_INTERVAL', '30'))  # seconds
+PAYMENT_BILL_LIFETIME = int(os.environ.get('PAYMENT_BILL_LIFETIME', '86400'))  # pending bills expire after
+
+# Throttling: 'memory' or 'mongo' (shared between instances)
+THROTTLE_STORAGE = os.environ.get('THROTTLE_STORAGE', 'memory')
+THROTTLE_RATE = float(os.environ.get('THROTTLE_RATE', '2'))  # default tokens per second
+THROTTLE_BURST = int(os.environ.get('THROTTLE_BURST', '5'))
+INLINE_DEBOUNCE = float(os.environ.get('INLINE_DEBOUNCE', '0.5'))  # seconds
+
+# Prometheus metrics endpoint, set METRICS_PORT=0 to disable
+METRICS_HOST = os.environ.get('METRICS_HOST', '0.0.0.0')
+METRICS_PORT = int(os.environ.get('METRICS_PORT', '9100'))
+
+# Updates slower than this (seconds) get their trace span tree logged
+SLOW_UPDATE_THRESHOLD = float(os.environ.get('SLOW_UPDATE_THRESHOLD', '2'))
+
+# Record anonymized raw updates for replay.py, empty disables recording
+RECORD_UPDATES = os.environ.get('RECORD_UPDATES', '')
+RECORD_SALT = os.environ.get('RECORD_SALT', 'change-me')  # keyed hash for anonymized ids
+RECORD_MAX_BYTES = int(os.environ.get('RECORD_MAX_BYTES', str(100 * 1024 * 1024)))
+RECORD_BACKUPS = int(os.environ.get('RECORD_BACKUPS', '5'))
+
+# Moderation scanner: incremental scan interval in seconds (0 disables), scans
+# of at least MODERATION_PROCESS_THRESHOLD profiles are checked in a process pool
+MODERATION_INTERVAL = int(os.environ.get('MODERATION_INTERVAL', '3600'))
+MODERATION_BATCH = int(os.environ.get('MODERATION_BATCH', '1000'))
+MODERATION_PROCESS_THRESHOLD = int(os.environ.get('MODERATION_PROCESS_THRESHOLD', '5000'))
+
+# Recount the admin statistics from the profiles every N seconds to fix drift
+STATS_RECONCILE_INTERVAL = int(os.environ.get('STATS_RECONCILE_INTERVAL', '21600'))
+
+# Event log of ratings, skips, complaints and answers
+EVENTS_RETENTION_DAYS = int(os.environ.get('EVENTS_RETENTION_DAYS', '90'))
+EVENTS_BATCH = int(os.environ.get('EVENTS_BATCH', '500'))  # events per insert_many
+EVENTS_FLUSH_INTERVAL = float(os.environ.get('EVENTS_FLUSH_INTERVAL', '2'))  # seconds
+EVENTS_MAX_BUFFER = int(os.environ.get('EVENTS_MAX_BUFFER', '50000'))  # oldest events are dropped beyond this
+
+# Candidate sampler weighted by active credit: profiles drawn per lookup and full
+# rebuild interval in seconds (picks up changes made by other instances)
+SAMPLER_DRAWS = int(os.environ.get('SAMPLER_DRAWS', '8'))
+SAMPLER_REBUILD_INTERVAL = int(os.environ.get('SAMPLER_REBUILD_INTERVAL', '600'))
+
+# Full rebuild interval in seconds of the in-memory ranking behind the profile place
+RANKING_REBUILD_INTERVAL = int(os.environ.get('RANKING_REBUILD_INTERVAL', '600'))
+
+# Admission control: handlers running at once, seconds an update may wait for a
+# slot before it is shed, and updates allowed to wait
+ADMISSION_MAX_INFLIGHT = int(os.environ.get('ADMISSION_MAX_INFLIGHT', '50'))
+ADMISSION_QUEUE_BUDGET = float(os.environ.get('ADMISSION_QUEUE_BUDGET', '3'))
+ADMISSION_MAX_QUEUE = int(os.environ.get('ADMISSION_MAX_QUEUE', '1000'))
+
+# MongoDB circuit breaker: opens when at least BREAKER_FAILURE_RATE of the last
+# BREAKER_WINDOW operations failed or took longer than BREAKER_SLOW_CALL seconds,
+# then probes again every BREAKER_RESET_TIMEOUT seconds
+BREAKER_WINDOW = int(os.environ.get('BREAKER_WINDOW', '20'))
+BREAKER_FAILURE_RATE = float(os.environ.get('BREAKER_FAILURE_RATE', '0.5'))
+BREAKER_SLOW_CALL = float(os.environ.get('BREAKER_SLOW_CALL', '2'))
+BREAKER_RESET_TIMEOUT = int(os.environ.get('BREAKER_RESET_TIMEOUT', '15'))
+# Expired cache entries are kept this long (seconds) to serve reads while MongoDB is down
+CACHE_STALE_TTL = int(os.environ.get('CACHE_STALE_TTL', '1800'))
+
+# Ratings are appended to this local file on the response path and applied in batches
+# of up to OUTBOX_BATCH every OUTBOX_FLUSH_INTERVAL seconds, failed batches are retried
+# after OUTBOX_RETRY seconds or as soon as MongoDB is back
+RATING_OUTBOX = os.environ.get('RATING_OUTBOX', 'rating-outbox.jsonl')
+OUTBOX_BATCH = int(os.environ.get('OUTBOX_BATCH', '500'))
+OUTBOX_FLUSH_INTERVAL = float(os.environ.get('OUTBOX_FLUSH_INTERVAL', '0.5'))
+OUTBOX_RETRY = int(os.environ.get('OUTBOX_RETRY', '30'))
+
+# Profiles shown to a user are not offered again for SEEN_TTL seconds, up to SEEN_SIZE per user
+SEEN_SIZE = int(os.environ.get('SEEN_SIZE', '100'))
+SEEN_TTL = int(os.environ.get('SEEN_TTL', '21600'))
+
+# More bots served by this process next to TELEGRAM_API_TOKEN: comma-separated
+# token@database/collection entries, the database and the profile collection default
+# to the main bot's (bots sharing them share profiles, tops and caches)
+BOTS = [entry.strip() for entry in os.environ.get('BOTS', '').split(',') if entry.strip()]
+
+# Top 10 collage: tile size in pixels and a TrueType font with Cyrillic glyphs,
+# Pillow's built-in font is used when the file is missing
+COLLAGE_TILE = int(os.environ.get('COLLAGE_TILE', '256'))
+COLLAGE_FONT = os.environ.get('COLLAGE_FONT', '/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf')
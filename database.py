@@ -1,18 +1,26 @@
 import motor.motor_asyncio
 import certifi
 import functions
+import hosting
+import metrics
+import tracing
 import logging
 import asyncio
 import time
 import os
+from contextvars import ContextVar
+from datetime import datetime, timedelta
 from contextlib import asynccontextmanager
 from functools import lru_cache
+from pymongo import UpdateOne
+from breaker import CircuitBreaker, DatabaseUnavailable, UNAVAILABLE
+from config import CACHE_STALE_TTL
 
 
 # Configure logger
 logger = logging.getLogger(__name__)
 
-# Database connection with connection pooling
+# Database connection with connection pooling, shared by every hosted bot
 CONNECTION_STRING = os.environ.get("MONGODB_CONNECTION_STRING", "mongodb://localhost:27017")
 client = motor.motor_asyncio.AsyncIOMotorClient(
     CONNECTION_STRING, 
@@ -22,8 +30,41 @@ client = motor.motor_asyncio.AsyncIOMotorClient(
     serverSelectionTimeoutMS=5000,  # Timeout for server selection
     connectTimeoutMS=10000,  # Timeout for connection
 )
-db = client.baraboba
-posts = db.posts
+
+
+def _collection(name):
+    """Collection of the bot handling the current update, see hosting.py"""
+    return hosting.BotLocal(lambda config: client[config.database][config.collection_name(name)])
+
+
+db = hosting.BotLocal(lambda config: client[config.database])
+posts = hosting.BotLocal(lambda config: client[config.database][config.collection])
+throttle = _collection('throttle')  # Shared token buckets for throttling.MongoThrottleStorage
+bills = _collection('bills')  # Pending VIP payments checked by payments.PaymentReconciler
+meta = _collection('meta')  # Small service documents, e.g. hot profile ids for warm-up
+migrations = _collection('migrations')  # Checkpoints of migrations.py runs
+stats = _collection('stats')  # Incremental counters, see record_stats
+events = _collection('events')  # Append-only event log, see events.py
+leases = _collection('leases')  # Scheduler job leases and last run status
+
+# Profile fields mirrored in the stats counters and the value predicate for each
+STATS_FIELDS = {
+    'block': ('banned', lambda value: value == 1),
+    'vip': ('vip', lambda value: value == 1),
+    'active': ('inactive', lambda value: value == 0),
+}
+STATS_DAY_RETENTION = timedelta(days=400)
+# change_field reads these back in the same round trip, for the counters and profile listeners
+WATCHED_FIELDS = frozenset(STATS_FIELDS) | {'count', 'city', 'mark'}
+PROFILE_STATE = {'city': 1, 'active': 1, 'block': 1, 'vip': 1, 'count': 1, 'mark': 1}
+# Changes to these stamp 'updated', which incremental moderation scans filter on
+MODERATED_FIELDS = frozenset({'name', 'photo', 'by'})
+_profile_listeners = []
+
+# Fails operations fast while MongoDB is unreachable, see breaker.py
+circuit = CircuitBreaker()
+# Set inside db_operation, nested operations are left to the outermost one
+_in_operation = ContextVar('db_in_operation', default=False)
 
 # Set up indexes for better query performance
 async def ensure_indexes():
@@ -32,21 +73,27 @@ async def ensure_indexes():
     await posts.create_index("name")
     await posts.create_index([("count", -1), ("active", 1), ("block", 1)])
     await posts.create_index([("mark", -1), ("active", 1), ("block", 1)])
+    await throttle.create_index("expireAt", expireAfterSeconds=0)
+    await bills.create_index("expireAt", expireAfterSeconds=0)
+    await bills.create_index([("status", 1), ("next_check", 1)])
+    await posts.create_index("updated")  # Incremental moderation scans
+    await stats.create_index("expireAt", expireAfterSeconds=0)
     logger.info("Database indexes created")
 
-# Cache for frequently accessed documents
-_document_cache = {}
+# Cache for frequently accessed documents, one key space per hosted bot namespace
+_document_cache = hosting.BotLocal(lambda config: {})
 _cache_ttl = 300  # seconds
-_bulk_cache = {}  # Cache for bulk operations results
+_bulk_cache = hosting.BotLocal(lambda config: {})  # Cache for bulk operations results
 
 async def _get_from_cache(chat_id):
     """Get document from cache if available and not expired"""
     if chat_id in _document_cache:
         doc, timestamp = _document_cache[chat_id]
         if (time.time() - timestamp) < _cache_ttl:
+            metrics.cache_lookup("document", True)
             return doc
-        # Remove expired cache entry
-        del _document_cache[chat_id]
+        # Expired entries stay until prune_caches, see _serve_stale
+    metrics.cache_lookup("document", False)
     return None
 
 async def _add_to_cache(chat_id, document):
@@ -63,9 +110,9 @@ async def _get_from_bulk_cache(key):
     if key in _bulk_cache:
         result, timestamp = _bulk_cache[key]
         if (time.time() - timestamp) < _cache_ttl:
+            metrics.cache_lookup("bulk", True)
             return result
-        # Remove expired cache entry
-        del _bulk_cache[key]
+    metrics.cache_lookup("bulk", False)
     return None
 
 async def _add_to_bulk_cache(key, result):
@@ -73,14 +120,51 @@ async def _add_to_bulk_cache(key, result):
     if result is not None:
         _bulk_cache[key] = (result, time.time())
 
+def _serve_stale(cache, key, error):
+    """Expired cache entry for reads while MongoDB is unavailable, re-raises error without one"""
+    entry = cache.get(key)
+    if entry is None or time.time() - entry[1] >= CACHE_STALE_TTL:
+        metrics.cache_lookup("stale", False)
+        raise error
+    metrics.cache_lookup("stale", True)
+    return entry[0]
+
+def get_cached(chat_id):
+    """Cached profile regardless of age, None if there is none"""
+    entry = _document_cache.get(chat_id)
+    return entry[0] if entry else None
+
 @asynccontextmanager
-async def db_operation():
-    """Context manager for database operations with error handling"""
+async def db_operation(name="unknown", background=False):
+    """Context manager for database operations with error handling, timing and the circuit breaker,
+    background operations may be slow without counting against the breaker"""
+    outermost = not _in_operation.get()
+    if outermost:
+        circuit.check(name)
+        token = _in_operation.set(True)
+    start = time.perf_counter()
+    failed = False
+    finished = True
     try:
-        yield
+        with tracing.span(f"db.{name}"):
+            yield
+    except asyncio.CancelledError:
+        # Says nothing about the database, a cancelled probe is retried by the breaker
+        finished = False
+        raise
     except Exception as e:
-        logger.error(f"Database error: {str(e)}")
+        failed = isinstance(e, UNAVAILABLE)
+        if not isinstance(e, DatabaseUnavailable):
+            metrics.DB_ERRORS.inc(operation=name)
+            logger.error(f"Database error in {name}: {str(e)}")
         raise
+    finally:
+        elapsed = time.perf_counter() - start
+        metrics.DB_LATENCY.observe(elapsed, operation=name)
+        if outermost:
+            _in_operation.reset(token)
+            if finished:
+                circuit.record(failed, elapsed, budget=not background)
 
 async def check(chat_id):
     """Check if a document with the given chat_id exists"""
@@ -89,13 +173,13 @@ async def check(chat_id):
     if cached_doc:
         return True
         
-    async with db_operation():
+    async with db_operation("check"):
         return await posts.count_documents({'chat_id': chat_id}) > 0
 
 
 async def insert(chat_id, name, photo, city):
     """Insert a new user document"""
-    async with db_operation():
+    async with db_operation("insert"):
         if not await check(chat_id):
             post_data = {
                 'chat_id': chat_id,
@@ -103,15 +187,19 @@ async def insert(chat_id, name, photo, city):
                 'photo': photo,
                 'count': 0,
                 'by': [],
+                'histogram': [0] * 10,
                 'mark': 0,
                 'block': 0,
                 'active': 1,
                 'answer': [],
                 'vip': 0,
-                'city': city
+                'city': city,
+                'updated': datetime.utcnow()
             }
             await posts.insert_one(post_data)
             await _add_to_cache(chat_id, post_data)
+            _notify_profile(chat_id, post_data)
+            await record_stats(city, 'registered', users=1)
 
 
 async def get_document(chat_id):
@@ -122,24 +210,85 @@ async def get_document(chat_id):
         return cached_doc
     
     # If not in cache, get from database
-    async with db_operation():
-        document = await posts.find_one({'chat_id': chat_id})
-        await _add_to_cache(chat_id, document)
-        return document
+    try:
+        async with db_operation("get_document"):
+            document = await posts.find_one({'chat_id': chat_id})
+    except UNAVAILABLE as e:
+        return _serve_stale(_document_cache, chat_id, e)
+    await _add_to_cache(chat_id, document)
+    return document
 
 
 async def change_field(chat_id, field, key):
     """Update a specific field in a document"""
-    async with db_operation():
-        await posts.update_one({'chat_id': chat_id}, {'$set': {field: key}})
+    async with db_operation("change_field"):
+        update = {'$set': {field: key}}
+        if field in MODERATED_FIELDS:
+            update['$set']['updated'] = datetime.utcnow()
+        if field == 'by':
+            # Keep the mark counters in step with the ratings list
+            update['$set']['histogram'] = mark_histogram(key)
+        if field in WATCHED_FIELDS:
+            # Read the previous state in the same round trip to keep the counters exact
+            old = await posts.find_one_and_update({'chat_id': chat_id}, update, PROFILE_STATE)
+        else:
+            await posts.update_one({'chat_id': chat_id}, update)
+            old = None
         # Invalidate cache for this chat_id
         if chat_id in _document_cache:
             del _document_cache[chat_id]
+    if old is not None:
+        _notify_profile(chat_id, dict(old, **{field: key}))
+        await _record_field_change(old, field, key)
+
+
+async def bulk_change_field(chat_ids, field, key):
+    """Set a field on many profiles with one unordered bulk_write, returns matched and
+    modified counts and the chat ids without a profile"""
+    chat_ids = list(dict.fromkeys(chat_ids))
+    if not chat_ids:
+        return 0, 0, []
+    async with db_operation("bulk_change_field"):
+        before = {doc['chat_id']: doc async for doc in posts.find(
+            {'chat_id': {'$in': chat_ids}}, dict(PROFILE_STATE, chat_id=1)
+        )}
+        # No 'updated' stamp, so modified counts only the profiles whose value changed
+        ops = [UpdateOne({'chat_id': chat_id}, {'$set': {field: key}}) for chat_id in chat_ids]
+        result = await posts.bulk_write(ops, ordered=False)
+    for chat_id in chat_ids:
+        _document_cache.pop(chat_id, None)
+    changed = [old for old in before.values() if old.get(field) != key]
+    if field in WATCHED_FIELDS:
+        for old in changed:
+            _notify_profile(old['chat_id'], dict(old, **{field: key}))
+    if field in STATS_FIELDS:
+        # Counter deltas summed per city, a concurrent change in between is fixed by reconcile_stats
+        name, predicate = STATS_FIELDS[field]
+        cities = {}
+        for old in changed:
+            delta = int(predicate(key)) - int(predicate(old.get(field, 0)))
+            if delta:
+                city = city_key(old.get('city'))
+                cities[city] = cities.get(city, 0) + delta
+        for city, delta in cities.items():
+            await record_stats(city, name if delta > 0 else None, event_count=delta, **{name: delta})
+    missing = [chat_id for chat_id in chat_ids if chat_id not in before]
+    return result.matched_count, result.modified_count, missing
+
+
+def mark_histogram(ratings):
+    """Counters of marks 1-10 for a list of ratings"""
+    histogram = [0] * 10
+    for rating in ratings:
+        mark = int(rating.get('mark', 0) or 0)
+        if 1 <= mark <= 10:
+            histogram[mark - 1] += 1
+    return histogram
 
 
 async def find_answer(chat_id):
     """Find answers for a specific chat ID"""
-    async with db_operation():
+    async with db_operation("find_answer"):
         return await posts.find_one({'chat_id': chat_id}, {'answer.id': 1})
 
 
@@ -151,20 +300,23 @@ async def get_users_by_name(name):
     if cached_result:
         return cached_result
         
-    async with db_operation():
-        result = [doc async for doc in posts.find(
-            {'name': {'$regex': name, '$options': 'i'}},
-            {'chat_id': 1, 'name': 1, 'photo': 1, 'count': 1, 'mark': 1, 'active': 1, 'city': 1}  # Project only needed fields
-        )]
-        await _add_to_bulk_cache(cache_key, result)
-        return result
-
-
-async def get_random_form(chat_id, city):
-    """Get a random profile for rating that matches the city criteria"""
+    try:
+        async with db_operation("get_users_by_name"):
+            result = [doc async for doc in posts.find(
+                {'name': {'$regex': name, '$options': 'i'}},
+                {'chat_id': 1, 'name': 1, 'photo': 1, 'count': 1, 'mark': 1, 'active': 1, 'city': 1}  # Project only needed fields
+            )]
+    except UNAVAILABLE as e:
+        return _serve_stale(_bulk_cache, cache_key, e)
+    await _add_to_bulk_cache(cache_key, result)
+    return result
+
+
+async def get_random_form(chat_id, city, exclude=()):
+    """Get a random profile for rating that matches the city criteria, skipping the excluded chat ids"""
     query = {
         'by.id': {'$ne': chat_id},
-        'chat_id': {'$ne': chat_id},
+        'chat_id': {'$nin': [chat_id, *exclude]},
         'block': {'$ne': 1},
         'active': {'$ne': 0},
         'city': {'$regex': city, '$options': 'i'}
@@ -175,16 +327,16 @@ async def get_random_form(chat_id, city):
         {'$sample': {'size': 1}}
     ]
     
-    async with db_operation():
+    async with db_operation("get_random_form"):
         result = [doc async for doc in posts.aggregate(pipeline)]
-        return await get_default_form(chat_id) if not result else result
+        return await get_default_form(chat_id, exclude) if not result else result
 
 
-async def get_default_form(chat_id):
+async def get_default_form(chat_id, exclude=()):
     """Get a random profile for rating with no city filter"""
     query = {
         'by.id': {'$ne': chat_id},
-        'chat_id': {'$ne': chat_id},
+        'chat_id': {'$nin': [chat_id, *exclude]},
         'block': {'$ne': 1},
         'active': {'$ne': 0}
     }
@@ -194,27 +346,31 @@ async def get_default_form(chat_id):
         {'$sample': {'size': 1}}
     ]
     
-    async with db_operation():
+    async with db_operation("get_default_form"):
         result = [doc async for doc in posts.aggregate(pipeline)]
         return False if not result else result
 
 
 async def update_by(chat_id, id, mark, comm):
     """Add a rating to a user profile"""
-    async with db_operation():
-        await posts.update_one(
-            {'chat_id': chat_id}, 
-            {'$push': {'by': {'id': id, 'mark': mark, 'comment': comm}}}, 
-            upsert=True
-        )
+    update = {
+        '$push': {'by': {'id': id, 'mark': mark, 'comment': comm}},
+        '$inc': {f'histogram.{int(mark) - 1}': 1},
+    }
+    if comm:
+        # Only a comment needs moderation
+        update['$set'] = {'updated': datetime.utcnow()}
+    async with db_operation("update_by"):
+        await posts.update_one({'chat_id': chat_id}, update, upsert=True)
         # Invalidate cache for this chat_id
         if chat_id in _document_cache:
             del _document_cache[chat_id]
+    await record_stats(None, 'rated')
 
 
 async def update_answer(chat_id, id):
     """Add an answer record to a user profile"""
-    async with db_operation():
+    async with db_operation("update_answer"):
         await posts.update_one(
             {'chat_id': chat_id}, 
             {'$push': {'answer': {'id': id}}}, 
@@ -227,7 +383,7 @@ async def update_answer(chat_id, id):
 
 async def get_likers(chat_id):
     """Get list of users who rated a specific user"""
-    async with db_operation():
+    async with db_operation("get_likers"):
         return [doc async for doc in posts.find({'chat_id': chat_id}, {'by': 1})]
 
 
@@ -246,15 +402,17 @@ async def check_counts():
     if cached_result:
         return cached_result
         
-    async with db_operation():
-        pipeline = [
-            {'$group': {'_id': None, 'total': {'$sum': '$count'}}}
-        ]
-        result = await posts.aggregate(pipeline).to_list(length=1)
-        total = result[0]['total'] if result else 0
-        
-        await _add_to_bulk_cache(cache_key, total)
-        return total
+    try:
+        async with db_operation("check_counts", background=True):
+            pipeline = [
+                {'$group': {'_id': None, 'total': {'$sum': '$count'}}}
+            ]
+            result = await posts.aggregate(pipeline).to_list(length=1)
+    except UNAVAILABLE as e:
+        return _serve_stale(_bulk_cache, cache_key, e)
+    total = result[0]['total'] if result else 0
+    await _add_to_bulk_cache(cache_key, total)
+    return total
 
 
 async def sender():
@@ -264,12 +422,115 @@ async def sender():
     if cached_result:
         return cached_result
         
-    async with db_operation():
+    async with db_operation("sender", background=True):
         result = await posts.distinct("chat_id")
         await _add_to_bulk_cache(cache_key, result)
         return result
 
 
+def on_profile_change(func):
+    """Register func(chat_id, profile) called after a profile's city, active, block, vip, count
+    or mark changes, profile holds the new values and is None when the profile is deleted"""
+    _profile_listeners.append(func)
+    return func
+
+
+def _notify_profile(chat_id, profile):
+    for func in _profile_listeners:
+        try:
+            func(chat_id, profile)
+        except Exception as e:
+            logger.error(f"Profile listener {func.__name__} failed: {str(e)}")
+
+
+def city_key(city):
+    """Normalize a city into a safe field name"""
+    key = (city or '').strip().lower().replace('.', '_').replace('$', '_')[:64]
+    return key or 'не важно'
+
+
+async def record_stats(city, event=None, event_count=1, **deltas):
+    """Increment the global counters and, for an event, today's counters"""
+    now = datetime.utcnow()
+    city = city_key(city) if city is not None else None
+    writes = []
+    if deltas:
+        inc = {f'total.{name}': value for name, value in deltas.items()}
+        if city:
+            inc.update({f'cities.{city}.{name}': value for name, value in deltas.items()})
+        writes.append(stats.update_one({'_id': 'global'}, {'$inc': inc}, upsert=True))
+    if event:
+        inc = {f'total.{event}': event_count}
+        if city:
+            inc[f'cities.{city}.{event}'] = event_count
+        writes.append(stats.update_one(
+            {'_id': f"day:{now:%Y-%m-%d}"},
+            {'$inc': inc, '$setOnInsert': {'expireAt': now + STATS_DAY_RETENTION}},
+            upsert=True
+        ))
+    try:
+        async with db_operation("record_stats"):
+            await asyncio.gather(*writes)
+    except Exception:
+        # Drift is corrected by reconcile_stats, never fail the user action
+        pass
+
+
+async def _record_field_change(old, field, value):
+    """Translate a profile field change into counter deltas"""
+    previous = old.get(field, 0)
+    if field not in STATS_FIELDS and field != 'count':
+        # City moves are picked up by reconcile_stats
+        return
+    if field == 'count':
+        delta = value - (previous or 0)
+        if delta:
+            await record_stats(old.get('city'), ratings=delta)
+        return
+    name, predicate = STATS_FIELDS[field]
+    delta = int(predicate(value)) - int(predicate(previous))
+    if delta:
+        await record_stats(old.get('city'), name if delta > 0 else None, **{name: delta})
+
+
+async def get_stats():
+    """Read the global counters, a single small document"""
+    async with db_operation("get_stats"):
+        doc = await stats.find_one({'_id': 'global'})
+    return doc or {}
+
+
+async def reconcile_stats():
+    """Recount the global counters from the profiles and fix any drift"""
+    pipeline = [{'$group': {
+        '_id': '$city',
+        'users': {'$sum': 1},
+        'ratings': {'$sum': '$count'},
+        'banned': {'$sum': {'$cond': [{'$eq': ['$block', 1]}, 1, 0]}},
+        'vip': {'$sum': {'$cond': [{'$eq': ['$vip', 1]}, 1, 0]}},
+        'inactive': {'$sum': {'$cond': [{'$eq': ['$active', 0]}, 1, 0]}},
+    }}]
+    names = ('users', 'ratings', 'banned', 'vip', 'inactive')
+    total = dict.fromkeys(names, 0)
+    cities = {}
+    async with db_operation("reconcile_stats", background=True):
+        async for row in posts.aggregate(pipeline, allowDiskUse=True):
+            city = cities.setdefault(city_key(row['_id']), dict.fromkeys(names, 0))
+            for name in names:
+                city[name] += row[name]
+                total[name] += row[name]
+        current = await stats.find_one_and_update(
+            {'_id': 'global'},
+            {'$set': {'total': total, 'cities': cities, 'reconciled': datetime.utcnow()}},
+            upsert=True
+        )
+    drift = {name: total[name] - (current or {}).get('total', {}).get(name, 0) for name in names}
+    drift = {name: value for name, value in drift.items() if value}
+    if drift:
+        logger.info(f"Stats drift corrected: {drift}")
+    return drift
+
+
 async def sort_collection_by_mark():
     """Get top 10 profiles by mark score"""
     cache_key = "top_by_mark"
@@ -277,21 +538,24 @@ async def sort_collection_by_mark():
     if cached_result:
         return cached_result
         
-    async with db_operation():
-        query = {
-            'count': {'$gte': 100},
-            'active': {'$gte': 1},
-            'block': {'$ne': 1}
-        }
-        pipeline = [
-            {'$match': query},
-            {'$sort': {'mark': -1}},
-            {'$limit': 10},
-            {'$project': {'chat_id': 1, 'name': 1, 'photo': 1, 'mark': 1, 'count': 1}}  # Project only needed fields
-        ]
-        result = [doc async for doc in posts.aggregate(pipeline)]
-        await _add_to_bulk_cache(cache_key, result)
-        return result
+    query = {
+        'count': {'$gte': 100},
+        'active': {'$gte': 1},
+        'block': {'$ne': 1}
+    }
+    try:
+        async with db_operation("sort_collection_by_mark"):
+            pipeline = [
+                {'$match': query},
+                {'$sort': {'mark': -1}},
+                {'$limit': 10},
+                {'$project': {'chat_id': 1, 'name': 1, 'photo': 1, 'mark': 1, 'count': 1}}  # Project only needed fields
+            ]
+            result = [doc async for doc in posts.aggregate(pipeline)]
+    except UNAVAILABLE as e:
+        return _serve_stale(_bulk_cache, cache_key, e)
+    await _add_to_bulk_cache(cache_key, result)
+    return result
 
 
 async def sort_collection_by_count():
@@ -301,77 +565,242 @@ async def sort_collection_by_count():
     if cached_result:
         return cached_result
         
-    async with db_operation():
-        query = {
-            'count': {'$gte': 100},
-            'active': {'$gte': 1},
-            'block': {'$ne': 1}
-        }
-        pipeline = [
-            {'$match': query},
-            {'$sort': {'count': -1}},
-            {'$limit': 10},
-            {'$project': {'chat_id': 1, 'name': 1, 'photo': 1, 'mark': 1, 'count': 1}}  # Project only needed fields
-        ]
-        result = [doc async for doc in posts.aggregate(pipeline)]
-        await _add_to_bulk_cache(cache_key, result)
-        return result
+    query = {
+        'count': {'$gte': 100},
+        'active': {'$gte': 1},
+        'block': {'$ne': 1}
+    }
+    try:
+        async with db_operation("sort_collection_by_count"):
+            pipeline = [
+                {'$match': query},
+                {'$sort': {'count': -1}},
+                {'$limit': 10},
+                {'$project': {'chat_id': 1, 'name': 1, 'photo': 1, 'mark': 1, 'count': 1}}  # Project only needed fields
+            ]
+            result = [doc async for doc in posts.aggregate(pipeline)]
+    except UNAVAILABLE as e:
+        return _serve_stale(_bulk_cache, cache_key, e)
+    await _add_to_bulk_cache(cache_key, result)
+    return result
 
 
 async def update_mark(chat_id):
     """Update user's mark based on ratings received (optimized)"""
-    async with db_operation():
+    async with db_operation("update_mark"):
         fb = await get_document(chat_id)
         if not fb:
             return 0.0
             
-        marks = [int(i.get('mark', 0)) for i in fb.get('by', [])]
-        likes = round(sum(marks) / len(marks), 2) if marks else 0.0
+        histogram = fb.get('histogram')
+        if isinstance(histogram, list):
+            likes = functions.mark_stats(histogram)['mean']
+        else:
+            # Not backfilled yet, see migrations.mark_histogram
+            marks = [int(i.get('mark', 0)) for i in fb.get('by', [])]
+            likes = round(sum(marks) / len(marks), 2) if marks else 0.0
         await change_field(chat_id, 'mark', likes)
         return likes
 
 
-async def add_new_field():
-    """Add a new field to all documents"""
-    async with db_operation():
-        await posts.update_many({}, {"$set": {"city": 'не важно'}}, upsert=False)
+async def apply_ratings(batch_id, ratings):
+    """Apply (key, rater_id, chat_id, mark, comment) ratings with one unordered bulk_write.
+    Ratings are skipped when their key is already in the rated profile and rater credits when
+    the rater was credited for batch_id, so applying a batch again changes nothing. Raters earn
+    a view per rating of an existing profile, ratings of missing ones are dropped"""
+    now = datetime.utcnow()
+    ids = list({rating[1] for rating in ratings} | {rating[2] for rating in ratings if rating[2] is not None})
+    projection = dict(PROFILE_STATE, chat_id=1)
+    async with db_operation("apply_ratings"):
+        before = {doc['chat_id']: doc async for doc in posts.find({'chat_id': {'$in': ids}}, projection)}
+        credits = {}
+        ops = []
+        for key, rater_id, chat_id, mark, comment in ratings:
+            if chat_id not in before:
+                # Deleted profile or chat_id lost with the FSM data, the rater earns nothing for it
+                logger.warning(f"Rating {key} of missing profile {chat_id} by {rater_id} skipped")
+                continue
+            rating = {'$push': {'by': {'id': rater_id, 'mark': mark, 'comment': comment, 'key': key}}}
+            if comment:
+                # Only a comment needs moderation
+                rating['$set'] = {'updated': now}
+            inc = {'count': 1, f'histogram.{int(mark) - 1}': 1}
+            # The rated profile spends a view if it has one left, exactly one of the two matches
+            ops.append(UpdateOne(
+                {'chat_id': chat_id, 'by.key': {'$ne': key}, 'active': {'$gt': 0}},
+                dict(rating, **{'$inc': dict(inc, active=-1)}),
+            ))
+            ops.append(UpdateOne(
+                {'chat_id': chat_id, 'by.key': {'$ne': key}, 'active': {'$not': {'$gt': 0}}},
+                dict(rating, **{'$inc': inc}),
+            ))
+            # Counted from the profiles that exist, so a retried batch credits the same views
+            credits[rater_id] = credits.get(rater_id, 0) + 1
+        for rater_id, count in credits.items():
+            ops.append(UpdateOne(
+                {'chat_id': rater_id, 'credited': {'$ne': batch_id}},
+                {'$inc': {'active': count}, '$set': {'credited': batch_id}},
+            ))
+        if not ops:
+            return
+        await posts.bulk_write(ops, ordered=False)
+        after = {doc['chat_id']: doc async for doc in posts.find({'chat_id': {'$in': ids}}, dict(projection, histogram=1))}
+        # Same as update_mark, for every rated profile at once
+        histograms = {chat_id: doc.pop('histogram', None) for chat_id, doc in after.items()}
+        # Not backfilled yet, see migrations.mark_histogram
+        unmigrated = [chat_id for chat_id, histogram in histograms.items() if not isinstance(histogram, list)]
+        by = {}
+        if unmigrated:
+            cursor = posts.find({'chat_id': {'$in': unmigrated}}, {'chat_id': 1, 'by.mark': 1})
+            by = {doc['chat_id']: doc.get('by', []) async for doc in cursor}
+        marks = []
+        for chat_id, doc in after.items():
+            histogram = histograms[chat_id]
+            if isinstance(histogram, list):
+                mark = functions.mark_stats(histogram)['mean']
+            else:
+                rated = [int(i.get('mark', 0)) for i in by.get(chat_id, [])]
+                mark = round(sum(rated) / len(rated), 2) if rated else 0.0
+            if mark != doc.get('mark'):
+                doc['mark'] = mark
+                marks.append(UpdateOne({'chat_id': chat_id}, {'$set': {'mark': mark}}))
+        if marks:
+            await posts.bulk_write(marks, ordered=False)
+    for chat_id in ids:
+        _document_cache.pop(chat_id, None)
+    # Counter deltas summed per city, like _record_field_change does for one profile
+    name, predicate = STATS_FIELDS['active']
+    cities = {}
+    for chat_id, doc in after.items():
+        old = before.get(chat_id)
+        if old is None:
+            continue
+        if any(old.get(field) != doc.get(field) for field in PROFILE_STATE):
+            _notify_profile(chat_id, doc)
+        counters = cities.setdefault(city_key(old.get('city')), {'ratings': 0, name: 0, 'events': 0})
+        counters['ratings'] += (doc.get('count') or 0) - (old.get('count') or 0)
+        delta = int(predicate(doc.get('active', 0))) - int(predicate(old.get('active', 0)))
+        counters[name] += delta
+        counters['events'] += delta > 0
+    rated = sum(counters['ratings'] for counters in cities.values())
+    for city, counters in cities.items():
+        events = counters.pop('events')
+        deltas = {key: value for key, value in counters.items() if value}
+        if deltas:
+            await record_stats(city, name if events else None, event_count=events, **deltas)
+    if rated > 0:
+        await record_stats(None, 'rated', event_count=rated)
+
+
+async def add_bill(bill_id, chat_id, link, lifetime, first_check, bot_name=None):
+    """Persist a pending bill so it is reconciled even if the user never comes back,
+    bot_name is the hosted bot the user paid in"""
+    now = datetime.utcnow()
+    async with db_operation("add_bill"):
+        await bills.update_one(
+            {'_id': bill_id},
+            {'$setOnInsert': {
+                'chat_id': chat_id,
+                'bot': bot_name,
+                'link': link,
+                'status': 'WAITING',
+                'attempts': 0,
+                'created': now,
+                'next_check': now + timedelta(seconds=first_check),
+                'expireAt': now + timedelta(seconds=lifetime)
+            }},
+            upsert=True
+        )
 
 
-async def delete_field():
-    """Remove a field from all documents"""
-    async with db_operation():
-        await posts.update_many({}, {"$unset": {"city": 1}}, upsert=False)
+async def get_bill(bill_id):
+    """Get a persisted bill by id"""
+    async with db_operation("get_bill"):
+        return await bills.find_one({'_id': bill_id})
 
 
-async def toDecimal():
-    """Convert mark field to float"""
-    async with db_operation():
-        async for doc in posts.find({}, {"mark": 1}):
-            await posts.update_one({"_id": doc["_id"]}, {"$set": {"mark": float(doc["mark"])}})
+async def get_due_bills(limit):
+    """Get pending bills whose next check time has come"""
+    async with db_operation("get_due_bills"):
+        cursor = bills.find(
+            {'status': 'WAITING', 'next_check': {'$lte': datetime.utcnow()}},
+            {'chat_id': 1, 'bot': 1, 'attempts': 1}
+        ).sort('next_check', 1).limit(limit)
+        return [doc async for doc in cursor]
+
+
+async def reschedule_bill(bill_id, attempts, delay):
+    """Postpone the next check of a pending bill"""
+    async with db_operation("reschedule_bill"):
+        await bills.update_one(
+            {'_id': bill_id, 'status': 'WAITING'},
+            {'$set': {'attempts': attempts, 'next_check': datetime.utcnow() + timedelta(seconds=delay)}}
+        )
+
+
+async def close_bill(bill_id, status):
+    """Move a pending bill to its final status, returns False if it was already closed"""
+    async with db_operation("close_bill"):
+        result = await bills.update_one(
+            {'_id': bill_id, 'status': 'WAITING'},
+            {'$set': {'status': status}}
+        )
+        return result.modified_count == 1
 
 
 async def delete_form(chat_id):
     """Delete a user profile"""
-    async with db_operation():
+    async with db_operation("delete_form"):
         await posts.delete_one({'chat_id': chat_id})
         # Remove from cache if exists
         if chat_id in _document_cache:
             del _document_cache[chat_id]
+    _notify_profile(chat_id, None)
 
 
 async def exists():
     """Get all documents with active field"""
-    async with db_operation():
+    async with db_operation("exists", background=True):
         return [doc async for doc in posts.find({"active": {"$exists": True}}, {"chat_id": 1, "active": 1})]
 
 
-async def check_users_for_bugs():
-    """Check for invalid character bugs in user names"""
-    async with db_operation():
-        async for doc in posts.find({}, {"chat_id": 1, "name": 1}):
-            check = await functions.simbols_exists(doc['name'])
-            if check is True and not doc['name'].startswith('@'):
-                logger.warning(f"User with invalid name: {doc['chat_id']}, {doc['name']}")
+async def prune_caches():
+    """Drop cache entries too old even for degraded mode"""
+    now = time.time()
+    for cache in _document_cache.instances() + _bulk_cache.instances():
+        for key in [key for key, (_, timestamp) in cache.items() if now - timestamp >= CACHE_STALE_TTL]:
+            del cache[key]
+
+
+async def save_hot_ids(limit=5000):
+    """Store the most recently used cached profiles for the next warm-up"""
+    hot = sorted(_document_cache.items(), key=lambda item: item[1][1], reverse=True)[:limit]
+    async with db_operation("save_hot_ids"):
+        await meta.update_one(
+            {'_id': 'hot_ids'},
+            {'$set': {'ids': [chat_id for chat_id, _ in hot]}},
+            upsert=True
+        )
+
+
+async def _preload_profiles(query, limit):
+    """Load matching profiles straight into the document cache"""
+    async with db_operation("preload_profiles", background=True):
+        async for doc in posts.find(query).limit(limit):
+            await _add_to_cache(doc['chat_id'], doc)
+
+
+async def warm_up(limit=5000):
+    """Preload leaderboards, banned users and last hot profiles concurrently"""
+    async with db_operation("warm_up"):
+        hot = await meta.find_one({'_id': 'hot_ids'})
+    hot_ids = hot.get('ids', []) if hot else []
+    await asyncio.gather(
+        sort_collection_by_mark(),
+        sort_collection_by_count(),
+        _preload_profiles({'block': 1}, limit),
+        _preload_profiles({'chat_id': {'$in': hot_ids}}, limit),
+    )
 
 
 # Initialize database indexes when module is loaded
@@ -0,0 +1,155 @@
+import asyncio
+import logging
+from collections import deque
+from datetime import datetime, timedelta
+
+from pymongo.errors import CollectionInvalid, OperationFailure
+
+import database as db
+from config import EVENTS_RETENTION_DAYS, EVENTS_BATCH, EVENTS_FLUSH_INTERVAL, EVENTS_MAX_BUFFER
+
+
+# Configure logger
+logger = logging.getLogger(__name__)
+
+# Event kinds written by the handlers
+RATING = 'rating'
+SKIP = 'skip'
+COMPLAINT = 'complaint'
+ANSWER = 'answer'
+
+
+async def ensure_collection(retention_days=EVENTS_RETENTION_DAYS):
+    """Create the events time-series collection, or a TTL-indexed one on old servers"""
+    retention = retention_days * 86400
+    try:
+        await db.db.create_collection(
+            db.events.name,
+            timeseries={'timeField': 'ts', 'metaField': 'meta', 'granularity': 'seconds'},
+            expireAfterSeconds=retention,
+        )
+        logger.info("Created events time-series collection")
+    except CollectionInvalid:
+        # Already exists, keep the retention in sync with the config
+        try:
+            await db.db.command('collMod', db.events.name, expireAfterSeconds=retention)
+        except OperationFailure:
+            pass
+    except OperationFailure:
+        # Time-series collections need MongoDB 5.0
+        await db.events.create_index('ts', expireAfterSeconds=retention)
+        logger.info("Time-series collections unsupported, using a TTL index for events")
+    await db.events.create_index([('meta.kind', 1), ('ts', -1)])
+    try:
+        await db.events.create_index([('target', 1), ('ts', -1)])
+        await db.events.create_index([('actor', 1), ('ts', -1)])
+    except OperationFailure as e:
+        logger.warning(f"Events measurement indexes unavailable: {str(e)}")
+
+
+class EventLog:
+    """Buffers events in memory and writes them with insert_many in the background"""
+
+    def __init__(self, batch_size=EVENTS_BATCH, flush_interval=EVENTS_FLUSH_INTERVAL, max_buffer=EVENTS_MAX_BUFFER):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_buffer = max_buffer
+        self.dropped = 0
+        self._buffer = deque(maxlen=max_buffer)
+        self._flushing = None
+
+    def log(self, kind, actor, target=None, **fields):
+        """Append an event, never awaits so handlers pay nothing for it"""
+        if len(self._buffer) == self.max_buffer:
+            # Mongo is down or slow, the deque sheds the oldest event instead of growing forever
+            self.dropped += 1
+        self._buffer.append(dict(fields, ts=datetime.utcnow(), meta={'kind': kind}, actor=actor, target=target))
+        if len(self._buffer) >= self.batch_size:
+            self._schedule()
+
+    def _schedule(self):
+        """Start a background flush unless one is already running"""
+        if self._flushing is None:
+            self._flushing = asyncio.ensure_future(self.flush())
+        return self._flushing
+
+    async def flush(self):
+        """Write the buffered events in batches"""
+        try:
+            while self._buffer:
+                batch = [self._buffer.popleft() for _ in range(min(self.batch_size, len(self._buffer)))]
+                try:
+                    async with db.db_operation("log_events", background=True):
+                        await db.events.insert_many(batch, ordered=False)
+                except Exception:
+                    # Put the batch back and retry on the next tick
+                    self._buffer.extendleft(reversed(batch[:self.max_buffer - len(self._buffer)]))
+                    break
+        finally:
+            self._flushing = None
+
+    async def run(self):
+        """Flush periodically until cancelled"""
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            if self._buffer:
+                await self._schedule()
+            if self.dropped:
+                logger.warning(f"Dropped {self.dropped} events, buffer full")
+                self.dropped = 0
+
+    async def close(self):
+        """Write whatever is left in the buffer"""
+        if self._flushing is not None:
+            await self._flushing
+        await self._schedule()
+
+
+def _window(window, kind=None, **match):
+    query = {'ts': {'$gte': datetime.utcnow() - window}}
+    if kind:
+        query['meta.kind'] = kind
+    query.update({key: value for key, value in match.items() if value is not None})
+    return query
+
+
+async def count(kind, window=timedelta(hours=1), actor=None, target=None):
+    """Number of events of a kind in the window, e.g. ratings in the last hour"""
+    async with db.db_operation("count_events", background=True):
+        return await db.events.count_documents(_window(window, kind, actor=actor, target=target))
+
+
+async def leaderboard(window=timedelta(days=7), limit=10, min_ratings=3):
+    """Profiles with the best average mark received in the window"""
+    pipeline = [
+        {'$match': _window(window, RATING)},
+        {'$group': {'_id': '$target', 'mark': {'$avg': '$mark'}, 'count': {'$sum': 1}}},
+        {'$match': {'count': {'$gte': min_ratings}}},
+        {'$sort': {'mark': -1, 'count': -1}},
+        {'$limit': limit},
+    ]
+    async with db.db_operation("events_leaderboard", background=True):
+        return [doc async for doc in db.events.aggregate(pipeline)]
+
+
+async def top_actors(kind, window=timedelta(hours=1), limit=10):
+    """Most active users for a kind of event, for abuse detection"""
+    pipeline = [
+        {'$match': _window(window, kind)},
+        {'$group': {'_id': '$actor', 'count': {'$sum': 1}}},
+        {'$sort': {'count': -1}},
+        {'$limit': limit},
+    ]
+    async with db.db_operation("events_top_actors", background=True):
+        return [doc async for doc in db.events.aggregate(pipeline)]
+
+
+async def histogram(kind, window=timedelta(days=1), unit='hour'):
+    """Event counts per time bucket, oldest first"""
+    pipeline = [
+        {'$match': _window(window, kind)},
+        {'$group': {'_id': {'$dateTrunc': {'date': '$ts', 'unit': unit}}, 'count': {'$sum': 1}}},
+        {'$sort': {'_id': 1}},
+    ]
+    async with db.db_operation("events_histogram", background=True):
+        return [(doc['_id'], doc['count']) async for doc in db.events.aggregate(pipeline)]
@@ -0,0 +1,227 @@
+import asyncio
+import copy
+import dataclasses
+import logging
+import os
+from collections import namedtuple
+from functools import partial
+
+from aiogram import Bot, Dispatcher
+from aiogram.contrib.fsm_storage.memory import MemoryStorage
+from aiogram.dispatcher.handler import Handler
+
+import metrics
+from config import API_TOKEN, BOTS
+
+
+# Configure logger
+logger = logging.getLogger(__name__)
+
+DEFAULT_DATABASE = os.environ.get("MONGODB_DATABASE", "baraboba")
+DEFAULT_COLLECTION = "posts"
+
+
+class BotConfig(namedtuple("BotConfig", "name token database collection")):
+    """One hosted bot, name is the bot id from the token"""
+
+    @property
+    def namespace(self):
+        """Bots with the same namespace share profiles and everything derived from them"""
+        return self.database, self.collection
+
+    def collection_name(self, name):
+        """Service collection of this bot, prefixed when the bot has its own profile collection"""
+        return name if self.collection == DEFAULT_COLLECTION else f"{self.collection}.{name}"
+
+
+def parse_bot(entry):
+    """Parse token[@database[/collection]], the database and collection default to the main bot's"""
+    token, _, location = entry.partition('@')
+    database, _, collection = location.partition('/')
+    return BotConfig(token.split(':')[0], token, database or DEFAULT_DATABASE, collection or DEFAULT_COLLECTION)
+
+
+MAIN = parse_bot(API_TOKEN)
+CONFIGS = [MAIN] + [parse_bot(entry) for entry in BOTS]
+
+# Every hosted Dispatcher, the main one first
+dispatchers = []
+_polling = []
+
+
+def current():
+    """Config of the bot handling the current update, the main bot outside of one"""
+    bot = Bot.get_current(no_error=True)
+    return getattr(bot, 'config', None) or MAIN
+
+
+class BotLocal:
+    """Proxy to a per-namespace instance made by factory(config) on first use, so module
+    level collections, caches and indexes follow the bot handling the current update. Its own
+    methods have names the proxied objects don't use, e.g. get() of a dict reaches the dict"""
+
+    def __init__(self, factory):
+        self._factory = factory
+        self._instances = {}
+
+    def instance(self):
+        """Instance of the current namespace"""
+        config = current()
+        instance = self._instances.get(config.namespace)
+        if instance is None:
+            instance = self._instances[config.namespace] = self._factory(config)
+        return instance
+
+    def instances(self):
+        """Instances created so far, one per namespace"""
+        return list(self._instances.values())
+
+    def __getattr__(self, name):
+        return getattr(self.instance(), name)
+
+    def __getitem__(self, key):
+        return self.instance()[key]
+
+    def __setitem__(self, key, value):
+        self.instance()[key] = value
+
+    def __delitem__(self, key):
+        del self.instance()[key]
+
+    def __contains__(self, key):
+        return key in self.instance()
+
+    def __iter__(self):
+        return iter(self.instance())
+
+    def __len__(self):
+        return len(self.instance())
+
+
+class HostedBot(metrics.InstrumentedBot):
+    """Bot of one hosted token, Bot API requests of all hosted bots share one HTTP session"""
+
+    _shared_session = None
+
+    def __init__(self, config, **kwargs):
+        super().__init__(token=config.token, **kwargs)
+        self.config = config
+
+    async def get_new_session(self):
+        if HostedBot._shared_session is None or HostedBot._shared_session.closed:
+            HostedBot._shared_session = await super().get_new_session()
+        return HostedBot._shared_session
+
+
+class CurrentBot:
+    """Stands in for the bot that received the current update, default outside of one"""
+
+    def __init__(self, default):
+        self._default = default
+
+    def __getattr__(self, name):
+        return getattr(Bot.get_current(no_error=True) or self._default, name)
+
+
+def clone_dispatcher(template, bot):
+    """Dispatcher for another token with the template's handlers and middlewares and its own FSM storage"""
+    dispatcher = Dispatcher(bot, storage=MemoryStorage())
+    for name, handler in vars(template).items():
+        # updates_handler holds the template's own process_update
+        if not isinstance(handler, Handler) or name == 'updates_handler':
+            continue
+        target = getattr(dispatcher, name)
+        for obj in handler.handlers:
+            filters = [_rebind(filter_obj, dispatcher) for filter_obj in obj.filters or ()]
+            target.handlers.append(Handler.HandlerObj(handler=obj.handler, spec=obj.spec, filters=filters))
+    # Middleware instances are shared, so admission and throttling limits span all bots
+    dispatcher.middleware.applications.extend(template.middleware.applications)
+    return register(dispatcher)
+
+
+def register(dispatcher):
+    """Add a dispatcher to the hosted ones"""
+    dispatchers.append(dispatcher)
+    return dispatcher
+
+
+def _rebind(filter_obj, dispatcher):
+    """State filters read the FSM storage of the dispatcher they were made for"""
+    if not hasattr(filter_obj.filter, 'dispatcher'):
+        return filter_obj
+    bound = copy.copy(filter_obj.filter)
+    bound.dispatcher = dispatcher
+    return dataclasses.replace(filter_obj, filter=bound)
+
+
+def _namespaces():
+    """The first dispatcher of every namespace"""
+    found = {}
+    for dispatcher in dispatchers:
+        found.setdefault(dispatcher.bot.config.namespace, dispatcher)
+    return list(found.values())
+
+
+async def _run_as(dispatcher, func, *args):
+    Bot.set_current(dispatcher.bot)
+    Dispatcher.set_current(dispatcher)
+    return await func(*args)
+
+
+async def run_as(name, func, *args):
+    """Await func(*args) in the context of the hosted bot called name, in the current context
+    when no such bot is hosted"""
+    for dispatcher in dispatchers:
+        if dispatcher.bot.config.name != name:
+            continue
+        if dispatcher.bot is Bot.get_current(no_error=True):
+            return await func(*args)
+        return await asyncio.create_task(_run_as(dispatcher, func, *args))
+    if name is not None:
+        logger.warning(f"Bot {name} is not hosted, running {getattr(func, '__name__', func)} as {current().name}")
+    return await func(*args)
+
+
+def spawn_each(func, *args):
+    """Start func(*args) as a task per namespace, e.g. a worker loop"""
+    return [asyncio.create_task(_run_as(dispatcher, func, *args)) for dispatcher in _namespaces()]
+
+
+async def each_namespace(func, *args):
+    """Await func(*args) once per namespace in the context of its first bot, the first error
+    is raised after every namespace had its turn"""
+    errors = []
+    for dispatcher in _namespaces():
+        try:
+            # A task of its own keeps the context switch out of the caller
+            await asyncio.create_task(_run_as(dispatcher, func, *args))
+        except Exception as e:
+            logger.error(f"{getattr(func, '__name__', func)} failed for bot {dispatcher.bot.config.name}: {str(e)}")
+            errors.append(e)
+    if errors:
+        raise errors[0]
+
+
+def per_namespace(func):
+    """Scheduler job running func once per namespace"""
+    return partial(each_namespace, func)
+
+
+async def start_polling(**kwargs):
+    """Start polling of the bots after the main one, the executor polls the main bot"""
+    for dispatcher in dispatchers[1:]:
+        await dispatcher.skip_updates()
+        _polling.append(asyncio.create_task(dispatcher.start_polling(**kwargs)))
+        logger.info(f"Polling bot {dispatcher.bot.config.name}")
+
+
+async def stop_polling():
+    """Stop the bots after the main one, the executor stops the main bot and closes the shared session"""
+    # A pending getUpdates would hold the stop for the whole polling timeout
+    for task in _polling:
+        task.cancel()
+    await asyncio.gather(*_polling, return_exceptions=True)
+    _polling.clear()
+    for dispatcher in dispatchers[1:]:
+        await dispatcher.storage.close()
+        await dispatcher.storage.wait_closed()
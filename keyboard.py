@@ -148,7 +148,7 @@ async def report_inline(chat_id, fromwho):
 
 senderkb = types.InlineKeyboardMarkup(row_width=1)
 senderkb.add(
-    types.InlineKeyboardButton(text='🆘По всем вопросам', url=f'tg://user?id={admin[0]}'),
+    types.InlineKeyboardButton(text='🆘По всем вопросам', url=f'tg://user?id={admin[0] if admin else 0}'),
 )
 
 
@@ -0,0 +1,330 @@
+#!/usr/bin/env python3
+"""
+Load test for Kaoka Telegram Bot
+Drives thousands of virtual users through the real handlers against a fake
+Bot API server and a local MongoDB seeded with a generated dataset.
+
+Example:
+    python loadtest.py --users 2000 --concurrency 200 --profiles 50000
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import sys
+import time
+from collections import Counter, defaultdict
+from contextlib import redirect_stdout
+
+from aiohttp import web
+
+
+# Id ranges for seeded profiles and virtual users, far from real Telegram ids
+SEED_OFFSET = 10 ** 12
+USER_OFFSET = 2 * 10 ** 12
+
+CITIES = ['Москва', 'Санкт-Петербург', 'Казань', 'Новосибирск', 'Екатеринбург', 'не важно']
+MARKS = [str(i) for i in range(1, 11)]
+BOT_USER = {'id': 1, 'is_bot': True, 'first_name': 'Kaoka', 'username': 'kaokabot'}
+
+
+def percentile(values, q):
+    """Nearest-rank percentile of a list of numbers"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(q / 100 * len(ordered) + 0.5)) - 1))
+    return ordered[index]
+
+
+class FakeBotAPI:
+    """Minimal Bot API server that records calls and injects latency and 429 errors"""
+
+    def __init__(self, latency_min=0.0, latency_max=0.0, rate_limit_ratio=0.0):
+        self.latency_min = latency_min
+        self.latency_max = latency_max
+        self.rate_limit_ratio = rate_limit_ratio
+        self.calls = Counter()
+        self.rate_limited = Counter()
+        self._message_id = 0
+
+    async def handle(self, request):
+        method = request.match_info['method']
+        self.calls[method] += 1
+        if self.latency_max > 0:
+            await asyncio.sleep(random.uniform(self.latency_min, self.latency_max))
+        if self.rate_limit_ratio and random.random() < self.rate_limit_ratio:
+            self.rate_limited[method] += 1
+            return web.json_response({
+                'ok': False,
+                'error_code': 429,
+                'description': 'Too Many Requests: retry after 1',
+                'parameters': {'retry_after': 1}
+            }, status=429)
+        data = await request.post()
+        return web.json_response({'ok': True, 'result': self._result(method.lower(), data)})
+
+    def _result(self, method, data):
+        if method == 'getme':
+            return BOT_USER
+        if method == 'getfile':
+            # Seeded file ids look like "<kind>_<n>", the bot relies on the folder name
+            file_id = data.get('file_id', '')
+            folder = {'video': 'videos', 'voice': 'voice'}.get(file_id.split('_')[0], 'photos')
+            return {'file_id': file_id, 'file_unique_id': file_id, 'file_size': 1, 'file_path': f'{folder}/{file_id}'}
+        if method.startswith('send') or method.startswith('edit'):
+            self._message_id += 1
+            return {
+                'message_id': self._message_id,
+                'date': int(time.time()),
+                'chat': {'id': int(data.get('chat_id') or 0), 'type': 'private'},
+                'from': BOT_USER,
+                'text': ''
+            }
+        return True
+
+    async def start(self, port):
+        app = web.Application()
+        app.router.add_post('/bot{token}/{method}', self.handle)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        await web.TCPSite(runner, '127.0.0.1', port).start()
+        return runner
+
+
+async def seed(posts, profiles, max_by):
+    """Replace the collection with generated profiles and realistic `by` arrays"""
+    await posts.delete_many({})
+    batch = []
+    for i in range(profiles):
+        by = [
+            {'id': SEED_OFFSET + random.randrange(profiles), 'mark': random.randint(1, 10), 'comment': None}
+            for _ in range(random.randint(0, max_by))
+        ]
+        marks = [item['mark'] for item in by]
+        kind = random.choices(['photo', 'video', 'voice'], [8, 1, 1])[0]
+        batch.append({
+            'chat_id': SEED_OFFSET + i,
+            'name': f'user{i}',
+            'photo': f'{kind}_{i}',
+            'count': len(by),
+            'by': by,
+            'mark': round(sum(marks) / len(marks), 2) if marks else 0.0,
+            'block': 1 if random.random() < 0.01 else 0,
+            'active': random.randint(0, 20),
+            'answer': [],
+            'vip': 1 if random.random() < 0.05 else 0,
+            'city': random.choice(CITIES)
+        })
+        if len(batch) >= 1000:
+            await posts.insert_many(batch, ordered=False)
+            batch = []
+    if batch:
+        await posts.insert_many(batch, ordered=False)
+
+
+class LoadTest:
+    """Feeds virtual user updates into the dispatcher and collects latencies"""
+
+    def __init__(self, dp, args):
+        self.dp = dp
+        self.args = args
+        self.latencies = defaultdict(list)
+        self.errors = Counter()
+        self._update_id = 0
+
+    def _next_id(self):
+        self._update_id += 1
+        return self._update_id
+
+    def _user(self, chat_id):
+        return {'id': chat_id, 'is_bot': False, 'first_name': 'Load', 'username': f'load{chat_id}'}
+
+    def message(self, chat_id, text=None, photo=None):
+        message = {
+            'message_id': self._next_id(),
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'private'},
+            'from': self._user(chat_id)
+        }
+        if text is not None:
+            message['text'] = text
+        if photo is not None:
+            message['photo'] = [{'file_id': photo, 'file_unique_id': photo, 'width': 320, 'height': 320}]
+        return {'update_id': self._next_id(), 'message': message}
+
+    def callback(self, chat_id, data):
+        return {'update_id': self._next_id(), 'callback_query': {
+            'id': str(self._next_id()),
+            'from': self._user(chat_id),
+            'chat_instance': str(chat_id),
+            'data': data,
+            'message': {
+                'message_id': self._next_id(),
+                'date': int(time.time()),
+                'chat': {'id': chat_id, 'type': 'private'},
+                'text': 'Выберите, какой топ хотите просмотреть'
+            }
+        }}
+
+    def inline(self, chat_id, query):
+        return {'update_id': self._next_id(), 'inline_query': {
+            'id': str(self._next_id()),
+            'from': self._user(chat_id),
+            'query': query,
+            'offset': ''
+        }}
+
+    async def send(self, step, payload):
+        from aiogram import types
+        update = types.Update(**payload)
+        start = time.perf_counter()
+        try:
+            # Same entry point as polling, every update runs in its own task context
+            await self.dp.process_updates([update])
+        except Exception as e:
+            self.errors[type(e).__name__] += 1
+        self.latencies[step].append(time.perf_counter() - start)
+
+    async def virtual_user(self, chat_id):
+        """Registration, rating, who liked me, top and inline search"""
+        think = self.args.think_time
+        await self.send('start', self.message(chat_id, '/start'))
+        await self.send('register_name', self.message(chat_id, f'load{chat_id % 10 ** 6}'))
+        await self.send('register_city', self.message(chat_id, random.choice(CITIES)))
+        await self.send('register_photo', self.message(chat_id, photo=f'photo_u{chat_id}'))
+        await self.send('rate_open', self.message(chat_id, '❤️Оценить'))
+        for _ in range(self.args.ratings):
+            await asyncio.sleep(think)
+            await self.send('rate', self.message(chat_id, random.choice(MARKS)))
+        await self.send('main_menu', self.message(chat_id, 'Главное меню'))
+        await self.send('who_liked', self.message(chat_id, '💕Кто меня оценил?'))
+        await self.send('top', self.message(chat_id, '🔝Топ'))
+        await self.send('top_marks', self.callback(chat_id, 'marks'))
+        await self.send('inline_profile', self.inline(chat_id, ''))
+        await self.send('inline_search', self.inline(chat_id, 'user1'))
+
+    async def run(self):
+        semaphore = asyncio.Semaphore(self.args.concurrency)
+
+        async def limited(chat_id):
+            async with semaphore:
+                await self.virtual_user(chat_id)
+
+        start = time.perf_counter()
+        await asyncio.gather(*(limited(USER_OFFSET + i) for i in range(self.args.users)))
+        return time.perf_counter() - start
+
+
+def disable_throttling(dp):
+    """Remove the throttling middleware so synthetic traffic is not dropped"""
+    from throttling import ThrottlingMiddleware
+    dp.middleware.applications = [m for m in dp.middleware.applications if not isinstance(m, ThrottlingMiddleware)]
+
+
+def mongo_operations(metrics):
+    """Total number of observed database.py operations"""
+    return sum(state[-2] for state in metrics.DB_LATENCY._values.values())
+
+
+async def main(args):
+    fake = FakeBotAPI(args.latency_min / 1000, args.latency_max / 1000, args.rate_limit_ratio)
+    runner = await fake.start(args.api_port)
+
+    # The bot modules read their configuration at import time
+    os.environ['TELEGRAM_API_SERVER'] = f'http://127.0.0.1:{args.api_port}'
+    os.environ['METRICS_PORT'] = '0'
+    import bot
+    import database as db
+    import metrics
+    from aiogram import Bot, Dispatcher
+    logging.getLogger().setLevel(logging.WARNING)
+
+    if args.no_throttle:
+        disable_throttling(bot.dp)
+    Bot.set_current(bot.main_bot)
+    Dispatcher.set_current(bot.dp)
+
+    if not args.skip_seed:
+        print(f"Seeding {args.profiles} profiles into {db.db.name}.posts...")
+        seed_start = time.perf_counter()
+        await seed(db.posts, args.profiles, args.max_by)
+        print(f"Seeded in {time.perf_counter() - seed_start:.1f}s")
+    await db.init_db()
+    await db.posts.delete_many({'chat_id': {'$gte': USER_OFFSET}})
+
+    test = LoadTest(bot.dp, args)
+    ops_before = mongo_operations(metrics)
+    # Handlers still print progress lines, keep them out of the report
+    with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+        elapsed = await test.run()
+    ops = mongo_operations(metrics) - ops_before
+
+    updates = sum(len(v) for v in test.latencies.values())
+    everything = [x for v in test.latencies.values() for x in v]
+    report = {
+        'users': args.users,
+        'updates': updates,
+        'seconds': round(elapsed, 3),
+        'updates_per_second': round(updates / elapsed, 1) if elapsed else 0,
+        'p50_ms': round(percentile(everything, 50) * 1000, 2),
+        'p95_ms': round(percentile(everything, 95) * 1000, 2),
+        'p99_ms': round(percentile(everything, 99) * 1000, 2),
+        'mongo_ops_per_update': round(ops / updates, 2) if updates else 0,
+        'api_calls_per_update': round(sum(fake.calls.values()) / updates, 2) if updates else 0,
+        'api_calls': dict(fake.calls),
+        'api_rate_limited': dict(fake.rate_limited),
+        'errors': dict(test.errors),
+        'steps': {
+            step: {
+                'count': len(values),
+                'p50_ms': round(percentile(values, 50) * 1000, 2),
+                'p95_ms': round(percentile(values, 95) * 1000, 2),
+                'p99_ms': round(percentile(values, 99) * 1000, 2)
+            }
+            for step, values in test.latencies.items()
+        }
+    }
+
+    print(f"\n{updates} updates from {args.users} users in {elapsed:.1f}s: {report['updates_per_second']} updates/s")
+    print(f"Latency p50 {report['p50_ms']}ms, p95 {report['p95_ms']}ms, p99 {report['p99_ms']}ms")
+    print(f"Mongo ops/update {report['mongo_ops_per_update']}, API calls/update {report['api_calls_per_update']}")
+    print(f"{'step':<16}{'count':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for step, row in report['steps'].items():
+        print(f"{step:<16}{row['count']:>8}{row['p50_ms']:>10}{row['p95_ms']:>10}{row['p99_ms']:>10}")
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+
+    await (await bot.main_bot.get_session()).close()
+    await runner.cleanup()
+    return report
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Kaoka bot load test")
+    parser.add_argument('--users', type=int, default=1000, help="virtual users")
+    parser.add_argument('--concurrency', type=int, default=100, help="users running at the same time")
+    parser.add_argument('--ratings', type=int, default=10, help="ratings per user")
+    parser.add_argument('--think-time', type=float, default=1.05, help="seconds between ratings")
+    parser.add_argument('--profiles', type=int, default=10000, help="seeded profiles")
+    parser.add_argument('--max-by', type=int, default=200, help="max ratings per seeded profile")
+    parser.add_argument('--skip-seed', action='store_true', help="reuse the already seeded collection")
+    parser.add_argument('--no-throttle', action='store_true', help="remove the throttling middleware")
+    parser.add_argument('--api-port', type=int, default=8081, help="port of the fake Bot API")
+    parser.add_argument('--latency-min', type=float, default=5, help="min injected API latency, ms")
+    parser.add_argument('--latency-max', type=float, default=50, help="max injected API latency, ms")
+    parser.add_argument('--rate-limit-ratio', type=float, default=0.0, help="share of API calls answered with 429")
+    parser.add_argument('--json', help="write the report to this file")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    # Never point the load test at the production database
+    os.environ.setdefault('MONGODB_DATABASE', 'kaoka_loadtest')
+    os.environ.setdefault('TELEGRAM_API_TOKEN', '123456:LOADTEST')
+    if os.environ['MONGODB_DATABASE'] == 'baraboba':
+        sys.exit("Refusing to seed the production database, set MONGODB_DATABASE")
+    asyncio.run(main(parse_args()))
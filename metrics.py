@@ -0,0 +1,236 @@
+import logging
+import os
+import time
+from contextlib import contextmanager
+
+from aiohttp import web
+from aiogram import Bot
+from aiogram.dispatcher.handler import current_handler
+from aiogram.dispatcher.middlewares import BaseMiddleware
+
+import tracing
+
+
+# Configure logger
+logger = logging.getLogger(__name__)
+
+# Latency buckets in seconds, from cache hits up to slow Telegram calls
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+REGISTRY = []
+_collectors = []
+
+
+def _process_start():
+    """Start of this process including the imports, from /proc on Linux and the import time
+    of this module elsewhere"""
+    try:
+        with open('/proc/self/stat') as f:
+            # Fields after the command name, which may contain spaces, starttime is the 22nd
+            ticks = int(f.read().rsplit(')', 1)[1].split()[19])
+        with open('/proc/uptime') as f:
+            uptime = float(f.read().split()[0])
+        return time.time() - (uptime - ticks / os.sysconf('SC_CLK_TCK'))
+    except (OSError, ValueError, IndexError):
+        return time.time()
+
+
+PROCESS_START = _process_start()
+_first_response = False
+
+
+def _format_labels(label_names, label_values, extra=()):
+    """Render a Prometheus label set"""
+    pairs = list(zip(label_names, label_values)) + list(extra)
+    if not pairs:
+        return ""
+    escaped = (
+        '{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for k, v in pairs
+    )
+    return "{" + ",".join(escaped) + "}"
+
+
+class Metric:
+    """Base class for a labelled metric family"""
+    type = "untyped"
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(labels)
+        self._values = {}
+        REGISTRY.append(self)
+
+    def _key(self, labels):
+        return tuple(labels.get(name, "") for name in self.label_names)
+
+    def samples(self):
+        """Yield (suffix, label_values, extra_labels, value) tuples"""
+        for key, value in self._values.items():
+            yield "", key, (), value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type}"]
+        for suffix, key, extra, value in self.samples():
+            lines.append(f"{self.name}{suffix}{_format_labels(self.label_names, key, extra)} {value}")
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    type = "gauge"
+
+    def set(self, value, **labels):
+        self._values[self._key(labels)] = value
+
+    def clear(self):
+        self._values.clear()
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name, documentation, labels=(), buckets=DEFAULT_BUCKETS):
+        super(Histogram, self).__init__(name, documentation, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        state = self._values.get(key)
+        if state is None:
+            # Per-bucket counts followed by the total count and the sum
+            state = self._values[key] = [0] * (len(self.buckets) + 2)
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                state[i] += 1
+                break
+        state[-2] += 1
+        state[-1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        """Observe the duration of the wrapped block"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def samples(self):
+        for key, state in self._values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets, state):
+                cumulative += count
+                yield "_bucket", key, (("le", bound),), cumulative
+            yield "_bucket", key, (("le", "+Inf"),), state[-2]
+            yield "_count", key, (), state[-2]
+            yield "_sum", key, (), state[-1]
+
+
+HANDLER_LATENCY = Histogram("bot_handler_seconds", "Time spent in update handlers", ["handler"])
+DB_LATENCY = Histogram("mongo_operation_seconds", "Time spent in database.py operations", ["operation"])
+DB_ERRORS = Counter("mongo_errors_total", "Failed database.py operations", ["operation"])
+CACHE_REQUESTS = Counter("cache_requests_total", "Cache lookups by result", ["cache", "result"])
+API_LATENCY = Histogram("telegram_api_seconds", "Telegram Bot API call latency", ["method"])
+API_ERRORS = Counter("telegram_api_errors_total", "Failed Telegram Bot API calls", ["method", "error"])
+FSM_STATES = Gauge("fsm_state_users", "Users currently in each FSM state", ["state"])
+FIRST_RESPONSE = Gauge("bot_time_to_first_response_seconds", "Seconds from process start to the first reply")
+JOB_SECONDS = Histogram("scheduler_job_seconds", "Scheduled job run time", ["job"])
+JOB_RUNS = Counter("scheduler_job_runs_total", "Scheduled job runs by result", ["job", "status"])
+ADMISSION_QUEUE_WAIT = Histogram("admission_queue_wait_seconds", "Time updates waited for a handler slot", ["priority"])
+ADMISSION_SHED = Counter("admission_shed_total", "Updates rejected by admission control", ["priority"])
+ADMISSION_IN_FLIGHT = Gauge("admission_in_flight", "Handlers currently running")
+ADMISSION_QUEUED = Gauge("admission_queued", "Updates waiting for a handler slot")
+DB_BREAKER_STATE = Gauge("db_circuit_state", "MongoDB circuit breaker state: 0 closed, 1 half-open, 2 open")
+DB_BREAKER_REJECTED = Counter(
+    "db_circuit_rejected_total", "Database operations failed fast by the open circuit", ["operation"]
+)
+OUTBOX_PENDING = Gauge("rating_outbox_pending", "Ratings in the local outbox not applied yet")
+OUTBOX_BATCH_SECONDS = Histogram("rating_outbox_batch_seconds", "Time to apply one outbox batch")
+JOB_LAST_SUCCESS = Gauge("scheduler_job_last_success_timestamp", "Unix time of the last successful run", ["job"])
+
+
+def cache_lookup(cache, hit):
+    """Record a cache hit or miss"""
+    result = "hit" if hit else "miss"
+    CACHE_REQUESTS.inc(cache=cache, result=result)
+    tracing.event(f"cache.{cache} {result}")
+
+
+def register_collector(func):
+    """Register a callable that refreshes gauges right before a scrape"""
+    _collectors.append(func)
+    return func
+
+
+def render():
+    """Render every registered metric in Prometheus text format"""
+    for collector in _collectors:
+        try:
+            collector()
+        except Exception as e:
+            logger.error(f"Metrics collector failed: {str(e)}")
+    return "\n".join(metric.render() for metric in REGISTRY) + "\n"
+
+
+class InstrumentedBot(Bot):
+    """Bot that counts and times every Bot API request"""
+
+    async def request(self, method, data=None, files=None, **kwargs):
+        global _first_response
+        start = time.perf_counter()
+        try:
+            with tracing.span(f"api.{method}"):
+                result = await super(InstrumentedBot, self).request(method, data, files, **kwargs)
+            if not _first_response and method.startswith(("send", "answer", "edit")):
+                _first_response = True
+                FIRST_RESPONSE.set(time.time() - PROCESS_START)
+                logger.info(f"First response {time.time() - PROCESS_START:.2f}s after start")
+            return result
+        except Exception as e:
+            API_ERRORS.inc(method=method, error=type(e).__name__)
+            raise
+        finally:
+            API_LATENCY.observe(time.perf_counter() - start, method=method)
+
+
+class MetricsMiddleware(BaseMiddleware):
+    """Measure handler latency for every update type"""
+
+    async def trigger(self, action, args):
+        if action.startswith("process_"):
+            handler = current_handler.get()
+            data = args[-1]
+            data["_metrics_handler"] = handler.__name__ if handler else "unknown"
+            data["_metrics_start"] = time.perf_counter()
+        elif action.startswith("post_process_"):
+            data = args[-1]
+            if "_metrics_start" in data:
+                HANDLER_LATENCY.observe(
+                    time.perf_counter() - data.pop("_metrics_start"),
+                    handler=data.pop("_metrics_handler"),
+                )
+        return True
+
+
+async def _handle_metrics(request):
+    return web.Response(text=render(), content_type="text/plain", charset="utf-8")
+
+
+async def start_server(host, port):
+    """Serve /metrics on a small aiohttp app, returns the runner for cleanup"""
+    app = web.Application()
+    app.router.add_get("/metrics", _handle_metrics)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    logger.info(f"Metrics endpoint listening on {host}:{port}/metrics")
+    return runner
@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+"""
+Versioned, resumable data migrations for the posts collection.
+
+Each migration streams matching documents through a projected cursor,
+turns them into update operations and applies them with unordered
+bulk_write in chunks. The last processed _id is checkpointed, so an
+interrupted run continues where it stopped. Migrations must be
+idempotent: the query should skip documents that are already migrated.
+
+    python migrations.py --list
+    python migrations.py --dry-run
+    python migrations.py --only 2 --batch-size 5000
+"""
+import argparse
+import asyncio
+import logging
+import time
+from datetime import datetime
+
+from pymongo import UpdateOne
+
+import database as db
+
+
+# Configure logger
+logger = logging.getLogger(__name__)
+
+MIGRATIONS = []
+
+
+class Migration:
+    """A numbered change applied document by document"""
+
+    def __init__(self, version, name, query, projection, transform, collection=None):
+        self.version = version
+        self.name = name
+        self.query = query
+        self.projection = projection
+        self.transform = transform
+        self.collection = collection if collection is not None else db.posts
+
+
+def migration(version, name, query, projection):
+    """Register a transform(doc) -> update dict (or None to skip) as a migration"""
+    def decorator(func):
+        MIGRATIONS.append(Migration(version, name, query, projection, func))
+        MIGRATIONS.sort(key=lambda m: m.version)
+        return func
+    return decorator
+
+
+async def get_checkpoint(version):
+    async with db.db_operation("get_checkpoint"):
+        return await db.migrations.find_one({'_id': version}) or {}
+
+
+async def save_checkpoint(version, **fields):
+    async with db.db_operation("save_checkpoint"):
+        await db.migrations.update_one(
+            {'_id': version},
+            {'$set': dict(fields, updated=datetime.utcnow())},
+            upsert=True
+        )
+
+
+async def run_migration(item, batch_size=1000, dry_run=False):
+    """Apply one migration, resuming after the last checkpointed _id"""
+    checkpoint = {} if dry_run else await get_checkpoint(item.version)
+    if checkpoint.get('done'):
+        logger.info(f"Migration {item.version} {item.name} already applied")
+        return checkpoint
+
+    query = dict(item.query)
+    if checkpoint.get('last_id') is not None:
+        query['_id'] = {'$gt': checkpoint['last_id']}
+    scanned = checkpoint.get('scanned', 0)
+    modified = checkpoint.get('modified', 0)
+    start = time.perf_counter()
+    run_scanned = 0
+    ops = []
+    last_id = checkpoint.get('last_id')
+
+    async def flush():
+        nonlocal modified, ops
+        if not ops:
+            return
+        if dry_run:
+            modified += len(ops)
+        else:
+            async with db.db_operation(f"migration_{item.version}", background=True):
+                result = await item.collection.bulk_write(ops, ordered=False)
+            modified += result.modified_count
+            await save_checkpoint(item.version, name=item.name, last_id=last_id, scanned=scanned, modified=modified)
+        ops = []
+
+    cursor = item.collection.find(query, item.projection).sort('_id', 1).batch_size(batch_size)
+    async for doc in cursor:
+        update = item.transform(doc)
+        if update:
+            # The query is checked again on write, a document changed since the read is skipped
+            ops.append(UpdateOne(dict(item.query, _id=doc['_id']), update))
+        last_id = doc['_id']
+        scanned += 1
+        run_scanned += 1
+        if len(ops) >= batch_size:
+            await flush()
+            rate = run_scanned / (time.perf_counter() - start)
+            logger.info(f"Migration {item.version}: {scanned} scanned, {modified} modified, {rate:.0f} docs/s")
+    await flush()
+
+    elapsed = time.perf_counter() - start
+    rate = run_scanned / elapsed if elapsed else 0
+    if not dry_run:
+        await save_checkpoint(item.version, name=item.name, last_id=last_id, scanned=scanned, modified=modified, done=True)
+    logger.info(
+        f"Migration {item.version} {item.name}{' (dry run)' if dry_run else ''}: "
+        f"{scanned} scanned, {modified} {'would change' if dry_run else 'modified'}, "
+        f"{elapsed:.1f}s, {rate:.0f} docs/s"
+    )
+    return {'scanned': scanned, 'modified': modified, 'docs_per_second': rate}
+
+
+async def run_all(batch_size=1000, dry_run=False, only=None):
+    """Apply pending migrations in version order"""
+    for item in MIGRATIONS:
+        if only is None or item.version == only:
+            await run_migration(item, batch_size, dry_run)
+
+
+@migration(1, "mark_to_float", {'mark': {'$not': {'$type': 'double'}}}, {'mark': 1})
+def mark_to_float(doc):
+    """Store every mark as a float (was database.toDecimal)"""
+    return {'$set': {'mark': float(doc.get('mark') or 0)}}
+
+
+@migration(2, "default_city", {'city': {'$exists': False}}, {'_id': 1})
+def default_city(doc):
+    """Give profiles without a city the "не важно" default (was database.add_new_field)"""
+    return {'$set': {'city': 'не важно'}}
+
+
+# Same counters as database.mark_histogram, computed from the ratings list at write time
+HISTOGRAM_PIPELINE = [{'$set': {'histogram': {'$map': {
+    'input': list(range(1, 11)),
+    'as': 'mark',
+    'in': {'$size': {'$filter': {
+        'input': {'$ifNull': ['$by', []]},
+        'as': 'rating',
+        'cond': {'$eq': [
+            {'$convert': {'input': '$$rating.mark', 'to': 'int', 'onError': 0, 'onNull': 0}},
+            '$$mark',
+        ]},
+    }}},
+}}}}]
+
+
+@migration(3, "mark_histogram", {'histogram': {'$not': {'$type': 'array'}}}, {'_id': 1})
+def mark_histogram(doc):
+    """Backfill the 10-slot mark counters from the ratings list in the same write, so ratings
+    pushed since the read are counted"""
+    return HISTOGRAM_PIPELINE
+
+
+async def list_migrations():
+    for item in MIGRATIONS:
+        checkpoint = await get_checkpoint(item.version)
+        status = "done" if checkpoint.get('done') else f"pending ({checkpoint.get('scanned', 0)} scanned)"
+        print(f"{item.version:>4}  {item.name:<24} {status}")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Run data migrations")
+    parser.add_argument('--dry-run', action='store_true', help="count changes without writing")
+    parser.add_argument('--batch-size', type=int, default=1000)
+    parser.add_argument('--only', type=int, help="run a single migration version")
+    parser.add_argument('--list', action='store_true', help="show migration status")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    args = parse_args()
+    if args.list:
+        asyncio.run(list_migrations())
+    else:
+        asyncio.run(run_all(args.batch_size, args.dry_run, args.only))
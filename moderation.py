@@ -0,0 +1,138 @@
+import asyncio
+import logging
+import re
+import time
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from datetime import datetime
+
+from pymongo import UpdateOne
+
+import database as db
+import functions
+from config import MODERATION_BATCH, MODERATION_PROCESS_THRESHOLD
+
+
+# Configure logger
+logger = logging.getLogger(__name__)
+
+# Links and mentions in comments are almost always spam
+LINK_PATTERN = re.compile(r'(https?://|www\.|t\.me/|telegram\.me/|@[A-Za-z0-9_]{5,})', re.IGNORECASE)
+MAX_NAME_LENGTH = 64
+PROJECTION = {'chat_id': 1, 'name': 1, 'by.comment': 1}
+SAMPLE_SIZE = 10
+
+
+def check_profile(name, comments):
+    """Return the moderation flags for one profile, pure and synchronous"""
+    flags = []
+    name = name or ''
+    if functions.SYMBOL_PATTERN.search(name) and not name.startswith('@'):
+        flags.append('name_symbols')
+    if LINK_PATTERN.search(name):
+        flags.append('name_link')
+    if len(name) > MAX_NAME_LENGTH:
+        flags.append('name_length')
+    if any(comment and LINK_PATTERN.search(comment) for comment in comments):
+        flags.append('comment_link')
+    return flags
+
+
+def scan_batch(batch):
+    """Check a batch of (chat_id, name, comments) tuples, runs in a worker"""
+    return [(chat_id, check_profile(name, comments)) for chat_id, name, comments in batch]
+
+
+class ModerationScanner:
+    """Streams profiles through the checks and writes flags with bulk_write"""
+
+    def __init__(self, batch_size=MODERATION_BATCH, process_threshold=MODERATION_PROCESS_THRESHOLD):
+        self.batch_size = batch_size
+        self.process_threshold = process_threshold
+        self._threads = ThreadPoolExecutor(max_workers=1, thread_name_prefix="moderation")
+        self._processes = None
+        self._lock = asyncio.Lock()
+
+    @property
+    def running(self):
+        return self._lock.locked()
+
+    def _executor(self, size):
+        """Batches of small scans go to a thread, of big ones to a process pool"""
+        if size < self.process_threshold:
+            return self._threads
+        if self._processes is None:
+            self._processes = ProcessPoolExecutor(max_workers=2)
+        return self._processes
+
+    async def _last_run(self):
+        async with db.db_operation("moderation_last_run"):
+            state = await db.meta.find_one({'_id': 'moderation'})
+        return state.get('last_run') if state else None
+
+    async def _process(self, executor, batch, summary):
+        loop = asyncio.get_running_loop()
+        results = await loop.run_in_executor(executor, scan_batch, batch)
+        now = datetime.utcnow()
+        ops = []
+        for chat_id, flags in results:
+            ops.append(UpdateOne({'chat_id': chat_id}, {'$set': {'moderation': {'flags': flags, 'checked': now}}}))
+            summary['flags'].update(flags)
+            if flags:
+                summary['flagged'] += 1
+                if len(summary['sample']) < SAMPLE_SIZE:
+                    summary['sample'].append((chat_id, flags))
+        async with db.db_operation("moderation_flags", background=True):
+            await db.posts.bulk_write(ops, ordered=False)
+        summary['scanned'] += len(batch)
+
+    async def scan(self, incremental=True):
+        """Scan profiles, only the ones changed since the last run in incremental mode"""
+        async with self._lock:
+            started = datetime.utcnow()
+            query = {}
+            since = await self._last_run() if incremental else None
+            if since is not None:
+                query = {'$or': [{'updated': {'$gt': since}}, {'moderation': {'$exists': False}}]}
+            summary = {'scanned': 0, 'flagged': 0, 'flags': Counter(), 'sample': [], 'incremental': since is not None}
+            start = time.perf_counter()
+            # Batches are smaller than the threshold, the size of the whole scan decides
+            async with db.db_operation("moderation_count", background=True):
+                executor = self._executor(await db.posts.count_documents(query))
+            batch = []
+            cursor = db.posts.find(query, PROJECTION).batch_size(self.batch_size)
+            async for doc in cursor:
+                comments = [item.get('comment') for item in doc.get('by', []) if isinstance(item, dict)]
+                batch.append((doc['chat_id'], doc.get('name'), comments))
+                if len(batch) >= self.batch_size:
+                    await self._process(executor, batch, summary)
+                    batch = []
+            if batch:
+                await self._process(executor, batch, summary)
+            async with db.db_operation("moderation_last_run"):
+                await db.meta.update_one({'_id': 'moderation'}, {'$set': {'last_run': started}}, upsert=True)
+            summary['seconds'] = time.perf_counter() - start
+            logger.info(
+                f"Moderation scan: {summary['scanned']} scanned, {summary['flagged']} flagged "
+                f"in {summary['seconds']:.1f}s"
+            )
+            return summary
+
+    def close(self):
+        self._threads.shutdown(wait=False)
+        if self._processes is not None:
+            self._processes.shutdown(wait=False)
+
+
+def format_summary(summary):
+    """Render a scan summary for the admin chat"""
+    lines = [
+        "Модерация ({})".format("изменённые анкеты" if summary['incremental'] else "полная проверка"),
+        f"Проверено: {summary['scanned']} за {summary['seconds']:.1f} сек",
+        f"С нарушениями: {summary['flagged']}",
+    ]
+    for flag, count in summary['flags'].most_common():
+        lines.append(f"  {flag}: {count}")
+    for chat_id, flags in summary['sample']:
+        lines.append(f"{chat_id}: {', '.join(flags)}")
+    return "\n".join(lines)
@@ -0,0 +1,248 @@
+import asyncio
+import json
+import logging
+import os
+import time
+import uuid
+
+import database as db
+import hosting
+import metrics
+from breaker import CLOSED
+from config import RATING_OUTBOX, OUTBOX_BATCH, OUTBOX_FLUSH_INTERVAL, OUTBOX_RETRY
+
+
+# Configure logger
+logger = logging.getLogger(__name__)
+
+
+class WriteJournal:
+    """Append-only file of pending writes consumed in order in batches. The batch bounds are
+    saved before it is applied, so after a crash exactly the same batch is applied again"""
+
+    def __init__(self, path):
+        self.path = path
+        self.offset_path = f"{path}.offset"
+        self._repair()
+        # End of the entries known to be on disk, a write in flight lands after it
+        self._size = os.path.getsize(path) if os.path.exists(path) else 0
+        self._buffer = []
+        self._flushing = None
+        self.pending = self._count_pending()
+        metrics.OUTBOX_PENDING.set(self.pending)
+
+    def _repair(self):
+        """Terminate a line torn by a crash, or the next append would be glued to it"""
+        if not os.path.exists(self.path) or not os.path.getsize(self.path):
+            return
+        with open(self.path, 'rb+') as f:
+            f.seek(-1, os.SEEK_END)
+            if f.read(1) != b'\n':
+                f.write(b'\n')
+
+    def _read_offset(self):
+        """(offset of the first unapplied entry, end of the batch in progress or None)"""
+        try:
+            with open(self.offset_path) as f:
+                state = json.load(f)
+            return state['offset'], state.get('end')
+        except FileNotFoundError:
+            return 0, None
+
+    def _write_offset(self, offset, end=None):
+        tmp = f"{self.offset_path}.tmp"
+        with open(tmp, 'w') as f:
+            json.dump({'offset': offset, 'end': end}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.offset_path)
+
+    def _count_pending(self):
+        if not os.path.exists(self.path):
+            return 0
+        with open(self.path, 'rb') as f:
+            f.seek(self._read_offset()[0])
+            return sum(1 for line in f if line.strip())
+
+    async def append(self, op, *args):
+        """Durably store one write, returns its idempotency key once it is on disk"""
+        entry = {'id': uuid.uuid4().hex, 'ts': time.time(), 'op': op, 'args': args}
+        written = asyncio.get_running_loop().create_future()
+        self._buffer.append(((json.dumps(entry) + '\n').encode(), written))
+        if self._flushing is None:
+            self._flushing = asyncio.create_task(self._flush())
+        await written
+        return entry['id']
+
+    def _write(self, data):
+        """Runs in a thread, returns the file size after the write"""
+        with open(self.path, 'ab') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+            return f.tell()
+
+    async def _flush(self):
+        """Group commit, entries appended while a write is in flight share the next write and fsync"""
+        loop = asyncio.get_running_loop()
+        # Let the appends of this tick join the first write
+        await asyncio.sleep(0)
+        try:
+            while self._buffer:
+                buffer, self._buffer = self._buffer, []
+                try:
+                    self._size = await loop.run_in_executor(None, self._write, b''.join(line for line, _ in buffer))
+                except Exception as e:
+                    logger.error(f"Journal write failed: {str(e)}")
+                    self._repair()
+                    for _, written in buffer:
+                        if not written.done():
+                            written.set_exception(e)
+                    continue
+                self.pending += len(buffer)
+                metrics.OUTBOX_PENDING.set(self.pending)
+                for _, written in buffer:
+                    if not written.done():
+                        written.set_result(None)
+        finally:
+            self._flushing = None
+
+    async def wait_flushed(self):
+        """Wait for the write in flight, if any"""
+        if self._flushing is not None:
+            await asyncio.shield(self._flushing)
+
+    def begin(self, limit):
+        """Entries of the next batch, up to limit, or of the batch a crash left unfinished"""
+        offset, end = self._read_offset()
+        entries = []
+        if not os.path.exists(self.path):
+            return entries
+        stop = end if end is not None else self._size
+        with open(self.path, 'rb') as f:
+            f.seek(offset)
+            while f.tell() < stop and (end is not None or len(entries) < limit):
+                line = f.readline()
+                if not line:
+                    break
+                if not line.strip():
+                    continue
+                try:
+                    entries.append(json.loads(line))
+                except ValueError:
+                    logger.error(f"Dropped a corrupt journal line at {f.tell() - len(line)}")
+                    entries.append(None)
+            end = f.tell()
+        self._write_offset(offset, end)
+        return entries
+
+    def commit(self, count):
+        """Mark the batch as applied, the file is removed once every entry is"""
+        _, end = self._read_offset()
+        self.pending = max(self.pending - count, 0)
+        metrics.OUTBOX_PENDING.set(self.pending)
+        if not os.path.exists(self.path) or (end >= self._size and self._flushing is None):
+            # Nothing was appended since begin and no write is in flight
+            for path in (self.path, self.offset_path):
+                if os.path.exists(path):
+                    os.remove(path)
+            self._size = 0
+            self.pending = 0
+            metrics.OUTBOX_PENDING.set(0)
+            return
+        self._write_offset(end)
+
+
+class RatingOutbox:
+    """Ratings are journaled on the response path and applied by a background worker in batches"""
+
+    def __init__(self, path=RATING_OUTBOX, batch=OUTBOX_BATCH, interval=OUTBOX_FLUSH_INTERVAL, retry=OUTBOX_RETRY):
+        self.journal = WriteJournal(path)
+        self.batch = batch
+        self.interval = interval
+        self.retry = retry
+        self._wake = asyncio.Event()
+        self._recovered = asyncio.Event()
+        self._lock = asyncio.Lock()
+        self._task = None
+        db.circuit.on_change(self._on_circuit_change)
+
+    @property
+    def pending(self):
+        return self.journal.pending
+
+    async def submit(self, rater_id, chat_id, mark, comment):
+        """Durably queue a rating, returns its idempotency key"""
+        key = await self.journal.append('rating', rater_id, chat_id, mark, comment)
+        self._wake.set()
+        return key
+
+    def _on_circuit_change(self, old, new):
+        if new == CLOSED:
+            self._recovered.set()
+
+    async def drain(self):
+        """Apply every queued rating, returns False when MongoDB is unavailable"""
+        async with self._lock:
+            while self.pending:
+                entries = self.journal.begin(self.batch)
+                ratings = [(entry['id'], *entry['args']) for entry in entries if entry and entry['op'] == 'rating']
+                start = time.perf_counter()
+                try:
+                    if ratings:
+                        # The first key names the batch, it is the same when a batch is applied again
+                        await db.apply_ratings(ratings[0][0], ratings)
+                except db.UNAVAILABLE:
+                    logger.warning(f"MongoDB unavailable, {self.pending} ratings wait in the outbox")
+                    return False
+                metrics.OUTBOX_BATCH_SECONDS.observe(time.perf_counter() - start)
+                self.journal.commit(len(entries))
+            return True
+
+    async def run(self):
+        """Worker loop, call once the event loop is running"""
+        self._task = asyncio.current_task()
+        if self.pending:
+            logger.info(f"Applying {self.pending} ratings left in the outbox")
+            self._wake.set()
+        while True:
+            await self._wake.wait()
+            self._wake.clear()
+            # Let a batch gather
+            await asyncio.sleep(self.interval)
+            try:
+                drained = await self.drain()
+            except Exception as e:
+                logger.error(f"Outbox batch failed: {str(e)}")
+                drained = False
+            if not drained:
+                # New ratings don't help, retry when the circuit closes or after a pause
+                self._recovered.clear()
+                try:
+                    await asyncio.wait_for(self._recovered.wait(), self.retry)
+                except asyncio.TimeoutError:
+                    pass
+                self._wake.set()
+
+    async def close(self):
+        """Stop the worker and apply what is left while MongoDB is reachable"""
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+        await self.journal.wait_flushed()
+        try:
+            await self.drain()
+        except Exception as e:
+            logger.warning(f"{self.pending} ratings stay in the outbox for the next start: {str(e)}")
+
+
+def _outbox_path(config):
+    """The main bot keeps RATING_OUTBOX, other namespaces get a file named after their bot"""
+    if config.namespace == hosting.MAIN.namespace:
+        return RATING_OUTBOX
+    root, ext = os.path.splitext(RATING_OUTBOX)
+    return f"{root}-{config.name}{ext}"
+
+
+# One outbox per hosted bot namespace, see hosting.py
+rating_outbox = hosting.BotLocal(lambda config: RatingOutbox(_outbox_path(config)))
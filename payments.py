@@ -0,0 +1,206 @@
+import asyncio
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+import database as db
+import hosting
+from config import (
+    vipsum,
+    PAYMENT_WORKERS,
+    PAYMENT_TIMEOUT,
+    PAYMENT_RECONCILE_INTERVAL,
+    PAYMENT_BILL_LIFETIME,
+)
+
+
+# Configure logger
+logger = logging.getLogger(__name__)
+
+# How long a created bill is reused for the same user
+BILL_TTL = 300  # seconds
+# How long a fetched status is reused before asking QIWI again
+STATUS_TTL = 3  # seconds
+
+PAID_STATUSES = ("PAID", "COMPLETED")
+PENDING_STATUSES = ("WAITING", "PENDING")
+
+
+def _parse_status(wallet, bill_id):
+    """Blocking status lookup trying every wallet method for compatibility"""
+    try:
+        payment_info = wallet.get_bill_status(bill_id=bill_id)
+        if payment_info and payment_info.get('status'):
+            return payment_info.get('status')
+    except Exception:
+        pass
+
+    try:
+        payment_info = wallet.check_p2p_bill(bill_id=bill_id)
+        if payment_info:
+            status = payment_info.get('status')
+            # Status may be a plain string or a nested object
+            if isinstance(status, dict):
+                status = status.get('value')
+            if status:
+                return status
+    except Exception:
+        pass
+
+    status = wallet.invoice_status(bill_id=bill_id)
+    if status and isinstance(status, dict):
+        return status.get("status", {}).get("value")
+    return None
+
+
+class PaymentClient:
+    """Non-blocking QIWI client running wallet calls in a bounded thread pool"""
+
+    def __init__(self, wallet_factory, max_workers=PAYMENT_WORKERS, timeout=PAYMENT_TIMEOUT):
+        self._wallet_factory = wallet_factory
+        self._wallet = None
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="qiwi")
+        self.timeout = timeout
+        self._bills = {}  # chat_id -> (link, bill_id, timestamp)
+        self._statuses = {}  # bill_id -> (status, timestamp)
+        self._inflight = {}  # bill_id -> asyncio.Task with the running status lookup
+
+    def _get_wallet(self):
+        """Create the wallet on first use, runs inside the worker thread"""
+        if self._wallet is None:
+            self._wallet = self._wallet_factory()
+        return self._wallet
+
+    async def _call(self, func, *args, **kwargs):
+        """Run a blocking wallet call in the pool with a timeout"""
+        def run():
+            return func(self._get_wallet(), *args, **kwargs)
+
+        loop = asyncio.get_running_loop()
+        return await asyncio.wait_for(loop.run_in_executor(self._executor, run), self.timeout)
+
+    async def create_bill(self, chat_id):
+        """Return (link, bill_id) for the user, reusing their pending bill if any"""
+        current_time = time.time()
+        self._prune(current_time)
+        cached = self._bills.get(chat_id)
+        if cached and current_time - cached[2] < BILL_TTL:
+            link, bill_id, _ = cached
+            if await self.get_status(bill_id) in PENDING_STATUSES:
+                return link, bill_id
+        self._bills.pop(chat_id, None)
+
+        try:
+            invoice = await self._call(lambda wallet: wallet.create_p2p_bill(amount=vipsum))
+        except Exception as e:
+            logger.error(f"Payment error: {str(e)}")
+            return None, None
+        if not invoice:
+            logger.error("Failed to create payment invoice")
+            return None, None
+
+        link = invoice.get('payUrl') or invoice.get('pay_url')
+        bill_id = invoice.get('billId') or invoice.get('bill_id')
+        if link and bill_id:
+            self._bills[chat_id] = (link, bill_id, current_time)
+        return link, bill_id
+
+    async def get_status(self, bill_id, retries=3, retry_delay=1):
+        """Get bill status, concurrent lookups for the same bill share one request"""
+        cached = self._statuses.get(bill_id)
+        if cached and time.time() - cached[1] < STATUS_TTL:
+            return cached[0]
+
+        task = self._inflight.get(bill_id)
+        if task is None:
+            task = asyncio.ensure_future(self._fetch_status(bill_id, retries, retry_delay))
+            self._inflight[bill_id] = task
+            task.add_done_callback(lambda _: self._inflight.pop(bill_id, None))
+        return await asyncio.shield(task)
+
+    async def _fetch_status(self, bill_id, retries, retry_delay):
+        """Status lookup with retries that sleep without blocking the loop"""
+        for attempt in range(retries):
+            try:
+                status = await self._call(partial(_parse_status, bill_id=bill_id))
+                self._statuses[bill_id] = (status, time.time())
+                return status
+            except Exception as e:
+                if attempt < retries - 1:
+                    logger.warning(f"Error checking payment status, attempt {attempt+1}: {str(e)}")
+                    await asyncio.sleep(retry_delay)
+                else:
+                    logger.error(f"Failed to check payment status after {retries} attempts: {str(e)}")
+        return None
+
+    def _prune(self, current_time):
+        """Remove expired bills and statuses so the caches stay bounded"""
+        for chat_id, (_, _, timestamp) in list(self._bills.items()):
+            if current_time - timestamp >= BILL_TTL:
+                del self._bills[chat_id]
+        for bill_id, (_, timestamp) in list(self._statuses.items()):
+            if current_time - timestamp >= STATUS_TTL:
+                del self._statuses[bill_id]
+
+    def forget(self, chat_id):
+        """Drop the cached bill of a user once it is paid or cancelled"""
+        cached = self._bills.pop(chat_id, None)
+        if cached:
+            self._statuses.pop(cached[1], None)
+
+    def close(self):
+        """Shut down the worker threads and the wallet's connections"""
+        self._executor.shutdown(wait=False)
+        close = getattr(self._wallet, 'close', None)
+        if close is not None:
+            close()
+
+
+class PaymentReconciler:
+    """Periodically checks persisted bills and grants VIP for the paid ones"""
+
+    def __init__(self, client, on_paid, interval=PAYMENT_RECONCILE_INTERVAL, batch_size=50, max_delay=600):
+        self.client = client
+        self.on_paid = on_paid
+        self.interval = interval
+        self.batch_size = batch_size
+        self.max_delay = max_delay
+
+    async def track(self, chat_id, link, bill_id):
+        """Persist a freshly created bill for background checks"""
+        await db.add_bill(bill_id, chat_id, link, PAYMENT_BILL_LIFETIME, self.interval, hosting.current().name)
+
+    async def check(self, bill):
+        """Check one bill, grant VIP exactly once when it is paid"""
+        bill_id = bill['_id']
+        chat_id = bill['chat_id']
+        status = await self.client.get_status(bill_id)
+        if status in PAID_STATUSES:
+            # close_bill is atomic, so only one checker calls on_paid
+            if await db.close_bill(bill_id, status):
+                self.client.forget(chat_id)
+                await self.on_paid(chat_id, bill.get('bot'))
+        elif status in PENDING_STATUSES or status is None:
+            # Exponential backoff, unknown status is treated as a transient error
+            attempts = bill.get('attempts', 0) + 1
+            delay = min(self.interval * 2 ** attempts, self.max_delay)
+            await db.reschedule_bill(bill_id, attempts, delay)
+        else:
+            await db.close_bill(bill_id, status)
+            self.client.forget(chat_id)
+        return status
+
+    async def run_once(self):
+        """Check one batch of due bills, returns how many were checked"""
+        due = await db.get_due_bills(self.batch_size)
+        results = await asyncio.gather(*(self.check(bill) for bill in due), return_exceptions=True)
+        for bill, result in zip(due, results):
+            if isinstance(result, Exception):
+                logger.error(f"Failed to reconcile bill {bill['_id']}: {str(result)}")
+        return len(due)
+
+    async def drain(self):
+        """Check due bills batch after batch until a batch comes back short"""
+        while await self.run_once() >= self.batch_size:
+            pass
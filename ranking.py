@@ -0,0 +1,92 @@
+import logging
+import time
+from bisect import bisect_left, insort
+
+import database as db
+import hosting
+
+
+# Configure logger
+logger = logging.getLogger(__name__)
+
+# Same eligibility as the top 10 in database.sort_collection_by_mark
+MIN_RATINGS = 100
+
+
+class Ranking:
+    """Sorted (-mark, chat_id) keys of eligible profiles, rank lookup is a binary search"""
+
+    def __init__(self):
+        self.ready = False
+        self._keys = []
+        self._marks = {}
+        self._pending = None  # Changes seen while a rebuild is loading
+
+    @staticmethod
+    def eligible(profile):
+        return (
+            bool(profile)
+            and profile.get('count', 0) >= MIN_RATINGS
+            and profile.get('active', 0) >= 1
+            and profile.get('block', 0) != 1
+        )
+
+    def update(self, chat_id, profile):
+        """Apply a profile change, profile None removes it"""
+        if self._pending is not None:
+            self._pending.append((chat_id, profile))
+        old = self._marks.pop(chat_id, None)
+        if old is not None:
+            self._keys.pop(bisect_left(self._keys, (-old, chat_id)))
+        if self.eligible(profile):
+            mark = float(profile.get('mark') or 0)
+            self._marks[chat_id] = mark
+            insort(self._keys, (-mark, chat_id))
+
+    def rank(self, chat_id):
+        """(place, total) for an eligible profile, ties share the place, None otherwise"""
+        mark = self._marks.get(chat_id)
+        if mark is None:
+            return None
+        return bisect_left(self._keys, (-mark,)) + 1, len(self._keys)
+
+    def describe(self, chat_id):
+        """Caption line with the place in the ranking"""
+        place = self.rank(chat_id) if self.ready else None
+        if place is None:
+            return f"🏆Место в рейтинге: после {MIN_RATINGS} оценок"
+        return "🏆Место в рейтинге: {} из {}".format(*place)
+
+    async def rebuild(self):
+        """Load every eligible profile from the database"""
+        start = time.perf_counter()
+        fresh = Ranking()
+        self._pending = []
+        try:
+            async with db.db_operation("ranking_rebuild", background=True):
+                cursor = db.posts.find(
+                    {'count': {'$gte': MIN_RATINGS}, 'active': {'$gte': 1}, 'block': {'$ne': 1}},
+                    {'chat_id': 1, 'mark': 1, 'count': 1, 'active': 1, 'block': 1},
+                ).batch_size(5000)
+                async for doc in cursor:
+                    mark = float(doc.get('mark') or 0)
+                    fresh._marks[doc['chat_id']] = mark
+                    fresh._keys.append((-mark, doc['chat_id']))
+            fresh._keys.sort()
+            # Replay changes committed while loading, then swap in one step
+            for chat_id, profile in self._pending:
+                fresh.update(chat_id, profile)
+        finally:
+            self._pending = None
+        self._keys, self._marks = fresh._keys, fresh._marks
+        self.ready = True
+        logger.info(f"Ranking rebuilt with {len(self._keys)} profiles in {time.perf_counter() - start:.2f}s")
+
+
+# One per hosted bot namespace, see hosting.py
+ranking = hosting.BotLocal(lambda config: Ranking())
+
+
+@db.on_profile_change
+def update_ranking(chat_id, profile):
+    ranking.update(chat_id, profile)
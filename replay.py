@@ -0,0 +1,239 @@
+#!/usr/bin/env python3
+"""
+Update record and replay for performance regression testing.
+
+UpdateRecorder is an optional middleware that writes anonymized raw updates
+to a rotating NDJSON file (enable with RECORD_UPDATES=path). Running this
+module replays a recording into the Dispatcher with Bot API calls stubbed out
+and reports CPU time, Mongo operations and memory per update:
+
+    MONGODB_DATABASE=kaoka_replay python replay.py updates.ndjson --json build.json
+    MONGODB_DATABASE=kaoka_replay python replay.py updates.ndjson --pace original --compare build.json
+"""
+import argparse
+import asyncio
+import hashlib
+import hmac
+import json
+import logging
+import os
+import re
+import sys
+import time
+import tracemalloc
+from logging.handlers import RotatingFileHandler
+
+from aiogram import types
+from aiogram.dispatcher.middlewares import BaseMiddleware
+
+from config import RECORD_SALT, RECORD_MAX_BYTES, RECORD_BACKUPS
+
+
+# Configure logger
+logger = logging.getLogger(__name__)
+
+# Object keys holding Telegram users and chats
+PERSON_KEYS = ('from', 'chat', 'user', 'sender_chat', 'forward_from')
+NAME_KEYS = ('first_name', 'last_name', 'username', 'title')
+MEDIA_KEYS = ('photo', 'video', 'voice', 'document', 'audio')
+# Long numbers in texts and callback data are chat ids, e.g. "admin_ban_123456"
+ID_PATTERN = re.compile(r'\d{5,}')
+
+
+def _button_texts():
+    """Texts sent by keyboard buttons, kept as-is because handlers match on them"""
+    import keyboard
+    texts = {"Изменить имя", "Изменить медиа", "Изменить город", "Отключить анкету", "Назад", "🖤VIP"}
+    texts.update(str(i) for i in range(1, 11))
+    for value in vars(keyboard).values():
+        if isinstance(value, types.ReplyKeyboardMarkup):
+            for row in value.keyboard:
+                texts.update(button.text for button in row)
+    return texts
+
+
+class Anonymizer:
+    """Replaces ids consistently with a keyed hash and scrubs personal text"""
+
+    def __init__(self, salt=RECORD_SALT):
+        self.salt = salt.encode()
+        self.buttons = _button_texts()
+
+    def _digest(self, value):
+        return hmac.new(self.salt, str(value).encode(), hashlib.sha256).hexdigest()
+
+    def chat_id(self, value):
+        # Keep the sign so group chats stay negative
+        mapped = int(self._digest(abs(value))[:12], 16)
+        return -mapped if value < 0 else mapped
+
+    def text(self, value):
+        if value in self.buttons or value.startswith('/'):
+            return ID_PATTERN.sub(lambda m: str(self.chat_id(int(m.group()))), value)
+        if value.isdigit():
+            return str(self.chat_id(int(value)))
+        # Keep the length, handlers check it
+        return 'x' * len(value)
+
+    def file_id(self, kind, value):
+        return f"{kind}_{self._digest(value)[:16]}"
+
+    def __call__(self, obj, kind=None):
+        if isinstance(obj, list):
+            return [self(item, kind) for item in obj]
+        if not isinstance(obj, dict):
+            return obj
+        result = {}
+        for key, value in obj.items():
+            if key in PERSON_KEYS and isinstance(value, dict):
+                value = dict(value)
+                if isinstance(value.get('id'), int):
+                    value['id'] = self.chat_id(value['id'])
+                for name in NAME_KEYS:
+                    if name in value:
+                        value[name] = f"{name}_{self._digest(value[name])[:6]}"
+                result[key] = value
+            elif key in ('text', 'caption', 'query') and isinstance(value, str):
+                result[key] = self.text(value)
+            elif key == 'data' and isinstance(value, str):
+                result[key] = ID_PATTERN.sub(lambda m: str(self.chat_id(int(m.group()))), value)
+            elif key in ('file_id', 'file_unique_id'):
+                result[key] = self.file_id(kind or 'file', value)
+            elif key in ('contact', 'location', 'entities', 'caption_entities'):
+                continue
+            else:
+                result[key] = self(value, key if key in MEDIA_KEYS else kind)
+        return result
+
+
+class UpdateRecorder(BaseMiddleware):
+    """Writes every incoming update, anonymized, to a rotating NDJSON file"""
+
+    def __init__(self, path, max_bytes=RECORD_MAX_BYTES, backups=RECORD_BACKUPS):
+        self.anonymize = Anonymizer()
+        self._log = logging.getLogger(f"{__name__}.recording")
+        self._log.propagate = False
+        self._log.setLevel(logging.INFO)
+        handler = RotatingFileHandler(path, maxBytes=max_bytes, backupCount=backups, encoding='utf-8')
+        handler.setFormatter(logging.Formatter('%(message)s'))
+        self._log.addHandler(handler)
+        super(UpdateRecorder, self).__init__()
+
+    async def on_pre_process_update(self, update: types.Update, data: dict):
+        try:
+            record = {'ts': time.time(), 'update': self.anonymize(update.to_python())}
+            self._log.info(json.dumps(record, ensure_ascii=False))
+        except Exception as e:
+            logger.error(f"Failed to record update: {str(e)}")
+
+
+def load_recording(path):
+    """Read (timestamp, update dict) pairs from an NDJSON recording"""
+    with open(path, encoding='utf-8') as f:
+        return [(record['ts'], record['update']) for record in map(json.loads, filter(str.strip, f))]
+
+
+async def replay(dp, records, pace='fast', concurrency=1):
+    """Feed recorded updates into the dispatcher, returns wall time"""
+    start = time.perf_counter()
+    if pace == 'original':
+        first = records[0][0]
+        tasks = []
+        for ts, payload in records:
+            delay = (ts - first) - (time.perf_counter() - start)
+            if delay > 0:
+                await asyncio.sleep(delay)
+            tasks.append(asyncio.ensure_future(dp.process_updates([types.Update(**payload)])))
+        await asyncio.gather(*tasks, return_exceptions=True)
+    else:
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def feed(payload):
+            async with semaphore:
+                await dp.process_updates([types.Update(**payload)])
+
+        await asyncio.gather(*(feed(payload) for _, payload in records), return_exceptions=True)
+    return time.perf_counter() - start
+
+
+async def main(args):
+    os.environ['METRICS_PORT'] = '0'
+    import bot
+    import metrics
+    from aiogram import Bot, Dispatcher
+    from loadtest import FakeBotAPI, disable_throttling, mongo_operations
+    logging.getLogger().setLevel(logging.WARNING)
+
+    # Stub out the Bot API, responses come from the load test's fake server logic
+    fake = FakeBotAPI()
+
+    async def stub_request(method, data=None, files=None, **kwargs):
+        fake.calls[method] += 1
+        return fake._result(method.lower(), data or {})
+
+    bot.main_bot.request = stub_request
+    if args.no_throttle:
+        disable_throttling(bot.dp)
+    Bot.set_current(bot.main_bot)
+    Dispatcher.set_current(bot.dp)
+
+    records = load_recording(args.recording)
+    if not records:
+        sys.exit("Recording is empty")
+
+    tracemalloc.start()
+    ops_before = mongo_operations(metrics)
+    cpu_before = time.process_time()
+    with open(os.devnull, 'w') as devnull:
+        stdout, sys.stdout = sys.stdout, devnull
+        try:
+            elapsed = await replay(bot.dp, records, args.pace, args.concurrency)
+        finally:
+            sys.stdout = stdout
+    cpu = time.process_time() - cpu_before
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    count = len(records)
+
+    report = {
+        'updates': count,
+        'pace': args.pace,
+        'wall_seconds': round(elapsed, 3),
+        'cpu_ms_per_update': round(cpu * 1000 / count, 3),
+        'mongo_ops_per_update': round((mongo_operations(metrics) - ops_before) / count, 3),
+        'api_calls_per_update': round(sum(fake.calls.values()) / count, 3),
+        'retained_kib_per_update': round(current / 1024 / count, 3),
+        'peak_traced_kib': round(peak / 1024, 1),
+    }
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    for key, value in report.items():
+        line = f"{key:<26}{value}"
+        if baseline and isinstance(value, (int, float)) and baseline.get(key):
+            line += f"  ({(value - baseline[key]) / baseline[key] * 100:+.1f}% vs baseline)"
+        print(line)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2)
+    return report
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Replay recorded updates against this build")
+    parser.add_argument('recording', help="NDJSON file written by UpdateRecorder")
+    parser.add_argument('--pace', choices=['fast', 'original'], default='fast')
+    parser.add_argument('--concurrency', type=int, default=1, help="parallel updates in fast mode")
+    parser.add_argument('--no-throttle', action='store_true', help="remove the throttling middleware")
+    parser.add_argument('--json', help="write the report to this file")
+    parser.add_argument('--compare', help="previous JSON report to compare against")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    os.environ.setdefault('MONGODB_DATABASE', 'kaoka_replay')
+    os.environ.setdefault('TELEGRAM_API_TOKEN', '123456:REPLAY')
+    if os.environ['MONGODB_DATABASE'] == 'baraboba':
+        sys.exit("Refusing to replay against the production database, set MONGODB_DATABASE")
+    asyncio.run(main(parse_args()))
@@ -0,0 +1,199 @@
+import logging
+import random
+import time
+
+import database as db
+import hosting
+from config import SAMPLER_DRAWS
+
+
+# Configure logger
+logger = logging.getLogger(__name__)
+
+# Tree holding every eligible profile regardless of city
+ANY_CITY = None
+FORM_PROJECTION = {'chat_id': 1, 'name': 1, 'photo': 1, 'city': 1}
+
+
+class FenwickTree:
+    """Prefix sums over integer weights with O(log n) update and weighted search"""
+
+    def __init__(self):
+        self.weights = []
+        self._tree = [0]  # 1-indexed
+        self.total = 0
+
+    def __len__(self):
+        return len(self.weights)
+
+    def _prefix(self, n):
+        """Sum of the first n weights"""
+        result = 0
+        while n > 0:
+            result += self._tree[n]
+            n -= n & -n
+        return result
+
+    def append(self, weight):
+        """Add a slot at the end, returns its index"""
+        n = len(self.weights) + 1
+        # Node n covers the weights (n - lowbit(n), n]
+        self._tree.append(self._prefix(n - 1) - self._prefix(n - (n & -n)) + weight)
+        self.weights.append(weight)
+        self.total += weight
+        return n - 1
+
+    def set(self, index, weight):
+        delta = weight - self.weights[index]
+        if not delta:
+            return
+        self.weights[index] = weight
+        self.total += delta
+        n = index + 1
+        while n < len(self._tree):
+            self._tree[n] += delta
+            n += n & -n
+
+    def find(self, value):
+        """Index of the slot where the running sum passes value, 0 <= value < total"""
+        position = 0
+        mask = 1 << (len(self.weights).bit_length() - 1) if self.weights else 0
+        while mask:
+            following = position + mask
+            if following <= len(self.weights) and self._tree[following] <= value:
+                position = following
+                value -= self._tree[following]
+            mask >>= 1
+        return position
+
+
+class WeightedSampler:
+    """Per-city trees of eligible profiles weighted by their active credit"""
+
+    def __init__(self):
+        self.ready = False
+        self._trees = {}
+        self._ids = {}
+        self._slots = {}
+        self._cities = {}
+        self._pending = None  # Changes seen while a rebuild is loading
+
+    @staticmethod
+    def weight(profile):
+        """Views a profile is entitled to, 0 when it must not be shown"""
+        if not profile or profile.get('block', 0) == 1:
+            return 0
+        return max(int(profile.get('active', 0) or 0), 0)
+
+    def _set(self, key, chat_id, weight):
+        tree = self._trees.get(key)
+        if tree is None:
+            if not weight:
+                return
+            tree = self._trees[key] = FenwickTree()
+            self._ids[key] = []
+            self._slots[key] = {}
+        slot = self._slots[key].get(chat_id)
+        if slot is not None:
+            tree.set(slot, weight)
+        elif weight:
+            self._slots[key][chat_id] = tree.append(weight)
+            self._ids[key].append(chat_id)
+
+    def update(self, chat_id, profile):
+        """Apply a profile change, profile None removes it"""
+        if self._pending is not None:
+            self._pending.append((chat_id, profile))
+        weight = self.weight(profile)
+        city = db.city_key(profile.get('city')) if profile else None
+        previous = self._cities.get(chat_id)
+        if previous is not None and previous != city:
+            self._set(previous, chat_id, 0)
+        if city is not None:
+            self._cities[chat_id] = city
+            self._set(city, chat_id, weight)
+        else:
+            self._cities.pop(chat_id, None)
+        self._set(ANY_CITY, chat_id, weight)
+
+    def draw(self, city, count):
+        """Up to count distinct chat ids, proportional to their weight"""
+        key = db.city_key(city) if city is not None else ANY_CITY
+        tree = self._trees.get(key)
+        if tree is None or not tree.total:
+            return []
+        ids = self._ids[key]
+        return list(dict.fromkeys(ids[tree.find(random.randrange(tree.total))] for _ in range(count)))
+
+    async def rebuild(self):
+        """Load every eligible profile, compacting slots of removed ones"""
+        start = time.perf_counter()
+        fresh = WeightedSampler()
+        self._pending = []
+        try:
+            async with db.db_operation("sampler_rebuild", background=True):
+                cursor = db.posts.find(
+                    {'block': {'$ne': 1}, 'active': {'$gt': 0}},
+                    {'chat_id': 1, 'city': 1, 'active': 1, 'block': 1},
+                ).batch_size(5000)
+                async for doc in cursor:
+                    fresh.update(doc['chat_id'], doc)
+            # Replay changes committed while loading, then swap in one step
+            for chat_id, profile in self._pending:
+                fresh.update(chat_id, profile)
+        finally:
+            self._pending = None
+        self._trees, self._ids, self._slots, self._cities = fresh._trees, fresh._ids, fresh._slots, fresh._cities
+        self.ready = True
+        logger.info(f"Sampler rebuilt with {len(self._cities)} profiles in {time.perf_counter() - start:.2f}s")
+
+    async def _pick(self, chat_id, city, exclude):
+        # Draw extra to make up for the excluded ones, heavy profiles come up often
+        candidates = [
+            candidate for candidate in self.draw(city, SAMPLER_DRAWS + len(exclude))
+            if candidate != chat_id and candidate not in exclude
+        ][:SAMPLER_DRAWS]
+        if not candidates:
+            return None
+        query = {
+            'chat_id': {'$in': candidates},
+            'by.id': {'$ne': chat_id},
+            'block': {'$ne': 1},
+            'active': {'$ne': 0},
+        }
+        try:
+            async with db.db_operation("sampler_pick"):
+                found = {doc['chat_id']: doc async for doc in db.posts.find(query, FORM_PROJECTION)}
+        except db.UNAVAILABLE:
+            # Degraded mode, pick among the drawn profiles still in the document cache
+            found = {}
+            for candidate in candidates:
+                doc = db.get_cached(candidate)
+                if doc and not any(item.get('id') == chat_id for item in doc.get('by', [])):
+                    found[candidate] = doc
+        # Keep the weighted draw order
+        return next((found[candidate] for candidate in candidates if candidate in found), None)
+
+    async def get_form(self, chat_id, city, exclude=()):
+        """Same contract as database.get_random_form, without aggregating the collection"""
+        exclude = set(exclude)
+        if self.ready:
+            for scope in (city, ANY_CITY):
+                form = await self._pick(chat_id, scope, exclude)
+                if form:
+                    return [form]
+        # Not built yet, or the user has rated or recently seen most of the drawn profiles
+        form = await db.get_random_form(chat_id, city, list(exclude))
+        if not form and exclude:
+            # Showing a recently seen profile again beats running out
+            form = await db.get_random_form(chat_id, city)
+        return form
+
+
+# One per hosted bot namespace, see hosting.py
+sampler = hosting.BotLocal(lambda config: WeightedSampler())
+
+
+@db.on_profile_change
+def update_sampler(chat_id, profile):
+    sampler.update(chat_id, profile)
@@ -0,0 +1,254 @@
+import asyncio
+import logging
+import os
+import random
+import socket
+import time
+from datetime import datetime, timedelta
+
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
+import database as db
+import metrics
+
+
+# Configure logger
+logger = logging.getLogger(__name__)
+
+# Identifies this process in leases
+INSTANCE = f"{socket.gethostname()}:{os.getpid()}"
+
+
+class Interval:
+    """Run every N seconds"""
+
+    def __init__(self, seconds):
+        self.seconds = seconds
+
+    def first(self, now):
+        # Instances restarted together don't all run the job at once
+        return self.next(now)
+
+    def next(self, after):
+        return after + timedelta(seconds=self.seconds)
+
+    def __str__(self):
+        return f"every {self.seconds}s"
+
+
+def _parse_field(field, low, high):
+    """Expand one cron field: *, */n, a-b, a-b/n and comma separated lists"""
+    values = set()
+    for part in field.split(','):
+        step = 1
+        if '/' in part:
+            part, step = part.split('/')
+            step = int(step)
+        if part == '*':
+            start, end = low, high
+        elif '-' in part:
+            start, end = map(int, part.split('-'))
+        else:
+            start = end = int(part)
+        if start < low or end > high:
+            raise ValueError(f"Cron value out of range {low}-{high}: {field}")
+        values.update(range(start, end + 1, step))
+    return values
+
+
+class Cron:
+    """Five field cron expression in UTC: minute hour day-of-month month day-of-week (0 = Monday),
+    unlike classic cron a restricted day-of-month and day-of-week must both match"""
+
+    def __init__(self, expression):
+        self.expression = expression
+        fields = expression.split()
+        if len(fields) != 5:
+            raise ValueError(f"Cron expression needs 5 fields: {expression}")
+        self.minutes = _parse_field(fields[0], 0, 59)
+        self.hours = _parse_field(fields[1], 0, 23)
+        self.days = _parse_field(fields[2], 1, 31)
+        self.months = _parse_field(fields[3], 1, 12)
+        self.weekdays = _parse_field(fields[4], 0, 6)
+
+    def first(self, now):
+        return self.next(now)
+
+    def next(self, after):
+        moment = after.replace(second=0, microsecond=0) + timedelta(minutes=1)
+        limit = moment + timedelta(days=366 * 5)
+        while moment < limit:
+            if moment.month not in self.months:
+                moment = (moment.replace(day=1, hour=0, minute=0) + timedelta(days=32)).replace(day=1)
+            elif moment.day not in self.days or moment.weekday() not in self.weekdays:
+                moment = moment.replace(hour=0, minute=0) + timedelta(days=1)
+            elif moment.hour not in self.hours:
+                moment = moment.replace(minute=0) + timedelta(hours=1)
+            elif moment.minute not in self.minutes:
+                moment += timedelta(minutes=1)
+            else:
+                return moment
+        raise ValueError(f"Cron expression never fires: {self.expression}")
+
+    def __str__(self):
+        return f"cron {self.expression}"
+
+
+class Job:
+    """A periodic coroutine function with its trigger and last run status"""
+
+    def __init__(self, name, func, trigger, timeout=300, jitter=0, exclusive=True, initial_delay=None):
+        self.name = name
+        self.func = func
+        self.trigger = trigger
+        self.timeout = timeout
+        self.jitter = jitter
+        self.exclusive = exclusive
+        self.initial_delay = initial_delay
+        self.next_run = None
+        self.last_run = None
+        self.last_status = None
+        self.last_duration = None
+        self.owner = None
+
+
+class Scheduler:
+    """Runs jobs on their triggers, exclusive jobs on one instance through Mongo leases"""
+
+    def __init__(self, instance=INSTANCE):
+        self.instance = instance
+        self.jobs = {}
+        self._tasks = []
+
+    def add(self, name, func, trigger, timeout=300, jitter=0, exclusive=True, initial_delay=None):
+        """Register a job, exclusive jobs run on a single instance at a time. The first run is
+        initial_delay seconds after start when given, otherwise when the trigger first fires"""
+        self.jobs[name] = Job(name, func, trigger, timeout, jitter, exclusive, initial_delay)
+
+    def every(self, seconds, name=None, **options):
+        """Decorator form of add with an interval trigger"""
+        def decorator(func):
+            self.add(name or func.__name__, func, Interval(seconds), **options)
+            return func
+        return decorator
+
+    async def _acquire(self, job, until):
+        """Hold the job's lease until its next run, returns False if another instance has it"""
+        now = datetime.utcnow()
+        async with db.db_operation("lease_acquire"):
+            try:
+                await db.leases.find_one_and_update(
+                    {'_id': job.name, '$or': [{'expireAt': {'$lt': now}}, {'owner': self.instance}]},
+                    {'$set': {'owner': self.instance, 'expireAt': until}},
+                    upsert=True,
+                    return_document=ReturnDocument.AFTER,
+                )
+                return True
+            except DuplicateKeyError:
+                # The lease exists and belongs to a live instance
+                return False
+
+    async def _record(self, job):
+        async with db.db_operation("lease_record"):
+            await db.leases.update_one({'_id': job.name}, {'$set': {
+                'last_run': job.last_run,
+                'last_status': job.last_status,
+                'last_duration': job.last_duration,
+            }})
+
+    async def run_job(self, job):
+        """Run a job once with its timeout and record the outcome"""
+        job.last_run = datetime.utcnow()
+        job.owner = self.instance
+        start = time.perf_counter()
+        try:
+            await asyncio.wait_for(job.func(), job.timeout)
+            job.last_status = "ok"
+            metrics.JOB_LAST_SUCCESS.set(time.time(), job=job.name)
+        except asyncio.TimeoutError:
+            job.last_status = "timeout"
+            logger.error(f"Job {job.name} timed out after {job.timeout}s")
+        except Exception as e:
+            job.last_status = f"error: {str(e)}"
+            logger.error(f"Job {job.name} failed: {str(e)}")
+        job.last_duration = time.perf_counter() - start
+        metrics.JOB_SECONDS.observe(job.last_duration, job=job.name)
+        metrics.JOB_RUNS.inc(job=job.name, status=job.last_status.split(':')[0])
+        if job.exclusive:
+            try:
+                await self._record(job)
+            except Exception:
+                pass
+
+    async def _loop(self, job):
+        now = datetime.utcnow()
+        if job.initial_delay is not None:
+            job.next_run = now + timedelta(seconds=job.initial_delay)
+        else:
+            job.next_run = job.trigger.first(now)
+        while True:
+            delay = (job.next_run - datetime.utcnow()).total_seconds() + random.uniform(0, job.jitter)
+            if delay > 0:
+                await asyncio.sleep(delay)
+            now = datetime.utcnow()
+            job.next_run = job.trigger.next(now)
+            if job.exclusive:
+                # Keep the lease for the whole period so no other instance runs it again,
+                # but at least as long as the job may take
+                until = max(job.next_run, now + timedelta(seconds=job.timeout))
+                try:
+                    acquired = await self._acquire(job, until)
+                except Exception:
+                    acquired = False
+                if not acquired:
+                    continue
+            await self.run_job(job)
+
+    def start(self):
+        """Start a loop per job, call once the event loop is running"""
+        for job in self.jobs.values():
+            self._tasks.append(asyncio.create_task(self._loop(job)))
+        logger.info(f"Scheduler started {len(self.jobs)} jobs as {self.instance}")
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        # Let another instance take over right away
+        names = [job.name for job in self.jobs.values() if job.exclusive]
+        try:
+            async with db.db_operation("lease_release"):
+                await db.leases.update_many(
+                    {'_id': {'$in': names}, 'owner': self.instance},
+                    {'$set': {'expireAt': datetime.utcnow()}},
+                )
+        except db.UNAVAILABLE:
+            logger.warning("MongoDB is unavailable, leases expire on their own")
+
+    async def status(self):
+        """Job lines for /admin, exclusive jobs show the last run on any instance"""
+        try:
+            async with db.db_operation("lease_status"):
+                leases = {doc['_id']: doc async for doc in db.leases.find({'_id': {'$in': list(self.jobs)}})}
+        except db.UNAVAILABLE:
+            # Runs of this instance only
+            logger.warning("MongoDB is unavailable, job status is taken from this instance")
+            leases = {}
+        now = datetime.utcnow()
+        lines = []
+        for job in self.jobs.values():
+            state = leases.get(job.name, {}) if job.exclusive else {}
+            last_run = state.get('last_run', job.last_run)
+            if last_run is None:
+                lines.append(f"{job.name} ({job.trigger}): ещё не запускалась")
+                continue
+            ago = int((now - last_run).total_seconds())
+            duration = state.get('last_duration', job.last_duration) or 0
+            owner = f", {state['owner']}" if state.get('owner') else ""
+            lines.append(
+                f"{job.name} ({job.trigger}): {state.get('last_status', job.last_status)}, "
+                f"{duration:.1f}с, {ago}с назад{owner}"
+            )
+        return "\n".join(lines)
@@ -0,0 +1,33 @@
+import time
+
+from aiogram.dispatcher import FSMContext
+
+from config import SEEN_SIZE, SEEN_TTL
+
+
+class RecentlySeen:
+    """Per-user ring buffer of recently shown profiles, kept in the FSM storage bucket
+    so it survives state.finish() and lives as long as the FSM storage does"""
+
+    def __init__(self, size=SEEN_SIZE, ttl=SEEN_TTL):
+        self.size = size
+        self.ttl = ttl
+
+    async def _load(self, state: FSMContext):
+        bucket = await state.storage.get_bucket(chat=state.chat, user=state.user)
+        cutoff = time.time() - self.ttl
+        # Old entries decay, a profile skipped hours ago may be shown again
+        return [entry for entry in bucket.get('seen', []) if entry[1] > cutoff]
+
+    async def get(self, state: FSMContext):
+        """Chat ids shown to this user within the TTL, oldest first"""
+        return [chat_id for chat_id, _ in await self._load(state)]
+
+    async def add(self, state: FSMContext, chat_id):
+        """Remember a shown profile, the oldest one is forgotten once the buffer is full"""
+        entries = [entry for entry in await self._load(state) if entry[0] != chat_id]
+        entries.append([chat_id, time.time()])
+        await state.storage.update_bucket(chat=state.chat, user=state.user, bucket={'seen': entries[-self.size:]})
+
+
+recently_seen = RecentlySeen()
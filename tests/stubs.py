@@ -0,0 +1,53 @@
+"""Stand-ins for Motor collections and cursors shared by the tests"""
+from pymongo.errors import AutoReconnect
+
+
+class DownCursor:
+    """Cursor of an unreachable MongoDB, fails once iterated"""
+
+    def __getattr__(self, name):
+        # sort, limit, batch_size and the like
+        return lambda *args, **kwargs: self
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        raise AutoReconnect("down")
+
+
+class DownCollection:
+    """Collection of an unreachable MongoDB"""
+
+    def find(self, *args, **kwargs):
+        return DownCursor()
+
+    def aggregate(self, *args, **kwargs):
+        return DownCursor()
+
+    def __getattr__(self, name):
+        async def fail(*args, **kwargs):
+            raise AutoReconnect("down")
+        return fail
+
+
+class ListCursor:
+    """Cursor over docs, on_next runs before each document like a concurrent write"""
+
+    def __init__(self, docs, on_next=None):
+        self.docs = iter(docs)
+        self.on_next = on_next
+
+    def batch_size(self, size):
+        return self
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if self.on_next:
+            self.on_next()
+        try:
+            return next(self.docs)
+        except StopIteration:
+            raise StopAsyncIteration
@@ -0,0 +1,97 @@
+import asyncio
+import os
+import unittest
+from unittest import mock
+
+os.environ.setdefault('TELEGRAM_API_TOKEN', '1:test')
+
+from aiogram.dispatcher.handler import CancelHandler, current_handler  # noqa: E402
+
+from admission import HIGH, LOW, NORMAL, AdmissionController, AdmissionMiddleware, priority  # noqa: E402
+
+
+class AdmissionControllerTest(unittest.IsolatedAsyncioTestCase):
+
+    async def test_slots_are_capped(self):
+        controller = AdmissionController(limit=2, budget=0.05, max_queue=10)
+        self.assertTrue(await controller.acquire(NORMAL))
+        self.assertTrue(await controller.acquire(NORMAL))
+        # Full for longer than the queue budget
+        self.assertFalse(await controller.acquire(NORMAL))
+        controller.release()
+        self.assertTrue(await controller.acquire(NORMAL))
+        self.assertEqual((controller.in_flight, controller.queued), (2, 0))
+
+    async def test_free_slot_goes_to_the_highest_priority(self):
+        controller = AdmissionController(limit=1, budget=1, max_queue=10)
+        await controller.acquire(NORMAL)
+        order = []
+
+        async def wait(level, name):
+            if await controller.acquire(level):
+                order.append(name)
+                controller.release()
+
+        levels = ((LOW, "low"), (NORMAL, "normal"), (HIGH, "high"))
+        waiters = [asyncio.create_task(wait(level, name)) for level, name in levels]
+        await asyncio.sleep(0)
+        controller.release()
+        await asyncio.gather(*waiters)
+        self.assertEqual(order, ["high", "normal", "low"])
+        self.assertEqual(controller.in_flight, 0)
+
+    async def test_full_queue_is_shed_at_once(self):
+        controller = AdmissionController(limit=1, budget=1, max_queue=1)
+        await controller.acquire(NORMAL)
+        queued = asyncio.create_task(controller.acquire(NORMAL))
+        await asyncio.sleep(0)
+        self.assertFalse(await asyncio.wait_for(controller.acquire(HIGH), 0.1))
+        controller.release()
+        self.assertTrue(await queued)
+
+    async def test_cancelled_waiter_keeps_no_slot(self):
+        controller = AdmissionController(limit=1, budget=1, max_queue=10)
+        await controller.acquire(NORMAL)
+        waiter = asyncio.create_task(controller.acquire(NORMAL))
+        await asyncio.sleep(0)
+        waiter.cancel()
+        await asyncio.gather(waiter, return_exceptions=True)
+        controller.release()
+        self.assertEqual((controller.in_flight, controller.queued), (0, 0))
+        self.assertTrue(await controller.acquire(NORMAL))
+
+
+class AdmissionMiddlewareTest(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        self.controller = AdmissionController(limit=1, budget=0.05, max_queue=10)
+        self.middleware = AdmissionMiddleware(self.controller)
+
+    async def test_handler_priority(self):
+        @priority(lambda message: HIGH if message.text == "/start" else LOW)
+        async def handler(message):
+            pass
+
+        current_handler.set(handler)
+        self.controller.acquire = mock.AsyncMock(return_value=True)
+        await self.middleware._admit(mock.Mock(text="/start"), {}, NORMAL)
+        await self.middleware._admit(mock.Mock(text="7"), {}, NORMAL)
+        self.assertEqual([call.args[0] for call in self.controller.acquire.call_args_list], [HIGH, LOW])
+
+    async def test_slot_is_released_after_the_handler(self):
+        current_handler.set(None)
+        data = {}
+        await self.middleware.on_process_message(mock.Mock(), data)
+        self.assertEqual(self.controller.in_flight, 1)
+        message = mock.Mock(answer=mock.AsyncMock())
+        with self.assertRaises(CancelHandler):
+            await self.middleware.on_process_message(message, {})
+        message.answer.assert_awaited_once()
+        await self.middleware.on_post_process_message(mock.Mock(), [], data)
+        # A shed update has nothing to release
+        await self.middleware.on_post_process_message(mock.Mock(), [], {})
+        self.assertEqual(self.controller.in_flight, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,81 @@
+import os
+import unittest
+from unittest import mock
+
+os.environ.setdefault('TELEGRAM_API_TOKEN', '1:test')
+
+import breaker  # noqa: E402
+from breaker import CLOSED, HALF_OPEN, OPEN, CircuitBreaker, DatabaseUnavailable  # noqa: E402
+
+
+class CircuitBreakerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 100.0
+        patcher = mock.patch.object(breaker.time, 'monotonic', lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.circuit = CircuitBreaker(window=4, failure_rate=0.5, slow_call=1, reset_timeout=10)
+        self.changes = []
+        self.circuit.on_change(lambda old, new: self.changes.append((old, new)))
+
+    def test_opens_on_failures(self):
+        self.circuit.record(True, 0)
+        # Too few outcomes to judge
+        self.assertEqual(self.circuit.state, CLOSED)
+        self.circuit.record(False, 0)
+        self.assertEqual(self.circuit.state, OPEN)
+        with self.assertRaises(DatabaseUnavailable):
+            self.circuit.check("find_one")
+
+    def test_opens_on_slow_calls(self):
+        for _ in range(4):
+            self.circuit.record(False, 0.1)
+        self.circuit.record(False, 2, budget=False)
+        self.assertEqual(self.circuit.state, CLOSED)
+        self.circuit.record(False, 2)
+        self.circuit.record(False, 2)
+        self.assertEqual(self.circuit.state, OPEN)
+
+    def test_probe_closes_the_circuit(self):
+        self.circuit.record(True, 0)
+        self.circuit.record(True, 0)
+        self.now += 10
+        self.circuit.check("find_one")
+        self.assertEqual(self.circuit.state, HALF_OPEN)
+        # One probe at a time
+        with self.assertRaises(DatabaseUnavailable):
+            self.circuit.check("find_one")
+        self.circuit.record(False, 0)
+        self.assertEqual(self.circuit.state, CLOSED)
+        self.circuit.check("find_one")
+        self.assertEqual(self.changes, [(CLOSED, OPEN), (OPEN, HALF_OPEN), (HALF_OPEN, CLOSED)])
+
+    def test_failed_probe_reopens(self):
+        self.circuit.record(True, 0)
+        self.circuit.record(True, 0)
+        self.now += 10
+        self.circuit.check("find_one")
+        self.circuit.record(True, 0)
+        self.assertEqual(self.circuit.state, OPEN)
+        with self.assertRaises(DatabaseUnavailable):
+            self.circuit.check("find_one")
+
+    def test_lost_probe_is_replaced(self):
+        self.circuit.record(True, 0)
+        self.circuit.record(True, 0)
+        self.now += 10
+        self.circuit.check("find_one")
+        self.now += 10
+        self.circuit.check("find_one")
+        self.assertEqual(self.circuit.state, HALF_OPEN)
+
+    def test_failing_listener_is_ignored(self):
+        self.circuit.on_change(mock.Mock(side_effect=RuntimeError))
+        self.circuit.record(True, 0)
+        self.circuit.record(True, 0)
+        self.assertEqual(self.changes, [(CLOSED, OPEN)])
+
+
+if __name__ == '__main__':
+    unittest.main()
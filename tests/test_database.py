@@ -0,0 +1,109 @@
+import os
+import time
+import unittest
+from unittest import mock
+
+os.environ.setdefault('TELEGRAM_API_TOKEN', '1:test')
+
+import database as db  # noqa: E402
+from breaker import CircuitBreaker  # noqa: E402
+from pymongo.errors import AutoReconnect  # noqa: E402
+from stubs import DownCollection, ListCursor  # noqa: E402
+
+
+class RecordingCollection:
+    """Collection remembering the updates it gets"""
+
+    def __init__(self):
+        self.updates = []
+
+    async def update_one(self, query, update, upsert=False):
+        self.updates.append(update)
+
+    async def find_one_and_update(self, query, update, projection=None):
+        self.updates.append(update)
+        return None
+
+
+class ChangeFieldTest(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        self.posts = RecordingCollection()
+        patcher = mock.patch.object(db, 'posts', self.posts)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    async def test_recomputed_fields_keep_updated(self):
+        await db.change_field(1, 'mark', 7.5)
+        await db.change_field(1, 'count', 3)
+        self.assertEqual(self.posts.updates, [{'$set': {'mark': 7.5}}, {'$set': {'count': 3}}])
+
+    async def test_moderated_fields_stamp_updated(self):
+        await db.change_field(1, 'name', "Анна")
+        self.assertIn('updated', self.posts.updates[0]['$set'])
+
+    async def test_only_comments_stamp_updated(self):
+        with mock.patch.object(db, 'record_stats', mock.AsyncMock()):
+            await db.update_by(1, 2, 7, None)
+            await db.update_by(1, 2, 7, "привет")
+        self.assertNotIn('$set', self.posts.updates[0])
+        self.assertIn('updated', self.posts.updates[1]['$set'])
+
+
+class DegradedReadTest(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        for patcher in (
+            mock.patch.object(db, 'posts', DownCollection()),
+            mock.patch.object(db, 'circuit', CircuitBreaker()),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.addCleanup(db._document_cache.clear)
+
+    async def test_expired_profile_is_served(self):
+        doc = {'chat_id': 1, 'name': "Анна"}
+        db._document_cache[1] = (doc, time.time() - db._cache_ttl - 1)
+        self.assertEqual(await db.get_document(1), doc)
+        self.assertEqual(db.get_cached(1), doc)
+
+    async def test_too_old_profile_is_not_served(self):
+        db._document_cache[1] = ({'chat_id': 1}, time.time() - db.CACHE_STALE_TTL - 1)
+        with self.assertRaises(AutoReconnect):
+            await db.get_document(1)
+
+    async def test_uncached_profile_raises(self):
+        with self.assertRaises(AutoReconnect):
+            await db.get_document(2)
+        self.assertIsNone(db.get_cached(2))
+
+
+class BulkChangeFieldTest(unittest.IsolatedAsyncioTestCase):
+
+    async def test_counts_and_stats(self):
+        posts = mock.Mock()
+        posts.find.return_value = ListCursor([
+            {'chat_id': 1, 'block': 0, 'city': "Москва"},
+            {'chat_id': 2, 'block': 1, 'city': "Москва"},
+            {'chat_id': 3, 'block': 0, 'city': "Казань"},
+        ])
+        posts.bulk_write = mock.AsyncMock(return_value=mock.Mock(matched_count=3, modified_count=2))
+        record_stats = mock.AsyncMock()
+        with mock.patch.object(db, 'posts', posts), mock.patch.object(db, 'circuit', CircuitBreaker()), \
+                mock.patch.object(db, 'record_stats', record_stats):
+            result = await db.bulk_change_field([1, 2, 4, 1, 3], 'block', 1)
+        self.assertEqual(result, (3, 2, [4]))
+        self.assertEqual([op._filter['chat_id'] for op in posts.bulk_write.call_args[0][0]], [1, 2, 4, 3])
+        # 2 was already banned
+        record_stats.assert_has_awaits([
+            mock.call("москва", 'banned', event_count=1, banned=1),
+            mock.call("казань", 'banned', event_count=1, banned=1),
+        ], any_order=True)
+        self.assertEqual(record_stats.await_count, 2)
+
+    async def test_no_ids(self):
+        self.assertEqual(await db.bulk_change_field([], 'block', 1), (0, 0, []))
+
+
+if __name__ == '__main__':
+    unittest.main()
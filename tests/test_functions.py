@@ -0,0 +1,27 @@
+import os
+import unittest
+
+os.environ.setdefault('TELEGRAM_API_TOKEN', '1:test')
+
+from functions import parse_ids  # noqa: E402
+
+
+class ParseIdsTest(unittest.TestCase):
+
+    def test_separators(self):
+        self.assertEqual(parse_ids("1 2,3;4\n5\t 6 ,, 7"), ([1, 2, 3, 4, 5, 6, 7], []))
+        self.assertEqual(parse_ids(" \n"), ([], []))
+
+    def test_repeats_keep_the_first_place(self):
+        self.assertEqual(parse_ids("3 1 3 2 1"), ([3, 1, 2], []))
+
+    def test_invalid_tokens(self):
+        self.assertEqual(parse_ids("12 -5 abc 7.0 +8 13"), ([12, 13], ["-5", "abc", "7.0", "+8"]))
+
+    def test_only_ascii_digits(self):
+        # Arabic-Indic and fullwidth digits pass str.isdecimal
+        self.assertEqual(parse_ids("١٢٣ １２ ²"), ([], ["١٢٣", "１２", "²"]))
+
+
+if __name__ == '__main__':
+    unittest.main()
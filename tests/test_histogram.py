@@ -0,0 +1,68 @@
+import os
+import random
+import statistics
+import unittest
+from unittest import mock
+
+os.environ.setdefault('TELEGRAM_API_TOKEN', '1:test')
+
+import database as db  # noqa: E402
+import functions  # noqa: E402
+import migrations  # noqa: E402
+from breaker import CircuitBreaker  # noqa: E402
+from stubs import ListCursor  # noqa: E402
+
+
+class MarkHistogramTest(unittest.TestCase):
+
+    def test_counters(self):
+        ratings = [{'mark': 7}, {'mark': "10"}, {'mark': 7}, {'mark': None}, {'mark': 11}, {}]
+        self.assertEqual(db.mark_histogram(ratings), [0, 0, 0, 0, 0, 0, 2, 0, 0, 1])
+
+    def test_stats_match_the_ratings(self):
+        rng = random.Random(3)
+        for _ in range(50):
+            marks = [rng.randint(1, 10) for _ in range(rng.randint(1, 40))]
+            stats = functions.mark_stats(db.mark_histogram([{'mark': mark} for mark in marks]))
+            self.assertEqual(stats['count'], len(marks))
+            self.assertEqual(stats['mean'], round(statistics.mean(marks), 2))
+            ordered = sorted(marks)
+            # Nearest-rank percentiles
+            self.assertEqual(stats['median'], ordered[max(-(-len(marks) // 2), 1) - 1])
+            self.assertEqual(stats['p90'], ordered[-(-len(marks) * 9 // 10) - 1])
+
+    def test_no_ratings(self):
+        self.assertEqual(functions.mark_stats([0] * 10), {'count': 0, 'mean': 0.0, 'median': 0, 'p90': 0})
+        self.assertEqual(functions.format_histogram([0] * 10), "")
+        self.assertEqual(functions.format_histogram({'7': 1}), "")
+
+    def test_format(self):
+        lines = functions.format_histogram([0, 0, 0, 0, 1, 0, 0, 0, 0, 4], width=4).split("\n")
+        self.assertEqual(lines, ["10 ▇▇▇▇ 4", " 5 ▇ 1", "Медиана: 10, 90% оценок не выше 10"])
+
+
+class HistogramMigrationTest(unittest.IsolatedAsyncioTestCase):
+
+    async def test_writes_recheck_the_query(self):
+        posts = mock.Mock()
+        posts.find.return_value.sort.return_value.batch_size.return_value = ListCursor([{'_id': 1}, {'_id': 2}])
+        posts.bulk_write = mock.AsyncMock(return_value=mock.Mock(modified_count=2))
+        item = migrations.Migration(
+            3, "mark_histogram", migrations.MIGRATIONS[2].query, {'_id': 1}, migrations.mark_histogram, posts
+        )
+        with mock.patch.object(migrations, 'get_checkpoint', mock.AsyncMock(return_value={})), \
+                mock.patch.object(migrations, 'save_checkpoint', mock.AsyncMock()), \
+                mock.patch.object(db, 'circuit', CircuitBreaker()):
+            result = await migrations.run_migration(item)
+        self.assertEqual(result['modified'], 2)
+        ops = posts.bulk_write.call_args[0][0]
+        self.assertEqual(
+            [op._filter for op in ops],
+            [{'histogram': {'$not': {'$type': 'array'}}, '_id': doc_id} for doc_id in (1, 2)],
+        )
+        # Computed by the server from $by in the same write
+        self.assertEqual(ops[0]._doc, migrations.HISTOGRAM_PIPELINE)
+
+
+if __name__ == '__main__':
+    unittest.main()
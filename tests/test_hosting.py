@@ -0,0 +1,53 @@
+import contextvars
+import os
+import unittest
+
+os.environ.setdefault('TELEGRAM_API_TOKEN', '1:test')
+
+import hosting  # noqa: E402
+from aiogram import Bot  # noqa: E402
+
+
+def as_bot(bot, func, *args):
+    """Call func with bot as the current bot, like an update handled by it"""
+    def run():
+        Bot.set_current(bot)
+        return func(*args)
+    return contextvars.copy_context().run(run)
+
+
+class BotLocalTest(unittest.TestCase):
+
+    def setUp(self):
+        self.other = hosting.HostedBot(hosting.parse_bot('2:b@other'))
+        self.shared = hosting.HostedBot(hosting.parse_bot('3:c'))
+        self.cache = hosting.BotLocal(lambda config: {})
+
+    def test_dict_methods_reach_the_instance(self):
+        self.cache['a'] = 1
+        self.assertEqual(self.cache.get('a'), 1)
+        self.assertIsNone(self.cache.get('b'))
+        self.assertEqual(self.cache.get('b', 2), 2)
+        self.assertEqual(list(self.cache.items()), [('a', 1)])
+        self.assertIn('a', self.cache)
+        self.assertEqual(len(self.cache), 1)
+        self.assertEqual(self.cache.pop('a'), 1)
+        self.assertNotIn('a', self.cache)
+
+    def test_namespaces_are_separate(self):
+        self.cache['a'] = 'main'
+        as_bot(self.other, self.cache.__setitem__, 'a', 'other')
+        self.assertEqual(self.cache.get('a'), 'main')
+        # Attributes are looked up in the context of the bot
+        self.assertEqual(as_bot(self.other, lambda: self.cache.get('a')), 'other')
+        # Same database and collection as the main bot
+        self.assertEqual(as_bot(self.shared, lambda: self.cache.get('a')), 'main')
+        self.assertEqual(len(self.cache.instances()), 2)
+
+    def test_collection_names(self):
+        self.assertEqual(hosting.parse_bot('2:b@other').collection_name('bills'), 'bills')
+        self.assertEqual(hosting.parse_bot('3:c@other/girls').collection_name('bills'), 'girls.bills')
+
+
+if __name__ == '__main__':
+    unittest.main()
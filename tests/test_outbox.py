@@ -0,0 +1,179 @@
+import asyncio
+import copy
+import json
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+os.environ.setdefault('TELEGRAM_API_TOKEN', '1:test')
+
+import database as db  # noqa: E402
+from breaker import CircuitBreaker  # noqa: E402
+from outbox import RatingOutbox, WriteJournal  # noqa: E402
+from pymongo.errors import AutoReconnect  # noqa: E402
+from stubs import ListCursor  # noqa: E402
+
+
+def values(doc, key):
+    """Values a dotted key reaches, arrays are expanded like MongoDB does"""
+    found = [doc]
+    for part in key.split('.'):
+        found = [item for value in found for item in (value if isinstance(value, list) else [value])]
+        found = [value[part] for value in found if isinstance(value, dict) and part in value]
+    return [item for value in found for item in (value if isinstance(value, list) else [value])]
+
+
+def matches(doc, query):
+    for key, condition in query.items():
+        found = values(doc, key)
+        if not isinstance(condition, dict):
+            condition = {'$eq': condition}
+        for operator, arg in condition.items():
+            if operator == '$eq' and arg not in found:
+                return False
+            if operator == '$ne' and arg in found:
+                return False
+            if operator == '$in' and not set(found) & set(arg):
+                return False
+            if operator == '$gt' and not any(value > arg for value in found):
+                return False
+            if operator == '$not' and matches(doc, {key: arg}):
+                return False
+    return True
+
+
+class MemoryCollection:
+    """Profiles collection understanding the filters and updates of apply_ratings"""
+
+    def __init__(self, docs):
+        self.docs = docs
+        self.writes = 0
+
+    def find(self, query, projection=None):
+        return ListCursor([copy.deepcopy(doc) for doc in self.docs if matches(doc, query)])
+
+    async def bulk_write(self, ops, ordered=True):
+        self.writes += 1
+        for op in ops:
+            doc = next((doc for doc in self.docs if matches(doc, op._filter)), None)
+            if doc is None:
+                continue
+            for field, value in op._doc.get('$push', {}).items():
+                doc.setdefault(field, []).append(value)
+            for field, value in op._doc.get('$set', {}).items():
+                doc[field] = value
+            for field, value in op._doc.get('$inc', {}).items():
+                field, _, index = field.partition('.')
+                if index:
+                    doc[field][int(index)] += value
+                else:
+                    doc[field] = doc.get(field, 0) + value
+
+
+def profile(chat_id, active):
+    return {'chat_id': chat_id, 'active': active, 'count': 0, 'mark': 0.0, 'by': [], 'histogram': [0] * 10}
+
+
+class ApplyRatingsTest(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        self.posts = MemoryCollection([profile(1, 0), profile(2, 3), profile(3, 0)])
+        for patcher in (
+            mock.patch.object(db, 'posts', self.posts),
+            mock.patch.object(db, 'circuit', CircuitBreaker()),
+            mock.patch.object(db, 'record_stats', mock.AsyncMock()),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def doc(self, chat_id):
+        return next(doc for doc in self.posts.docs if doc['chat_id'] == chat_id)
+
+    async def test_applying_again_changes_nothing(self):
+        ratings = [("k1", 1, 2, "8", None), ("k2", 1, 3, "6", None), ("k3", 3, 2, "10", "привет")]
+        await db.apply_ratings("k1", ratings)
+        state = copy.deepcopy(self.posts.docs)
+        # Crash before commit, the same batch comes back
+        await db.apply_ratings("k1", ratings)
+        self.assertEqual(self.posts.docs, state)
+        self.assertEqual((self.doc(2)['count'], self.doc(2)['active'], self.doc(2)['mark']), (2, 1, 9.0))
+        # 3 had no views to spend
+        self.assertEqual((self.doc(3)['count'], self.doc(3)['active']), (1, 1))
+        self.assertEqual(self.doc(1)['active'], 2)
+
+    async def test_missing_profiles_earn_nothing(self):
+        await db.apply_ratings("k1", [("k1", 1, 9, "8", None), ("k2", 1, 2, "8", None)])
+        self.assertEqual(self.doc(1)['active'], 1)
+        await db.apply_ratings("k3", [("k3", 1, 9, "8", None), ("k4", 1, None, "8", None)])
+        self.assertEqual(self.doc(1)['active'], 1)
+        self.assertEqual(self.posts.writes, 2)
+
+
+class WriteJournalTest(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, "outbox.jsonl")
+
+    async def test_batches(self):
+        journal = WriteJournal(self.path)
+        keys = [await journal.append('rating', 1, chat_id, "7", None) for chat_id in (2, 3, 4)]
+        self.assertEqual(journal.pending, 3)
+        self.assertEqual([entry['id'] for entry in journal.begin(2)], keys[:2])
+        journal.commit(2)
+        self.assertEqual([entry['id'] for entry in journal.begin(2)], keys[2:])
+        journal.commit(1)
+        self.assertEqual(journal.pending, 0)
+        self.assertFalse(os.path.exists(self.path))
+
+    async def test_unfinished_batch_is_replayed(self):
+        journal = WriteJournal(self.path)
+        keys = [await journal.append('rating', 1, chat_id, "7", None) for chat_id in (2, 3, 4)]
+        journal.begin(2)
+        # Restart between begin and commit
+        journal = WriteJournal(self.path)
+        self.assertEqual(journal.pending, 3)
+        self.assertEqual([entry['id'] for entry in journal.begin(10)], keys[:2])
+        journal.commit(2)
+        self.assertEqual([entry['id'] for entry in journal.begin(10)], keys[2:])
+
+    async def test_torn_line_is_repaired(self):
+        journal = WriteJournal(self.path)
+        key = await journal.append('rating', 1, 2, "7", None)
+        with open(self.path, 'a') as f:
+            f.write('{"id": "torn", "op": "rat')
+        journal = WriteJournal(self.path)
+        last = await journal.append('rating', 1, 3, "7", None)
+        entries = journal.begin(10)
+        self.assertEqual([entry and entry['id'] for entry in entries], [key, None, last])
+
+    async def test_group_commit(self):
+        journal = WriteJournal(self.path)
+        with mock.patch.object(journal, '_write', wraps=journal._write) as write:
+            await asyncio.gather(*(journal.append('rating', 1, chat_id, "7", None) for chat_id in range(5)))
+        self.assertEqual(write.call_count, 1)
+        with open(self.path) as f:
+            self.assertEqual([json.loads(line)['args'][1] for line in f], list(range(5)))
+
+
+class RatingOutboxTest(unittest.IsolatedAsyncioTestCase):
+
+    async def test_batch_is_retried_with_the_same_key(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        apply_ratings = mock.AsyncMock(side_effect=[AutoReconnect("down"), None])
+        with mock.patch.object(db, 'circuit', CircuitBreaker()), \
+                mock.patch.object(db, 'apply_ratings', apply_ratings):
+            outbox = RatingOutbox(os.path.join(directory.name, "outbox.jsonl"), batch=10)
+            key = await outbox.submit(1, 2, "7", None)
+            self.assertFalse(await outbox.drain())
+            self.assertEqual(outbox.pending, 1)
+            self.assertTrue(await outbox.drain())
+        self.assertEqual(outbox.pending, 0)
+        self.assertEqual([call.args for call in apply_ratings.call_args_list], [(key, [(key, 1, 2, "7", None)])] * 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,151 @@
+import asyncio
+import os
+import threading
+import time
+import unittest
+from unittest import mock
+
+os.environ.setdefault('TELEGRAM_API_TOKEN', '1:test')
+
+import payments  # noqa: E402
+from payments import PaymentClient, PaymentReconciler  # noqa: E402
+
+
+class StubWallet:
+    """QIWI wallet answering from a status table, counting the calls it gets"""
+
+    def __init__(self, status="WAITING", delay=0):
+        self.status = status
+        self.delay = delay
+        self.created = 0
+        self.lookups = 0
+        self.release = threading.Event()
+        self.hang = False
+        self._lock = threading.Lock()
+
+    def create_p2p_bill(self, amount):
+        with self._lock:
+            self.created += 1
+            bill_id = f"bill{self.created}"
+        return {'payUrl': f"https://pay/{bill_id}", 'billId': bill_id}
+
+    def get_bill_status(self, bill_id):
+        with self._lock:
+            self.lookups += 1
+        if self.hang:
+            self.release.wait(5)
+        time.sleep(self.delay)
+        return {'status': self.status}
+
+
+class FakeBills:
+    """In-memory stand-in for the bill functions of database.py"""
+
+    def __init__(self):
+        self.bills = {}
+
+    async def add_bill(self, bill_id, chat_id, link, lifetime, first_check, bot_name=None):
+        self.bills.setdefault(bill_id, {'_id': bill_id, 'chat_id': chat_id, 'bot': bot_name, 'status': 'WAITING'})
+
+    async def close_bill(self, bill_id, status):
+        bill = self.bills[bill_id]
+        if bill['status'] != 'WAITING':
+            return False
+        bill['status'] = status
+        return True
+
+    async def reschedule_bill(self, bill_id, attempts, delay):
+        self.bills[bill_id]['attempts'] = attempts
+
+    async def get_due_bills(self, limit):
+        return [dict(bill) for bill in self.bills.values() if bill['status'] == 'WAITING'][:limit]
+
+
+class PaymentClientTest(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        self.wallet = StubWallet()
+        self.client = PaymentClient(lambda: self.wallet, max_workers=4, timeout=0.2)
+
+    def tearDown(self):
+        self.wallet.release.set()
+        self.client.close()
+
+    async def test_one_bill_per_chat(self):
+        link, bill_id = await self.client.create_bill(1)
+        self.assertEqual(await self.client.create_bill(1), (link, bill_id))
+        self.assertNotEqual((await self.client.create_bill(2))[1], bill_id)
+        self.assertEqual(self.wallet.created, 2)
+
+    async def test_paid_bill_is_not_reused(self):
+        _, bill_id = await self.client.create_bill(1)
+        self.client.forget(1)
+        self.assertNotEqual((await self.client.create_bill(1))[1], bill_id)
+
+    async def test_status_lookups_are_coalesced(self):
+        self.wallet.delay = 0.05
+        statuses = await asyncio.gather(*(self.client.get_status("bill1") for _ in range(10)))
+        self.assertEqual(statuses, ["WAITING"] * 10)
+        self.assertEqual(self.wallet.lookups, 1)
+        # Cached for STATUS_TTL afterwards
+        await self.client.get_status("bill1")
+        self.assertEqual(self.wallet.lookups, 1)
+
+    async def test_close(self):
+        await self.client.create_bill(1)
+        self.wallet.close = mock.Mock()
+        self.client.close()
+        self.wallet.close.assert_called_once_with()
+        # No more wallet calls once the worker threads are gone
+        self.assertEqual(await self.client.create_bill(2), (None, None))
+        self.assertEqual(self.wallet.created, 1)
+
+    async def test_timeout(self):
+        self.wallet.hang = True
+        start = time.perf_counter()
+        status = await self.client.get_status("bill1", retries=2, retry_delay=0)
+        self.assertIsNone(status)
+        self.assertEqual(self.wallet.lookups, 2)
+        self.assertLess(time.perf_counter() - start, 1)
+
+
+class PaymentReconcilerTest(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        self.wallet = StubWallet(status="PAID", delay=0.02)
+        self.client = PaymentClient(lambda: self.wallet, max_workers=4, timeout=1)
+        self.paid = []
+
+        async def on_paid(chat_id, bot_name):
+            self.paid.append((chat_id, bot_name))
+
+        self.bills = FakeBills()
+        patcher = mock.patch.object(payments, 'db', self.bills)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.reconciler = PaymentReconciler(self.client, on_paid)
+
+    def tearDown(self):
+        self.client.close()
+
+    async def test_vip_is_granted_once(self):
+        link, bill_id = await self.client.create_bill(7)
+        await self.reconciler.track(7, link, bill_id)
+        bill = self.bills.bills[bill_id]
+        # The user pressing "Я оплатил" while the background check runs
+        statuses = await asyncio.gather(self.reconciler.check(bill), self.reconciler.check(bill), self.reconciler.drain())
+        self.assertEqual(statuses[:2], ["PAID", "PAID"])
+        await self.reconciler.drain()
+        self.assertEqual(self.paid, [(7, payments.hosting.current().name)])
+        self.assertEqual(self.bills.bills[bill_id]['status'], "PAID")
+
+    async def test_pending_bill_is_rescheduled(self):
+        self.wallet.status = "WAITING"
+        await self.reconciler.track(8, "link", "bill8")
+        self.assertEqual(await self.reconciler.check(self.bills.bills["bill8"]), "WAITING")
+        self.assertEqual(self.bills.bills["bill8"]['attempts'], 1)
+        self.assertEqual(self.paid, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,74 @@
+import os
+import unittest
+from unittest import mock
+
+os.environ.setdefault('TELEGRAM_API_TOKEN', '1:test')
+
+import database as db  # noqa: E402
+from breaker import CircuitBreaker  # noqa: E402
+from ranking import MIN_RATINGS, Ranking  # noqa: E402
+from stubs import ListCursor  # noqa: E402
+
+
+def profile(mark, count=MIN_RATINGS, active=1, block=0):
+    return {'mark': mark, 'count': count, 'active': active, 'block': block}
+
+
+class RankingTest(unittest.TestCase):
+
+    def setUp(self):
+        self.ranking = Ranking()
+        self.ranking.ready = True
+
+    def test_places_and_ties(self):
+        for chat_id, mark in ((1, 7.5), (2, 9.0), (3, 7.5), (4, 5.0)):
+            self.ranking.update(chat_id, profile(mark))
+        self.assertEqual(self.ranking.rank(2), (1, 4))
+        self.assertEqual(self.ranking.rank(1), (2, 4))
+        self.assertEqual(self.ranking.rank(3), (2, 4))
+        self.assertEqual(self.ranking.rank(4), (4, 4))
+
+    def test_updates(self):
+        self.ranking.update(1, profile(5.0))
+        self.ranking.update(2, profile(6.0))
+        self.ranking.update(1, profile(8.0))
+        self.assertEqual(self.ranking.rank(1), (1, 2))
+        self.ranking.update(2, None)
+        self.assertEqual(self.ranking.rank(1), (1, 1))
+        self.assertIsNone(self.ranking.rank(2))
+
+    def test_ineligible_profiles(self):
+        self.ranking.update(1, profile(9.0, count=MIN_RATINGS - 1))
+        self.ranking.update(2, profile(9.0, active=0))
+        self.ranking.update(3, profile(9.0, block=1))
+        self.assertEqual([self.ranking.rank(chat_id) for chat_id in (1, 2, 3)], [None] * 3)
+
+    def test_describe(self):
+        self.ranking.update(1, profile(9.0))
+        self.assertEqual(self.ranking.describe(1), "🏆Место в рейтинге: 1 из 1")
+        self.ranking.ready = False
+        self.assertIn(str(MIN_RATINGS), self.ranking.describe(1))
+
+
+class RebuildTest(unittest.IsolatedAsyncioTestCase):
+
+    async def test_changes_during_rebuild_are_kept(self):
+        ranking = Ranking()
+        docs = [dict(profile(mark), chat_id=chat_id) for chat_id, mark in ((1, 6.0), (2, 7.0))]
+        writes = [lambda: None, lambda: ranking.update(1, profile(9.0)), lambda: ranking.update(3, profile(8.0))]
+
+        def on_next():
+            if writes:
+                writes.pop(0)()
+
+        posts = mock.Mock()
+        posts.find.return_value = ListCursor(docs, on_next)
+        with mock.patch.object(db, 'posts', posts), mock.patch.object(db, 'circuit', CircuitBreaker()):
+            await ranking.rebuild()
+        self.assertTrue(ranking.ready)
+        # The stale mark of 1 from the cursor is replaced by the change made meanwhile
+        self.assertEqual([ranking.rank(chat_id) for chat_id in (1, 3, 2)], [(1, 3), (2, 3), (3, 3)])
+
+
+if __name__ == '__main__':
+    unittest.main()
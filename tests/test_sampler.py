@@ -0,0 +1,107 @@
+import os
+import random
+import time
+import unittest
+from collections import Counter
+from unittest import mock
+
+os.environ.setdefault('TELEGRAM_API_TOKEN', '1:test')
+
+import database as db  # noqa: E402
+from breaker import CircuitBreaker  # noqa: E402
+from sampler import ANY_CITY, FenwickTree, WeightedSampler  # noqa: E402
+from stubs import DownCollection  # noqa: E402
+
+
+def slot_of(weights, value):
+    """Brute force FenwickTree.find"""
+    total = 0
+    for index, weight in enumerate(weights):
+        total += weight
+        if value < total:
+            return index
+
+
+class FenwickTreeTest(unittest.TestCase):
+
+    def test_matches_brute_force(self):
+        rng = random.Random(1)
+        tree = FenwickTree()
+        weights = []
+        for _ in range(200):
+            if weights and rng.random() < 0.4:
+                index = rng.randrange(len(weights))
+                weights[index] = rng.randrange(5)
+                tree.set(index, weights[index])
+            else:
+                weights.append(rng.randrange(5))
+                self.assertEqual(tree.append(weights[-1]), len(weights) - 1)
+            self.assertEqual(tree.total, sum(weights))
+            for value in range(tree.total):
+                self.assertEqual(tree.find(value), slot_of(weights, value))
+
+    def test_zero_weights_are_never_found(self):
+        tree = FenwickTree()
+        for weight in (0, 3, 0, 0, 1, 0):
+            tree.append(weight)
+        self.assertEqual({tree.find(value) for value in range(tree.total)}, {1, 4})
+
+
+class WeightedSamplerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.sampler = WeightedSampler()
+        random.seed(2)
+
+    def test_weight(self):
+        self.assertEqual(WeightedSampler.weight({'active': 3}), 3)
+        self.assertEqual(WeightedSampler.weight({'active': 3, 'block': 1}), 0)
+        self.assertEqual(WeightedSampler.weight({'active': -2}), 0)
+        self.assertEqual(WeightedSampler.weight(None), 0)
+
+    def test_draw_is_proportional_to_credit(self):
+        self.sampler.update(1, {'active': 1, 'city': "Москва"})
+        self.sampler.update(2, {'active': 9, 'city': "Москва"})
+        drawn = Counter(self.sampler.draw("Москва", 1)[0] for _ in range(2000))
+        self.assertGreater(drawn[2], 6 * drawn[1])
+
+    def test_updates_move_and_remove_profiles(self):
+        self.sampler.update(1, {'active': 2, 'city': "Москва"})
+        self.sampler.update(2, {'active': 2, 'city': "Москва"})
+        # Moved to another city, then blocked, then deleted
+        self.sampler.update(1, {'active': 2, 'city': "Казань"})
+        self.assertEqual(set(self.sampler.draw("Москва", 50)), {2})
+        self.assertEqual(set(self.sampler.draw("Казань", 50)), {1})
+        self.sampler.update(2, {'active': 2, 'city': "Москва", 'block': 1})
+        self.assertEqual(self.sampler.draw("Москва", 50), [])
+        self.sampler.update(1, None)
+        self.assertEqual(self.sampler.draw(ANY_CITY, 50), [])
+
+    def test_unknown_city(self):
+        self.assertEqual(self.sampler.draw("Нигде", 5), [])
+
+
+class DegradedPickTest(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        for patcher in (
+            mock.patch.object(db, 'posts', DownCollection()),
+            mock.patch.object(db, 'circuit', CircuitBreaker()),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.addCleanup(db._document_cache.clear)
+
+    async def test_cached_profiles_are_picked(self):
+        sampler = WeightedSampler()
+        sampler.update(2, {'active': 1})
+        sampler.update(3, {'active': 1})
+        # 3 was already rated by 1
+        db._document_cache[2] = ({'chat_id': 2, 'by': []}, time.time())
+        db._document_cache[3] = ({'chat_id': 3, 'by': [{'id': 1, 'mark': 5}]}, time.time())
+        for _ in range(10):
+            self.assertEqual((await sampler._pick(1, ANY_CITY, set()))['chat_id'], 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
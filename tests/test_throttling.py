@@ -0,0 +1,74 @@
+import os
+import unittest
+from unittest import mock
+
+os.environ.setdefault('TELEGRAM_API_TOKEN', '1:test')
+
+from aiogram import types  # noqa: E402
+from aiogram.dispatcher.handler import CancelHandler, current_handler  # noqa: E402
+
+import throttling  # noqa: E402
+from throttling import MemoryThrottleStorage, ThrottlingMiddleware, rate_limit  # noqa: E402
+
+
+def message(text, user_id=1):
+    return types.Message(**{
+        'message_id': 1, 'date': 0, 'text': text,
+        'chat': {'id': user_id, 'type': 'private'},
+        'from': {'id': user_id, 'is_bot': False, 'first_name': "x"},
+    })
+
+
+class MemoryThrottleStorageTest(unittest.IsolatedAsyncioTestCase):
+
+    async def test_burst_then_refill(self):
+        storage = MemoryThrottleStorage()
+        with mock.patch.object(throttling.time, 'monotonic', return_value=100.0) as clock:
+            self.assertEqual([await storage.consume("k", 1, 2) for _ in range(3)], [True, True, False])
+            clock.return_value = 101.0
+            self.assertTrue(await storage.consume("k", 1, 2))
+            self.assertFalse(await storage.consume("k", 1, 2))
+            # Other keys have their own buckets
+            self.assertTrue(await storage.consume("other", 1, 2))
+
+    async def test_buckets_are_bounded(self):
+        storage = MemoryThrottleStorage(max_buckets=2)
+        for key in ("a", "b", "c"):
+            await storage.consume(key, 1, 1)
+        self.assertEqual(list(storage._buckets), ["b", "c"])
+
+
+class ThrottlingMiddlewareTest(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        self.middleware = ThrottlingMiddleware(storage=MemoryThrottleStorage(), inline_debounce=0)
+
+    async def process(self, handler, text):
+        current_handler.set(handler)
+        try:
+            await self.middleware.on_process_message(message(text), {})
+            return True
+        except CancelHandler:
+            return False
+
+    async def test_limited_handler(self):
+        @rate_limit(1, per=60)
+        async def handler(message):
+            pass
+
+        self.assertEqual([await self.process(handler, "x") for _ in range(2)], [True, False])
+
+    async def test_only_matching_updates_are_limited(self):
+        @rate_limit(1, per=60, when=lambda message: message.text.isdigit())
+        async def handler(message):
+            pass
+
+        self.assertTrue(await self.process(handler, "5"))
+        self.assertFalse(await self.process(handler, "6"))
+        # Skipping right after a rating is not dropped
+        self.assertTrue(await self.process(handler, "Пропустить"))
+        self.assertTrue(await self.process(handler, "Пропустить"))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,140 @@
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+from aiogram import types
+from aiogram.dispatcher.handler import CancelHandler, current_handler
+from aiogram.dispatcher.middlewares import BaseMiddleware
+from pymongo import ReturnDocument
+
+from config import THROTTLE_STORAGE, THROTTLE_RATE, THROTTLE_BURST, INLINE_DEBOUNCE
+
+
+# Configure logger
+logger = logging.getLogger(__name__)
+
+# Upper bound for buckets kept in memory, least recently used ones are evicted first
+MAX_BUCKETS = 100000
+
+
+def rate_limit(rate, per=1.0, burst=None, key=None, when=None):
+    """Decorator that attaches a token bucket limit to a handler, only the updates
+    when(update) is true for are limited if when is given"""
+    def decorator(func):
+        func.throttling_rate = rate / per
+        func.throttling_burst = burst if burst is not None else max(1, int(rate))
+        func.throttling_key = key or func.__name__
+        func.throttling_when = when
+        return func
+    return decorator
+
+
+class MemoryThrottleStorage:
+    """Token buckets per (user, handler) kept in a bounded LRU dictionary"""
+
+    def __init__(self, max_buckets=MAX_BUCKETS):
+        self.max_buckets = max_buckets
+        self._buckets = OrderedDict()
+
+    async def consume(self, key, rate, burst):
+        """Take one token from the bucket, return False if it is empty"""
+        now = time.monotonic()
+        tokens, last = self._buckets.pop(key, (burst, now))
+        tokens = min(burst, tokens + (now - last) * rate)
+        allowed = tokens >= 1
+        if allowed:
+            tokens -= 1
+        self._buckets[key] = (tokens, now)
+        while len(self._buckets) > self.max_buckets:
+            self._buckets.popitem(last=False)
+        return allowed
+
+
+class MongoThrottleStorage:
+    """Token buckets shared between bot instances through a Mongo collection"""
+
+    def __init__(self, collection):
+        self.collection = collection
+
+    async def consume(self, key, rate, burst):
+        """Atomically refill and take one token using an update pipeline"""
+        now = time.time()
+        refilled = {'$min': [burst, {'$add': [
+            {'$ifNull': ['$tokens', burst]},
+            {'$multiply': [{'$subtract': [now, {'$ifNull': ['$ts', now]}]}, rate]}
+        ]}]}
+        pipeline = [
+            {'$set': {'tokens': refilled, 'ts': now,
+                      'expireAt': datetime.utcnow() + timedelta(seconds=burst / rate + 60)}},
+            {'$set': {'allowed': {'$gte': ['$tokens', 1]}}},
+            {'$set': {'tokens': {'$cond': ['$allowed', {'$subtract': ['$tokens', 1]}, '$tokens']}}},
+        ]
+        try:
+            doc = await self.collection.find_one_and_update(
+                {'_id': key}, pipeline, upsert=True, return_document=ReturnDocument.AFTER
+            )
+        except Exception as e:
+            # Never block users because the shared limiter is unavailable
+            logger.warning(f"Shared throttle storage unavailable: {str(e)}")
+            return True
+        return bool(doc and doc.get('allowed'))
+
+
+def create_storage():
+    """Create throttle storage according to THROTTLE_STORAGE setting"""
+    if THROTTLE_STORAGE == 'mongo':
+        import database as db
+        return MongoThrottleStorage(db.throttle)
+    return MemoryThrottleStorage()
+
+
+class ThrottlingMiddleware(BaseMiddleware):
+    """Rate limit messages, callback queries and inline queries per user and handler"""
+
+    def __init__(self, storage=None, rate=THROTTLE_RATE, burst=THROTTLE_BURST, inline_debounce=INLINE_DEBOUNCE):
+        self.storage = storage or create_storage()
+        self.rate = rate
+        self.burst = burst
+        self.inline_debounce = inline_debounce
+        self._inline_seq = OrderedDict()
+        super(ThrottlingMiddleware, self).__init__()
+
+    async def _allowed(self, user_id, update):
+        """Check the bucket of the current handler for this user"""
+        handler = current_handler.get()
+        if handler is None:
+            return True
+        when = getattr(handler, 'throttling_when', None)
+        if when is not None and not when(update):
+            return True
+        rate = getattr(handler, 'throttling_rate', self.rate)
+        burst = getattr(handler, 'throttling_burst', self.burst)
+        key = getattr(handler, 'throttling_key', handler.__name__)
+        return await self.storage.consume(f"{user_id}:{key}", rate, burst)
+
+    async def on_process_message(self, message: types.Message, data: dict):
+        user_id = message.from_user.id if message.from_user else message.chat.id
+        if not await self._allowed(user_id, message):
+            # Silent drop, same as the old liketime/timeout behaviour
+            raise CancelHandler()
+
+    async def on_process_callback_query(self, call: types.CallbackQuery, data: dict):
+        if not await self._allowed(call.from_user.id, call):
+            await call.answer("Слишком часто, подождите немного")
+            raise CancelHandler()
+
+    async def on_process_inline_query(self, inline_query: types.InlineQuery, data: dict):
+        user_id = inline_query.from_user.id
+        if self.inline_debounce > 0:
+            # Only the last query typed within the debounce window gets answered
+            seq = self._inline_seq.pop(user_id, 0) + 1
+            self._inline_seq[user_id] = seq
+            while len(self._inline_seq) > MAX_BUCKETS:
+                self._inline_seq.popitem(last=False)
+            await asyncio.sleep(self.inline_debounce)
+            if self._inline_seq.get(user_id) != seq:
+                raise CancelHandler()
+        if not await self._allowed(user_id, inline_query):
+            raise CancelHandler()
@@ -0,0 +1,159 @@
+import asyncio
+import logging
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from aiogram.dispatcher.handler import current_handler
+from aiogram.dispatcher.middlewares import BaseMiddleware
+
+from config import SLOW_UPDATE_THRESHOLD
+
+
+# Configure logger
+logger = logging.getLogger(__name__)
+
+# Upper bound of spans recorded for a single update, protects broadcasts and big batches
+MAX_SPANS = 500
+
+_current_span = ContextVar("current_span", default=None)
+
+
+class Span:
+    """A timed operation inside the processing of one update"""
+    __slots__ = ("name", "start", "end", "children", "root", "spans")
+
+    def __init__(self, name, root=None):
+        self.name = name
+        self.start = time.perf_counter()
+        self.end = None
+        self.children = []
+        self.root = root or self
+        self.spans = 0  # Number of descendants, only tracked on the root
+
+    @property
+    def duration(self):
+        return (self.end or time.perf_counter()) - self.start
+
+    def format(self, depth=0):
+        """Render the span tree, one line per span"""
+        lines = ["{}{} {:.4f}s".format("  " * depth, self.name, self.duration)]
+        for child in self.children:
+            lines.append(child.format(depth + 1))
+        return "\n".join(lines)
+
+
+def _start(name):
+    """Open a span under the current one, returns None outside of an update"""
+    parent = _current_span.get()
+    if parent is None:
+        return None, None
+    root = parent.root
+    if root.spans >= MAX_SPANS:
+        return None, None
+    root.spans += 1
+    child = Span(name, root)
+    parent.children.append(child)
+    return child, _current_span.set(child)
+
+
+@contextmanager
+def span(name):
+    """Trace the wrapped block as a child of the current span"""
+    child, token = _start(name)
+    try:
+        yield child
+    finally:
+        if child is not None:
+            child.end = time.perf_counter()
+            _current_span.reset(token)
+
+
+def event(name):
+    """Record an instant event, e.g. a cache lookup"""
+    with span(name):
+        pass
+
+
+class TracingMiddleware(BaseMiddleware):
+    """Open a root span per update and a child span per handler, log slow updates"""
+
+    def __init__(self, threshold=SLOW_UPDATE_THRESHOLD):
+        self.threshold = threshold
+        super(TracingMiddleware, self).__init__()
+
+    async def trigger(self, action, args):
+        data = args[-1]
+        if action == "pre_process_update":
+            root = Span("update {}".format(args[0].update_id))
+            data["_trace_root"] = root
+            data["_trace_token"] = _current_span.set(root)
+        elif action == "post_process_update":
+            self._close_handler(data)
+            root = data.pop("_trace_root", None)
+            if root is not None:
+                root.end = time.perf_counter()
+                _current_span.reset(data.pop("_trace_token"))
+                if root.duration >= self.threshold:
+                    logger.warning("Slow update:\n{}".format(root.format()))
+        elif action.startswith("process_"):
+            handler = current_handler.get()
+            if action == "process_update":
+                name = "dispatcher"
+            else:
+                name = "handler.{}".format(handler.__name__ if handler else "unknown")
+            child, token = _start(name)
+            if child is not None:
+                data["_trace_handler"] = (child, token)
+        elif action.startswith("post_process_"):
+            self._close_handler(data)
+        return True
+
+    @staticmethod
+    def _close_handler(data):
+        child, token = data.pop("_trace_handler", (None, None))
+        if child is not None:
+            child.end = time.perf_counter()
+            _current_span.reset(token)
+
+
+class StackSampler:
+    """Samples the event loop thread stack and produces folded stacks for flame graphs"""
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self._lock = asyncio.Lock()
+
+    @property
+    def running(self):
+        return self._lock.locked()
+
+    def _sample(self, thread_id, until, stacks):
+        while time.monotonic() < until:
+            frame = sys._current_frames().get(thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append("{} ({}:{})".format(code.co_name, os.path.basename(code.co_filename), code.co_firstlineno))
+                frame = frame.f_back
+            if stack:
+                stacks[";".join(reversed(stack))] += 1
+            time.sleep(self.interval)
+
+    async def profile(self, seconds):
+        """Sample for the given number of seconds, returns folded stack text"""
+        async with self._lock:
+            stacks = Counter()
+            sampler = threading.Thread(
+                target=self._sample,
+                args=(threading.get_ident(), time.monotonic() + seconds, stacks),
+                daemon=True,
+            )
+            sampler.start()
+            await asyncio.sleep(seconds)
+            await asyncio.get_running_loop().run_in_executor(None, sampler.join)
+            return "\n".join("{} {}".format(stack, count) for stack, count in stacks.most_common()) + "\n"